@@ -0,0 +1,234 @@
+"""
+End-to-end benchmarks against a synthetic library and a local Postgres.
+
+    python bench/run_benchmarks.py --sizes 1000 10000 100000
+    python bench/run_benchmarks.py --compare bench/results/a.json bench/results/b.json
+
+The Postgres server comes from `config.json` (`databases.music`), but every
+size gets its own scratch database (`<dbname>_bench_<size>`), which is dropped
+and recreated. Synthetic libraries are cached under `--work-dir` so repeated
+runs don't regenerate files. Results are written to `bench/results/` named by
+commit, so runs can be compared across commits.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'source'))
+sys.path.insert(0, REPO_DIR)
+import psycopg2 as pg
+from util import (
+    psql_to_df,
+    create_tables,
+    create_playlist_tracks_view,
+    find_new_songs,
+    gen_new_song_config,
+    add_new_song_to_db,
+    get_song_metadata,
+    get_playlist_tracks,
+    track_queries,
+    query_cache,
+)
+from rhythmbox import (
+    create_merge_indexes,
+    sync_rhythmbox,
+)
+from playlist_order import plan_orders
+from synthetic import (
+    generate_library,
+    make_mp3,
+)
+from sort_playlist import sort_format
+from cli import STARTUP_TARGET_MS
+
+RESULTS_DIR = os.path.join(REPO_DIR, 'bench', 'results')
+
+##############################################################################
+##                                 Setup                                    ##
+##############################################################################
+
+def scratch_database(config, size):
+    """ Drops and recreates a scratch database; returns its config. """
+    bench_config = dict(config, dbname=f"{config['dbname']}_bench_{size}")
+    admin = dict(config, dbname='postgres')
+    conn = pg.connect(**admin)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(f"drop database if exists {bench_config['dbname']}")
+    cur.execute(f"create database {bench_config['dbname']}")
+    cur.close()
+    conn.close()
+    return bench_config
+
+class Timer:
+    """ Collects named timings (seconds) into a results dictionary. """
+
+    def __init__(self, results):
+        self.results = results
+
+    def __call__(self, name, func, *args, **kwargs):
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        self.results[name] = time.perf_counter() - start
+        print(f"  {name}: {self.results[name]:.3f} s", flush=True)
+        return out
+
+##############################################################################
+##                               Benchmarks                                 ##
+##############################################################################
+
+def run_size(size, config, work_dir, n_ingest=100, n_metadata=1000):
+    """ Runs every benchmark against a library of `size` songs. """
+    print(f"Library of {size} songs", flush=True)
+    results = dict(size=size)
+    timer = Timer(results)
+    music_dir, rb_dir = timer(
+        'generate_s', generate_library, os.path.join(work_dir, f'lib_{size}'), size
+    )
+    db_config = scratch_database(config, size)
+    create_tables(db_config)
+    create_merge_indexes(db_config)
+    create_playlist_tracks_view(db_config)
+
+    # Full build from the Rhythmbox files into an empty database
+    with track_queries('build') as log:
+        timer('full_build_s', sync_rhythmbox, rb_dir, music_dir, db_config)
+    results['full_build_queries'] = log.queries
+    # Re-sync with nothing changed
+    timer('resync_noop_s', sync_rhythmbox, rb_dir, music_dir, db_config)
+
+    # Scan with a few new files on disk
+    new_files = [f'zz_bench_new_{i}.mp3' for i in range(n_ingest)]
+    for i, file_nm in enumerate(new_files):
+        make_mp3(music_dir+file_nm, dict(title=f'New {i}', artist='Bench Artist'))
+    found = timer('scan_s', find_new_songs, music_dir, db_config)
+    results['scan_new_files'] = len(found)
+
+    # Metadata for a sample of files
+    sample = psql_to_df("select file_nm from song_files", db_config).file_nm.tolist()
+    sample = random.Random(0).sample(sample, min(n_metadata, len(sample)))
+    timer('metadata_s', lambda: [get_song_metadata(f, music_dir) for f in sample])
+    results['metadata_per_file_ms'] = results['metadata_s'] / max(1, len(sample)) * 1000
+
+    # Ingest the new files one at a time, the way the notebook does
+    def ingest():
+        for i, file_nm in enumerate(sorted(found)):
+            song_config = gen_new_song_config(
+                db_config, music_dir, file_nm, f'New {i}', 'Bench Artist', 'Funk', 'Bench Album'
+            )
+            add_new_song_to_db(song_config, db_config)
+    with track_queries('ingest') as log:
+        timer('ingest_s', ingest)
+    results['ingest_per_song_ms'] = results['ingest_s'] / max(1, len(found)) * 1000
+    results['ingest_queries_per_song'] = log.queries / max(1, len(found))
+    results['ingest_connections_per_song'] = log.connections / max(1, len(found))
+    for file_nm in new_files:
+        os.remove(music_dir+file_nm)
+
+    # Repeated Dash page loads, with and without the query cache
+    def page_loads(cache, n=20):
+        for _ in range(n):
+            get_playlist_tracks(db_config, order_by='artist_nm', limit=50, cache=cache)
+    timer('page_loads_uncached_s', page_loads, False)
+    query_cache.clear()
+    hits, misses = query_cache.stats['hits'], query_cache.stats['misses']
+    timer('page_loads_cached_s', page_loads, True)
+    hits, misses = query_cache.stats['hits'] - hits, query_cache.stats['misses'] - misses
+    results['query_cache_hit_rate'] = hits / max(1, hits + misses)
+
+    # Sort every playlist by artist and plan the order changes
+    def sort_playlists():
+        df = psql_to_df("select * from playlist_tracks", db_config)
+        df['sort_key'] = sort_format(df.artist_nm).values
+        changed = 0
+        for _, pl_df in df.groupby('playlist_id'):
+            orders = dict(zip(pl_df.song_id, pl_df.playlist_order))
+            target = pl_df.sort_values(['sort_key', 'playlist_order']).song_id.tolist()
+            changed += len(plan_orders(target, orders))
+        return changed
+    results['sort_rows_changed'] = timer('sort_playlists_s', sort_playlists)
+    results['cli_startup_ms'] = cli_startup_ms()
+    print(f"  cli_startup_ms: {results['cli_startup_ms']:.1f} (target {STARTUP_TARGET_MS})")
+    return results
+
+def cli_startup_ms(repeats=5):
+    """ Best-of-`repeats` wall time of `music --help`, in milliseconds. """
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(REPO_DIR, 'music'), '--help'],
+            capture_output=True, check=True
+        )
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+##############################################################################
+##                                Results                                   ##
+##############################################################################
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=REPO_DIR, capture_output=True, text=True, check=True
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def save_results(runs):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    commit = git_commit()
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(RESULTS_DIR, f'{stamp}-{commit}.json')
+    with open(path, 'w') as fp:
+        json.dump(dict(
+            commit=commit,
+            timestamp=stamp,
+            python=platform.python_version(),
+            machine=platform.platform(),
+            runs=runs,
+        ), fp, indent=2)
+    return path
+
+def compare(path_a, path_b):
+    """ Prints every metric of two result files side by side. """
+    with open(path_a) as fp:
+        a = json.load(fp)
+    with open(path_b) as fp:
+        b = json.load(fp)
+    print(f"{'metric':<40}{a['commit']:>12}{b['commit']:>12}{'ratio':>8}")
+    runs_b = {run['size']: run for run in b['runs']}
+    for run_a in a['runs']:
+        run_b = runs_b.get(run_a['size'], dict())
+        print(f"-- {run_a['size']} songs")
+        for k, va in run_a.items():
+            vb = run_b.get(k)
+            if (k == 'size') or (vb is None):
+                continue
+            ratio = f"{vb/va:.2f}" if va else ''
+            print(f"{k:<40}{va:>12.4g}{vb:>12.4g}{ratio:>8}")
+    return None
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--config', default=os.path.join(REPO_DIR, 'config.json'))
+    parser.add_argument('--work-dir', default=os.path.join(REPO_DIR, 'bench', 'work'))
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    with open(args.config, 'r') as fp:
+        config = json.load(fp)
+    config = config['databases']['music']
+    runs = [run_size(size, config, args.work_dir) for size in args.sizes]
+    print('Results saved to', save_results(runs))
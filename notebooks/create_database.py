@@ -126,61 +126,20 @@ playlist_df = pd.DataFrame(playlist_df)
 
 playlist_df.head()
 
-# Also need to cast values to their proper types:
-
-cast_pairs = {
-    'title': str,
-    'genre': str,
-    'artist': str,
-    'album': str,
-    'duration': int,
-    'file-size': int,
-    'location': str,
-    'mountpoint': str,
-    'mtime': int,
-    'first-seen': int,
-    'last-seen': int,
-    'bitrate': int,
-    'date': int,
-    'media-type': str,
-    'composer': str,
-    'track-number': int,
-    'comment': str,
-    'album-artist': str,
-    'play-count': int,
-    'last-played': int,
-    'track-total': int,
-    'beats-per-minute': float,
-    'track-total': int,
-    'disc-number': int,
-    'disc-total': int,
-    'mb-artistsortname': str,
-    'mb-trackid': str,
-    'mb-artistid': str,
-    'mb-albumid': str,
-    'mb-albumartistid': str,
-    'rating': int,
-    'album-sortname': str
-}
-for k, v in cast_pairs.items():
-    if v == int:
-        rhythmdb_df.fillna(0, inplace=True)
-    try:
-        rhythmdb_df[k] = rhythmdb_df[k].values.astype(v)
-    except:
-        print(k, v)
-        raise Exception
-
-cast_pairs = {
-    'name': str,
-    'show-browser': str,
-    'browser-position': int,
-    'search-type': str,
-    'type': str,
-    'location': str
-}
-for k, v in cast_pairs.items():
-    playlist_df[k] = playlist_df[k].values.astype(v)
+# Also need to cast values to their proper types. The column types are declared in `source/frames.py`; numbers are parsed in one vectorized pass per column, missing values stay missing (nullable integers instead of filling with 0), and repeated names like artist/album/genre are stored as categoricals, which makes the frames several times smaller.
+
+import sys
+sys.path.insert(0, '../source')
+from frames import (
+    build_frame,
+    memory_report,
+    RHYTHMDB_SCHEMA,
+    PLAYLIST_SCHEMA,
+)
+rhythmdb_df = build_frame(rhythmdb_df.to_dict('records'), RHYTHMDB_SCHEMA)
+playlist_df = build_frame(playlist_df.to_dict('records'), PLAYLIST_SCHEMA)
+
+memory_report(rhythmdb_df)
 
 # ## Building the database
 
@@ -198,7 +157,7 @@ playlist_df.columns
 # We will start on the outside at some of the simpler tables and work our way in. First is the `genres` table. Some of the genre names are really stupid, or duplicates/mispellings of each other, but we can fix these errors later.
 
 genres_df = pd.DataFrame()
-genres_df['genre_nm'] = sorted(rhythmdb_df.genre.unique())
+genres_df['genre_nm'] = sorted(rhythmdb_df.genre.dropna().unique())
 genres_df['genre_id'] = genres_df.index
 genres_df = genres_df[['genre_id','genre_nm']]
 
@@ -207,7 +166,7 @@ genres_df.head()
 # ### Make `artists` table
 
 artists_df = pd.DataFrame()
-artists_df['artist_nm'] = sorted(rhythmdb_df.artist.unique())
+artists_df['artist_nm'] = sorted(rhythmdb_df.artist.dropna().unique())
 artists_df['artist_id'] = artists_df.index
 artists_df = artists_df[['artist_id','artist_nm']]
 
@@ -216,7 +175,7 @@ artists_df.head()
 # ### Make `albums` table
 # This one will be a little trickier because it has a foreign key (`artist_id`) which connects to the `artists` table, so we have to tread carefully. Also, a lot of albums from different artists potentially have the same name (e.g. 'Greatest Hits').
 
-albums_df = rhythmdb_df[['artist','album']].drop_duplicates()
+albums_df = rhythmdb_df[['artist','album']].dropna().drop_duplicates()
 albums_df['album_id'] = np.arange(len(albums_df))
 albums_df = pd.merge(albums_df, artists_df, left_on='artist', right_on='artist_nm', how='left')
 albums_df.rename(columns={'album':'album_nm'}, inplace=True)
@@ -225,7 +184,7 @@ albums_df = albums_df[['album_id','artist_id','album_nm']]
 albums_df.head()
 
 # Verify nothing was lost or duplicated in the process
-print(rhythmdb_df[['album','artist']].drop_duplicates().shape[0])
+print(rhythmdb_df[['album','artist']].dropna().drop_duplicates().shape[0])
 print(albums_df.album_id.nunique())
 print(len(albums_df))
 
@@ -265,7 +224,7 @@ cols = {
 }
 song_files_df.rename(columns=cols, inplace=True)
 df = pd.merge(songs_df, artists_df, on='artist_id', how='inner')
-df = pd.merge(df, albums_df, on='album_id', how='inner')
+df = pd.merge(df, albums_df, on='album_id', how='left')  # keep songs without an album
 song_files_df = pd.merge(song_files_df, df, on=list(cols.values()), how='inner')
 song_files_df['file_nm'] = song_files_df.location.str.replace(r'^.*/Saved/', '').apply(unquote)
 song_files_df.rename(columns={'beats-per-minute':'beats_per_min', 'file-size':'file_size'}, inplace=True)
@@ -309,7 +268,9 @@ playlists_table_df = playlists_table_df[['playlist_id','playlist_nm']]
 df = list()
 for _, group in playlist_songs_df.groupby('playlist_id'):
     group = group.sort_values(by='artist_nm')
-    group['playlist_order'] = np.arange(len(group))
+    # Leave gaps between orders so songs can be inserted without renumbering
+    # the rest of the playlist (see `source/playlist_order.py`)
+    group['playlist_order'] = np.arange(len(group)) * 1024
     df.append(group)
 playlist_songs_df = pd.concat(df, axis=0)
 del df
@@ -466,7 +427,8 @@ create table songs(
 cur.execute(query)
 conn.commit()
 
-# Add rows
+# Add rows (songs without an album/genre get nulls)
+songs_df = songs_df.astype(object).where(songs_df.notna(), None)
 for _, row in songs_df.iterrows():
     query = """
     insert into songs
@@ -546,6 +508,9 @@ conn.commit()
 
 song_files_df.info()
 
+# Missing bitrate/duration/etc. are uploaded as nulls
+song_files_df = song_files_df.astype(object).where(song_files_df.notna(), None)
+
 conn = pg.connect(**config)
 cur = conn.cursor()
 
@@ -33,6 +33,8 @@ from util import (
     delete_song_from_db,
     change_song_name,
     get_song_metadata,
+    create_playlist_tracks_view,
+    get_playlist_tracks,
 )
 MUSIC_DIR = r"/media/ecotner/HDD/Users/27182_000/Music/Saved/"
 
@@ -136,3 +138,205 @@ metadata = get_song_metadata(file_nm, MUSIC_DIR)
 metadata
 
 
+
+# ## Denormalized playlist view
+# Reading a playlist means joining seven tables, so there's a `playlist_tracks` materialized view that holds every playlist track with all its display columns. It only needs to be created once; the delete/rename helpers refresh it afterwards.
+
+create_playlist_tracks_view(config)
+
+get_playlist_tracks(config, playlist_nm='Favorites', order_by='artist_nm', limit=10)
+
+# ## Renamed and duplicate files
+# `find_new_songs` only compares file names, so renaming a file makes it look brand new. The fingerprint index stores the size and a hash of the first/last blocks of every file, so a scan can tell renamed files (mapped back to their old `song_id`) and duplicate files apart from genuinely new ones. Unchanged files (same size and mtime) aren't reread.
+
+from fingerprint import (
+    create_fingerprint_table,
+    scan_music_dir,
+    update_fingerprint_index,
+)
+create_fingerprint_table(config)
+
+scan = update_fingerprint_index(MUSIC_DIR, config)
+print("New files:", len(scan['new_files']))
+print("Renamed files:", scan['renamed'])
+print("Duplicates:", scan['duplicates'])
+
+# ## Editing playlists
+# `playlist_order` values are spaced `ORDER_GAP` apart, so inserting or moving a song only writes that one row (it takes the midpoint between its new neighbours). The playlist only gets renumbered when two neighbours end up adjacent.
+
+from playlist_order import (
+    create_playlist_order_index,
+    insert_song,
+    move_song,
+    remove_song,
+)
+create_playlist_order_index(config)
+
+# ## Pruning missing files
+# When a lot of files get removed from the music directory, deleting them one `song_id` at a time is slow. `delete_songs_from_db` removes them all in one transaction, and `collect_orphans` cleans up any artists/albums/genres that no longer have songs.
+
+from util import (
+    find_missing_songs,
+    delete_songs_from_db,
+    collect_orphans,
+)
+missing_song_ids = find_missing_songs(MUSIC_DIR, config)
+print(f"{len(missing_song_ids)} songs no longer have files")
+
+delete_songs_from_db(missing_song_ids, config, collect_orphans=True)
+
+# ## Library snapshots
+# For analysis it's faster to dump the whole denormalized library to Arrow once, then memory-map it instead of re-running the joins against the database.
+
+from snapshot import (
+    export_snapshot,
+    load_snapshot,
+)
+export_snapshot(config, '../snapshot')
+
+snapshot = load_snapshot('../snapshot')
+snapshot['library'].info(memory_usage='deep')
+
+# ## Re-syncing from Rhythmbox
+# Instead of rebuilding the whole database with `create_database.py` (which drops every table and reassigns all the IDs), we can merge the current Rhythmbox files into it. Only the songs/playlists that changed are touched, and existing IDs stay the same. A dry run shows what would change.
+
+from rhythmbox import (
+    create_merge_indexes,
+    sync_rhythmbox,
+)
+RB_DIR = "/home/ecotner/.local/share/rhythmbox/"
+create_merge_indexes(config)
+
+sync_rhythmbox(RB_DIR, MUSIC_DIR, config, dry_run=True)
+
+# ## Fast lookups
+# Questions like "which playlists have this artist in them" don't need a round trip to the database or a pandas merge every time; `LibraryIndex` loads the library once into compact arrays and answers them directly.
+
+from library_index import LibraryIndex
+index = LibraryIndex.from_database(config)
+index
+
+index.playlists_with_artist('ACDC')
+
+# ## Writing tags back to files
+# `change_song_name` and friends only touch the database, so the file tags drift and a rescan would read the old names back. `write_back_tags` finds the files whose tags differ from the database and rewrites them (in parallel, replacing each file atomically); files already in sync are skipped.
+
+from tags import write_back_tags
+write_back_tags(config, MUSIC_DIR, dry_run=True)
+
+# ## How many queries does that take?
+# `track_queries` records every statement the helpers run (shape, latency, rows, connection) so it's easy to see how many round trips something like adding a song really costs, and to spot the same statement being run once per item.
+
+from util import track_queries
+with track_queries('add fake song') as log:
+    fake_song_config = make_temp_fake(lambda : gen_new_song_config(
+        config=config,
+        music_dir=MUSIC_DIR,
+        file_nm='fake_music.mp3',
+        song_nm='Fake Music',
+        artist_nm='Aerosmith',
+        genre_nm='Rock',
+        album_nm='Toys in the attic',
+    ))
+    add_new_song_to_db(fake_song_config, config)
+print(log)
+log.summary()
+
+delete_song_from_db(fake_song_config['song_id'], config)
+
+# ## Smart playlists
+# Rhythmbox's automatic playlists get skipped by the importers, so they're kept as rules instead (`smart_playlists.py`). Each one compiles to a single query over the library, and its results are cached until something in the library changes.
+
+from smart_playlists import (
+    create_smart_playlist_tables,
+    import_rhythmbox_smart_playlists,
+    save_smart_playlist,
+    get_smart_playlist,
+)
+create_smart_playlist_tables(config)
+import_rhythmbox_smart_playlists(RB_DIR, config)
+
+save_smart_playlist(
+    'Long reggae',
+    {'all': [['genre', '=', 'Reggae'], ['duration', '>', 300]]},
+    config,
+    sort_by='duration',
+    descending=True,
+)
+get_smart_playlist('Long reggae', config)
+
+# ## Similar songs
+# Songs that keep ending up in the same playlists are probably alike. `SimilarSongs` puts playlist membership in a sparse song x playlist matrix and precomputes every song's nearest neighbours (cosine similarity) with sparse products. After editing playlists, `refresh` only recomputes the songs the edit could have affected.
+
+from similar import SimilarSongs
+similar = SimilarSongs.from_database(config)
+similar.similar_songs(similar.song_ids[0], k=10)
+
+similar.extend_playlist('Favorites', n=10)
+
+# ## Play counts
+# The Dash player reports plays to `/plays`, which only queues them in a `PlayBuffer`; a background thread writes them to the `plays` table in batches and keeps the per-song/per-artist rollups up to date. Rhythmbox's own play counts can seed the rollups.
+
+from plays import (
+    create_play_tables,
+    import_rhythmbox_play_counts,
+    get_play_counts,
+)
+create_play_tables(config)
+import_rhythmbox_play_counts(RB_DIR, MUSIC_DIR, config)
+get_play_counts(config, by='artist', limit=10)
+
+# ## Cached reads
+# With `cache=True` (which the Dash app uses), `psql_to_df` keeps recent results in `query_cache` (LRU, with a TTL). Any statement that writes to a table, from any helper, drops the cached results that read from it, so renaming/adding/deleting a song is visible straight away.
+
+from util import query_cache
+get_playlist_tracks(config, playlist_nm='Favorites', order_by='artist_nm', limit=10, cache=True)
+get_playlist_tracks(config, playlist_nm='Favorites', order_by='artist_nm', limit=10, cache=True)
+print(query_cache)
+query_cache.summary()
+
+# ## Album art
+# Cover images are kept out of the metadata scan. `extract_all_artwork` reads one file per album in a thread pool and stores a thumbnail per distinct image under `artwork/` (named by content hash); the Dash app serves them from `/art/<song_id>`, extracting on the fly for songs the batch job hasn't reached.
+
+from artwork import (
+    create_artwork_table,
+    extract_all_artwork,
+)
+create_artwork_table(config)
+extract_all_artwork(config, MUSIC_DIR, '../artwork/')
+
+# ## Exporting playlists
+# Every playlist can be written out for another player, streamed straight from the database: one .m3u8/.xspf per playlist, or a single Rhythmbox `playlists.xml`. `music_dir` is where the other player sees the files.
+
+from playlist_export import export_playlists
+export_playlists(config, '../playlists/', MUSIC_DIR, fmt='xspf')
+
+# ## Batched edits
+# Each helper above commits on its own. A `Session` queues edits instead and writes them with a few batched statements on one connection, committing once at the end (and refreshing `playlist_tracks` in the same transaction). If anything in the block fails, nothing is changed.
+
+from session import Session
+with Session(config) as s:
+    song_id = s.add_song('fake_music.mp3', 'Fake Music', 'Aerosmith', 'Rock', 'Toys in the attic', music_dir=MUSIC_DIR)
+    s.rename_song(song_id, 'Poop Music')
+    s.delete_songs([song_id])
+
+# ## Local read replica
+# `refresh` copies the database into a SQLite file (the first time) or recopies just the rows changed since, using the change log triggers fill in. After `use_replica`, reads that pass `replica=True` go to the file (and queries SQLite can't run go to Postgres); everything else still reads from Postgres.
+
+from replica import refresh
+from util import use_replica
+refresh(config, '../replica.sqlite')
+use_replica('../replica.sqlite')
+get_playlist_tracks(config, playlist_nm='Favorites', limit=10, replica=True)
+
+# ## Duplicate names
+# Genre (and artist/album) names that are misspellings or variants of each other ('Hip Hop'/'Hip-Hop') are found with n-gram blocking and clustered; each cluster proposes the name with the most songs. Drop the rows you don't want merged, then `merge_names` rewrites `songs`/`albums` to the canonical ids in one transaction.
+
+from dedupe import (
+    find_duplicates,
+    merge_names,
+)
+proposals = find_duplicates('genres', config)
+proposals
+
+merge_names('genres', proposals[proposals.score >= 0.9], config)
@@ -1,48 +1,152 @@
-import gmusicapi
+import os
+import sys
+import threading
+from queue import Queue, Full
 import pandas as pd
 from time import sleep
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'source'))
+from frames import (
+    build_frame,
+    concat_frames,
+    GOOGLE_SONG_SCHEMA,
+    GOOGLE_ENTRY_SCHEMA,
+)
 
 
 def login():
+    # Imported here so the sorting helpers work without gmusicapi installed
+    import gmusicapi
     api = gmusicapi.clients.Mobileclient()
     api.oauth_login(api.FROM_MAC_ADDRESS, 'oauth_token')
     return api
 
+def prefetch(pages, depth=2):
+    """
+    Iterates over `pages` (a generator of API pages) from a background
+    thread that keeps up to `depth` pages fetched ahead, so waiting on the
+    network overlaps with processing the previous page. Errors are raised
+    in the caller.
+    """
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Gives up once the consumer has stopped, so the thread can exit
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=fetch, name='prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, error = queue.get()
+            if page is done:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        # The consumer stopped early (or failed); let the fetcher exit
+        stop.set()
+
+def _private_entry_pages(api):
+    """
+    Playlist entries a page at a time through the Mobileclient's private
+    `_get_all_items`, the only call that pages them (the public
+    `get_all_user_playlist_contents` downloads every playlist first).
+    Private API: returns None if this gmusicapi version doesn't have it.
+    """
+    get_all_items = getattr(api, '_get_all_items', None)
+    try:
+        from gmusicapi.protocol import mobileclient
+        call = mobileclient.ListPlaylistEntries
+    except (ImportError, AttributeError):
+        return None
+    if get_all_items is None:
+        return None
+    return get_all_items(call, incremental=True)
+
+def _playlist_entry_pages(api):
+    """
+    Pages of playlist entries: paged through the private listing call when
+    it's available, otherwise one page per playlist from the public API.
+    """
+    pages = _private_entry_pages(api)
+    if pages is None:
+        pages = (pl['tracks'] for pl in api.get_all_user_playlist_contents())
+    return pages
+
+def iter_playlist_entries(api):
+    """
+    Yields playlist entries a page at a time, as typed frames with the same
+    columns as `_get_all_playlist_ids`. Pages are fetched in the background
+    while the previous one is being converted. Entries aren't in playlist
+    order across pages; `_get_all_playlist_ids` sorts them.
+    """
+    playlists = {
+        pl['id']: pl['name'] for page in api.get_all_playlists(incremental=True) for pl in page
+        if pl.get('type', 'USER_GENERATED') != 'SHARED'
+    }
+    for page in prefetch(_playlist_entry_pages(api)):
+        rows = [
+            (e.get('playlistId'), e.get('trackId'), e.get('id'), e.get('absolutePosition'))
+            for e in page
+            if (e.get('playlistId') in playlists) and not e.get('deleted', False)
+        ]
+        chunk = build_frame(rows, GOOGLE_ENTRY_SCHEMA)
+        names = chunk.playlist_id.map(playlists).astype('category')
+        chunk.insert(0, 'playlist_nm', names)
+        yield chunk
+
 def _get_all_playlist_ids(api):
     """
     Gets all playlists from google music account. Only has playlist info
     and a unique song_id; have to merge with library to get song/artist
     names.
     """
-    all_playlists = api.get_all_user_playlist_contents()
-    all_playlists_df = list()
-    for pl in all_playlists:
-        pl_nm = pl['name']
-        pl_id = pl['id']
-        for track in pl['tracks']:
-            row = [
-                pl_nm,
-                pl_id,
-                track.get('trackId', None),
-                track.get('id', None)
-            ]
-            all_playlists_df.append(row)
-    col_names = ['playlist_nm','playlist_id','song_id','pl_entry_id']
-    all_playlists_df = pd.DataFrame(all_playlists_df, columns=col_names)
+    chunks = list(iter_playlist_entries(api))
+    if len(chunks) == 0:
+        df = build_frame([], GOOGLE_ENTRY_SCHEMA).drop(columns='position')
+        df.insert(0, 'playlist_nm', pd.Series(dtype='category'))
+        return df
+    all_playlists_df = concat_frames(chunks)
+    all_playlists_df = all_playlists_df.sort_values(['playlist_id','position'], kind='stable')
+    all_playlists_df = all_playlists_df.drop(columns='position').reset_index(drop=True)
     return all_playlists_df
 
+def iter_songs(api):
+    """
+    Yields the library a page at a time, as typed frames of (song_id,
+    title, artist, album), so the first songs are available before the
+    whole library has been downloaded.
+    """
+    for page in prefetch(api.get_all_songs(incremental=True)):
+        rows = [tuple(track.get(k) for k in ['id','title','artist','album']) for track in page]
+        yield build_frame(rows, GOOGLE_SONG_SCHEMA)
+
 def get_all_songs(api):
     """
     Gets all songs in the library, including all song/artist/album names.
     """
-    library = api.get_all_songs()
-    library_df = list()
-    for track in library:
-        row = [track[k] for k in ['id','title','artist','album']]
-        library_df.append(row)
-    col_names = ['song_id','title','artist','album']
-    library_df = pd.DataFrame(library_df, columns=col_names)
-    return library_df
+    chunks = list(iter_songs(api))
+    if len(chunks) == 0:
+        return build_frame([], GOOGLE_SONG_SCHEMA)
+    return concat_frames(chunks)
 
 def get_all_playlists(api):
     """
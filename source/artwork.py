@@ -0,0 +1,234 @@
+import os
+import io
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+)
+
+THUMBNAIL_SIZE = 256
+MIME_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+}
+# Shown for songs without artwork
+PLACEHOLDER_SVG = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="64" height="64">'
+    '<rect width="64" height="64" fill="#444"/></svg>'
+)
+
+##############################################################################
+##                          Extracting artwork                              ##
+##############################################################################
+
+def extract_artwork(path):
+    """
+    Reads the embedded cover image of a file as (bytes, mime type), or None
+    if it has none. Prefers the front cover when there are several images.
+    """
+    import mutagen
+    from mutagen.mp4 import MP4Cover
+    file = mutagen.File(path)
+    if (file is None) or (file.tags is None):
+        return None
+    if hasattr(file.tags, 'getall'):
+        # ID3 (MP3/WAV): APIC frames, type 3 is the front cover
+        frames = sorted(file.tags.getall('APIC'), key=lambda f: f.type != 3)
+        if len(frames) > 0:
+            return bytes(frames[0].data), frames[0].mime.lower()
+    if 'covr' in file.tags:
+        # MP4: 'covr' atoms
+        cover = file.tags['covr'][0]
+        mime = 'image/png' if cover.imageformat == MP4Cover.FORMAT_PNG else 'image/jpeg'
+        return bytes(cover), mime
+    if len(getattr(file, 'pictures', [])) > 0:
+        # FLAC picture blocks
+        pictures = sorted(file.pictures, key=lambda p: p.type != 3)
+        return pictures[0].data, pictures[0].mime.lower()
+    return None
+
+def make_thumbnail(data, size=THUMBNAIL_SIZE):
+    """
+    Shrinks an image to fit in `size` x `size` as a JPEG. Pillow is optional:
+    without it (or for images it can't read) the original is returned as is.
+    Returns (bytes, mime type).
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return data, None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.thumbnail((size, size))
+        out = io.BytesIO()
+        img.convert('RGB').save(out, 'JPEG', quality=85)
+    except (OSError, ValueError):
+        return data, None
+    return out.getvalue(), 'image/jpeg'
+
+def cache_artwork(data, mime, cache_dir):
+    """
+    Stores a thumbnail of an image in the content-addressed cache (named by
+    the hash of the original image, so every song/album with the same cover
+    shares one file) unless it's already there. Returns the hash.
+    """
+    art_hash = hashlib.sha1(data).hexdigest()
+    sub_dir = os.path.join(cache_dir, art_hash[:2])
+    for ext in set(MIME_EXTENSIONS.values()):
+        if os.path.exists(os.path.join(sub_dir, art_hash+ext)):
+            return art_hash
+    thumb, thumb_mime = make_thumbnail(data)
+    ext = MIME_EXTENSIONS.get(thumb_mime or mime, '.jpg')
+    os.makedirs(sub_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=sub_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(thumb)
+    os.replace(tmp_path, os.path.join(sub_dir, art_hash+ext))
+    return art_hash
+
+def artwork_path(art_hash, cache_dir):
+    """ Path of a cached thumbnail, or None if it isn't cached. """
+    sub_dir = os.path.join(cache_dir, art_hash[:2])
+    for ext in set(MIME_EXTENSIONS.values()):
+        path = os.path.join(sub_dir, art_hash+ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def _extract_and_cache(path, cache_dir):
+    """ Extracts and caches one file's artwork; returns its hash or None. """
+    import mutagen
+    try:
+        art = extract_artwork(path)
+    except (OSError, mutagen.MutagenError):
+        return None
+    if art is None:
+        return None
+    return cache_artwork(art[0], art[1], cache_dir)
+
+##############################################################################
+##                              Database                                    ##
+##############################################################################
+
+def create_artwork_table(config):
+    """
+    Creates `song_artwork`, which maps each song to the hash of its cached
+    thumbnail. Songs that have been checked and have no artwork get a null
+    hash, so they aren't reread.
+    """
+    query = """
+    create table if not exists song_artwork(
+        song_id integer not null,
+        art_hash varchar,
+        primary key (song_id),
+        foreign key (song_id) references songs (song_id) on delete cascade
+    );
+    create index if not exists song_artwork_art_hash on song_artwork (art_hash);
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _save_hashes(rows, config):
+    query = """
+    insert into song_artwork (song_id, art_hash)
+    values %s
+    on conflict (song_id) do update set art_hash = excluded.art_hash;
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    execute_values(cur, query, rows)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _songs_to_extract(config, song_ids=None, refresh=False):
+    """
+    Songs without an artwork row (or every song, with `refresh`), with their
+    album and one file each.
+    """
+    query = """
+    select songs.song_id, songs.album_id, min(song_files.file_nm) file_nm
+    from songs
+        join song_files on song_files.song_id = songs.song_id
+        left join song_artwork on song_artwork.song_id = songs.song_id
+    where (song_artwork.song_id is null or %s)
+    """
+    values = [refresh]
+    if song_ids is not None:
+        query += " and songs.song_id = any(%s)"
+        values.append([int(s) for s in song_ids])
+    query += " group by songs.song_id, songs.album_id order by songs.song_id"
+    return psql_to_df(query, config, values, cache=False)
+
+def extract_all_artwork(config, music_dir, cache_dir, song_ids=None, refresh=False, workers=8):
+    """
+    Batch job: extracts and caches artwork for every song that hasn't been
+    checked yet (or every song, with `refresh`), in a thread pool. Songs in
+    the same album share their cover, so only one file per album is read
+    and its artwork is assigned to the whole album; if that file has none,
+    the album's other files are tried before it's recorded as having none.
+    Returns the number of files read and songs with/without artwork.
+    """
+    df = _songs_to_extract(config, song_ids, refresh)
+    if len(df) == 0:
+        return dict(files_read=0, with_artwork=0, without_artwork=0)
+    # One representative file per album; songs without an album stand alone
+    df['group'] = df.album_id.astype('Int64').astype(str).where(
+        df.album_id.notna(), 'song:' + df.song_id.astype(str)
+    )
+    reps = df.drop_duplicates('group')
+    extract = lambda file_nm: _extract_and_cache(music_dir+file_nm, cache_dir)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        group_hashes = dict(zip(reps.group, pool.map(extract, reps.file_nm)))
+        # Albums whose representative file has no art: try the rest of their files
+        rest = df[df.group.map(group_hashes).isna() & ~df.index.isin(reps.index)]
+        rest = rest.drop_duplicates('file_nm')
+        for group, art_hash in zip(rest.group, pool.map(extract, rest.file_nm)):
+            if group_hashes[group] is None:
+                group_hashes[group] = art_hash
+    df['art_hash'] = df.group.map(group_hashes)
+    df['art_hash'] = df.art_hash.astype(object).where(df.art_hash.notna(), None)
+    _save_hashes([(int(s), h) for s, h in zip(df.song_id, df.art_hash)], config)
+    n_with = int(df.art_hash.notna().sum())
+    return dict(files_read=len(reps)+len(rest), with_artwork=n_with, without_artwork=len(df)-n_with)
+
+def _extract_song(song_id, config, music_dir, cache_dir):
+    """ Extracts one song's artwork and saves its hash. """
+    todo = _songs_to_extract(config, [song_id], refresh=True)
+    if len(todo) == 0:
+        raise KeyError(f"song_id {song_id} has no song file")
+    art_hash = _extract_and_cache(music_dir+todo.file_nm.iloc[0], cache_dir)
+    _save_hashes([(int(song_id), art_hash)], config)
+    return art_hash
+
+def get_artwork(song_id, config, music_dir, cache_dir, replica=False):
+    """
+    Path of a song's cached thumbnail, or None if it has no artwork. Songs
+    that haven't been checked yet are extracted on the spot. With `replica`,
+    the hash is looked up in the local replica.
+    """
+    query = "select art_hash from song_artwork where song_id = %s"
+    df = psql_to_df(query, config, (int(song_id),), cache=True, replica=replica)
+    if len(df) == 0:
+        art_hash = _extract_song(song_id, config, music_dir, cache_dir)
+    else:
+        art_hash = df.art_hash.iloc[0]
+    if art_hash is None:
+        return None
+    path = artwork_path(art_hash, cache_dir)
+    if path is None:
+        # The cache directory was cleared; extract it again
+        art_hash = _extract_song(song_id, config, music_dir, cache_dir)
+        path = None if art_hash is None else artwork_path(art_hash, cache_dir)
+    return path
@@ -0,0 +1,336 @@
+"""
+`music` command-line entry point.
+
+    music scan [--fingerprints]
+    music ingest [--rhythmbox [RB_DIR]] [--dry-run]
+    music sort [--playlist NAME] [--by artist_nm] [--dry-run]
+    music smart [NAME]
+    music export [--out DIR] [--format arrow|parquet|m3u8|xspf|rhythmbox]
+    music artwork [--cache-dir DIR] [--refresh]
+    music check [--reread] [--report PATH]
+    music dedupe {artists,genres,albums} [--min-score S] [--apply]
+    music replicate [--path PATH] [--full] [--prune]
+    music serve [--limit N] [--replica [PATH]] [--debug]
+
+Only the standard library is imported at startup; pandas, psycopg2, mutagen
+and dash are imported by the subcommand that needs them. `music --help` (and
+argument errors) should take well under STARTUP_TARGET_MS, which
+`bench/run_benchmarks.py` measures.
+"""
+import os
+import sys
+import json
+import argparse
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(REPO_DIR, 'config.json')
+MUSIC_DIR = '/media/ecotner/HDD/Users/27182_000/Music/Saved/'
+RB_DIR = os.path.expanduser('~/.local/share/rhythmbox/')
+ARTWORK_DIR = os.path.join(REPO_DIR, 'artwork')
+REPLICA_PATH = os.path.join(REPO_DIR, 'replica.sqlite')
+STARTUP_TARGET_MS = 100
+
+##############################################################################
+##                               Subcommands                                ##
+##############################################################################
+
+def scan(args, config):
+    """ Lists music files that aren't in the database yet. """
+    if args.fingerprints:
+        from fingerprint import (
+            create_fingerprint_table,
+            update_fingerprint_index,
+        )
+        create_fingerprint_table(config)
+        result = update_fingerprint_index(args.music_dir, config, args.full_hash)
+        new_files = result['new_files']
+        print(f"{len(result['renamed'])} renamed, {len(result['duplicates'])} duplicate files")
+    else:
+        from util import find_new_songs
+        new_files = find_new_songs(args.music_dir, config)
+    for file_nm in sorted(new_files):
+        print(file_nm)
+    print(f"{len(new_files)} new files", file=sys.stderr)
+    return 0
+
+def ingest(args, config):
+    """
+    Adds new files to the database. With --rhythmbox the Rhythmbox library is
+    merged in; otherwise new files are added using their own tags.
+    """
+    if args.rhythmbox is not None:
+        from rhythmbox import (
+            create_merge_indexes,
+            sync_rhythmbox,
+        )
+        from smart_playlists import (
+            create_smart_playlist_tables,
+            import_rhythmbox_smart_playlists,
+        )
+        # The merge upserts conflict on these, even when it's rolled back
+        create_merge_indexes(config)
+        if not args.dry_run:
+            # Created up front, so the static merge isn't left committed alone
+            create_smart_playlist_tables(config)
+        counts = sync_rhythmbox(args.rhythmbox, args.music_dir, config, dry_run=args.dry_run)
+        for key, n in counts.items():
+            print(f"{key}: {n}")
+        if not args.dry_run:
+            skipped = import_rhythmbox_smart_playlists(args.rhythmbox, config)
+            for pl_nm, reason in skipped.items():
+                print(f"skipping smart playlist {pl_nm}: {reason}", file=sys.stderr)
+        return 0
+    from util import (
+        find_new_songs,
+        gen_new_song_config,
+        add_new_song_to_db,
+        refresh_playlist_tracks,
+    )
+    from tags import read_tags
+    n_added, n_skipped = 0, 0
+    for file_nm in sorted(find_new_songs(args.music_dir, config)):
+        tags = read_tags(args.music_dir+file_nm)
+        if (tags['song_nm'] is None) or (tags['artist_nm'] is None):
+            print(f"skipping {file_nm}: no title/artist tag", file=sys.stderr)
+            n_skipped += 1
+            continue
+        print(f"{tags['artist_nm']} - {tags['song_nm']}")
+        if not args.dry_run:
+            song_config = gen_new_song_config(config, args.music_dir, file_nm, **tags)
+            add_new_song_to_db(song_config, config)
+        n_added += 1
+    if (n_added > 0) and not args.dry_run:
+        refresh_playlist_tracks(config)
+    print(f"{n_added} added, {n_skipped} skipped", file=sys.stderr)
+    return 0
+
+def sort(args, config):
+    """ Sorts the database playlists, writing only the songs that move. """
+    from playlist_order import sort_playlists
+    changed = sort_playlists(config, args.playlist, args.by, args.dry_run)
+    for pl_nm, n in changed.items():
+        print(f"{pl_nm}: {n} moved")
+    return 0
+
+def smart(args, config):
+    """ Lists the smart playlists, or the songs in one of them. """
+    from smart_playlists import (
+        list_smart_playlists,
+        get_smart_playlist,
+    )
+    if args.playlist is None:
+        df = list_smart_playlists(config)
+        cols = ['playlist_nm', 'n_songs', 'up_to_date']
+    else:
+        df = get_smart_playlist(args.playlist, config)
+        cols = ['position', 'artist_nm', 'song_nm', 'album_nm']
+    print(df[cols].to_string(index=False))
+    return 0
+
+def export(args, config):
+    """ Writes a snapshot of the library, or exports the playlists. """
+    if args.format in ['arrow', 'parquet']:
+        from snapshot import export_snapshot
+        paths = export_snapshot(config, args.out or os.path.join(REPO_DIR, 'snapshot'), args.format)
+    else:
+        from playlist_export import export_playlists
+        out = args.out or os.path.join(REPO_DIR, 'playlists')
+        paths = export_playlists(config, out, args.player_music_dir or args.music_dir, args.format)
+    for path in paths:
+        print(path)
+    return 0
+
+def artwork(args, config):
+    """ Extracts album art into the thumbnail cache. """
+    from artwork import (
+        create_artwork_table,
+        extract_all_artwork,
+    )
+    create_artwork_table(config)
+    counts = extract_all_artwork(config, args.music_dir, args.cache_dir, refresh=args.refresh)
+    for key, n in counts.items():
+        print(f"{key}: {n}")
+    return 0
+
+def check(args, config):
+    """
+    Checks that every file in the database is on disk and unchanged. Exits
+    with status 1 if anything is missing, changed or orphaned.
+    """
+    from integrity import (
+        check_library,
+        write_report,
+    )
+    report = check_library(config, args.music_dir, reread=args.reread, workers=args.workers)
+    for key, n in report['summary'].items():
+        print(f"{key}: {n}")
+    if args.report is not None:
+        print(write_report(report, args.report))
+    problems = sum(n for key, n in report['summary'].items() if key not in ['checked', 'unverified'])
+    return 1 if problems > 0 else 0
+
+def dedupe(args, config):
+    """ Finds near-duplicate artist/genre/album names, and merges them with --apply. """
+    from dedupe import (
+        find_duplicates,
+        merge_names,
+    )
+    proposals = find_duplicates(args.table, config, args.min_score)
+    for _, cluster in proposals.groupby('cluster', sort=False):
+        names = ', '.join(f"{nm!r} ({songs})" for nm, songs in zip(cluster.nm, cluster.songs))
+        print(f"{cluster.canonical_nm.iloc[0]!r} <- {names}")
+    print(f"{proposals.cluster.nunique()} clusters of near-duplicate {args.table}")
+    if args.apply:
+        for table, n in merge_names(args.table, proposals, config).items():
+            print(f"{table}: {n}")
+    return 0
+
+def replicate(args, config):
+    """ Copies the database into a local SQLite replica, or refreshes it. """
+    from replica import (
+        full_copy,
+        refresh,
+    )
+    if args.full:
+        summary = full_copy(config, args.path)
+    else:
+        summary = refresh(config, args.path, prune=args.prune)
+    print(f"{'full copy' if summary['full'] else 'refreshed'} at snapshot {summary['snapshot']}")
+    for table, n in summary['rows'].items():
+        print(f"{table}: {n}")
+    return 0
+
+def serve(args, config):
+    """ Runs the Dash app. """
+    import importlib.util
+    # Loaded by path, since the `source/dash` directory shadows the package name
+    path = os.path.join(REPO_DIR, 'source', 'dash', 'app.py')
+    spec = importlib.util.spec_from_file_location('music_app', path)
+    app_module = importlib.util.module_from_spec(spec)
+    # Registered so Dash can find the app's directory (and its assets)
+    sys.modules[spec.name] = app_module
+    spec.loader.exec_module(app_module)
+    app_module.MUSIC_DIR = args.music_dir
+    replica = args.replica is not None
+    if replica:
+        # The app's reads come from the local copy, so browsing works without Postgres
+        app_module.use_replica(args.replica)
+    else:
+        app_module.artwork.create_artwork_table(config)
+    try:
+        app_module.create_play_tables(config)
+    except app_module.psycopg2.OperationalError:
+        if not replica:
+            raise
+        # Postgres is down; the play buffer keeps plays until it's back
+    df = app_module.get_song_data(config, args.limit, replica=replica)
+    similar = app_module.SimilarSongs.from_database(config, replica=replica)
+    play_buffer = app_module.PlayBuffer(config)
+    app = app_module.build_app(
+        df, limit=args.limit, similar=similar, play_buffer=play_buffer,
+        artwork_dir=args.artwork_dir, dbconfig=config, replica=replica
+    )
+    app.run_server(host=args.host, port=args.port, debug=args.debug)
+    return 0
+
+##############################################################################
+##                             Argument parsing                             ##
+##############################################################################
+
+def load_config(path):
+    """ Reads the `music` database config (and `music_dir`, if set). """
+    with open(path, 'r') as fp:
+        config = json.load(fp)
+    return config['databases']['music'], config.get('music_dir')
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='music', description='Music library maintenance.')
+    parser.add_argument('--config', default=os.environ.get('MUSIC_CONFIG', CONFIG_PATH),
+        help="config.json with the database credentials (default: %(default)s)")
+    parser.add_argument('--music-dir',
+        help="music directory (default: `music_dir` in the config, or MUSIC_DIR)")
+    sub = parser.add_subparsers(dest='command', metavar='command')
+    sub.required = True
+
+    p = sub.add_parser('scan', help=scan.__doc__.strip())
+    p.add_argument('--fingerprints', action='store_true',
+        help="detect renamed/duplicate files with the fingerprint index")
+    p.add_argument('--full-hash', action='store_true',
+        help="confirm fingerprint matches with a full-file hash")
+    p.set_defaults(func=scan)
+
+    p = sub.add_parser('ingest', help='Adds new files to the database.')
+    p.add_argument('--rhythmbox', nargs='?', const=RB_DIR, metavar='RB_DIR',
+        help=f"merge the Rhythmbox library instead (default dir: {RB_DIR})")
+    p.add_argument('--dry-run', action='store_true', help="show what would change")
+    p.set_defaults(func=ingest)
+
+    p = sub.add_parser('sort', help=sort.__doc__.strip())
+    p.add_argument('--playlist', help="only sort this playlist")
+    p.add_argument('--by', default='artist_nm',
+        choices=['artist_nm', 'song_nm', 'album_nm', 'genre_nm'])
+    p.add_argument('--dry-run', action='store_true', help="show what would change")
+    p.set_defaults(func=sort)
+
+    p = sub.add_parser('smart', help=smart.__doc__.strip())
+    p.add_argument('playlist', nargs='?', help="smart playlist to show")
+    p.set_defaults(func=smart)
+
+    p = sub.add_parser('export', help=export.__doc__.strip())
+    p.add_argument('--out',
+        help="output directory (default: snapshot/, or playlists/ for playlist formats)")
+    p.add_argument('--format', default='arrow',
+        choices=['arrow', 'parquet', 'm3u8', 'xspf', 'rhythmbox'])
+    p.add_argument('--player-music-dir',
+        help="music directory as the new player sees it (default: --music-dir)")
+    p.set_defaults(func=export)
+
+    p = sub.add_parser('artwork', help=artwork.__doc__.strip())
+    p.add_argument('--cache-dir', default=ARTWORK_DIR)
+    p.add_argument('--refresh', action='store_true', help="re-read songs already checked")
+    p.set_defaults(func=artwork)
+
+    p = sub.add_parser('check', help='Checks that every file in the database is on disk and unchanged.')
+    p.add_argument('--reread', action='store_true',
+        help="re-read the metadata of changed files to show what changed")
+    p.add_argument('--report', metavar='PATH', help="write the full report to PATH as JSON")
+    p.add_argument('--workers', type=int, default=32)
+    p.set_defaults(func=check)
+
+    p = sub.add_parser('dedupe', help=dedupe.__doc__.strip())
+    p.add_argument('table', choices=['artists', 'genres', 'albums'])
+    p.add_argument('--min-score', type=float, default=0.85,
+        help="similarity needed to call two names duplicates (default: %(default)s)")
+    p.add_argument('--apply', action='store_true', help="merge every cluster into its canonical name")
+    p.set_defaults(func=dedupe)
+
+    p = sub.add_parser('replicate', help=replicate.__doc__.strip())
+    p.add_argument('--path', default=REPLICA_PATH, help="replica file (default: %(default)s)")
+    p.add_argument('--full', action='store_true', help="copy everything, not just what changed")
+    p.add_argument('--prune', action='store_true',
+        help="delete applied changes from the log (only with a single replica)")
+    p.set_defaults(func=replicate)
+
+    p = sub.add_parser('serve', help=serve.__doc__.strip())
+    p.add_argument('--limit', type=int, default=50)
+    p.add_argument('--replica', nargs='?', const=REPLICA_PATH, metavar='PATH',
+        help=f"read from the local replica instead of Postgres (default path: {REPLICA_PATH})")
+    p.add_argument('--artwork-dir', default=ARTWORK_DIR)
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=8050)
+    p.add_argument('--debug', action='store_true')
+    p.set_defaults(func=serve)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    config, music_dir = load_config(args.config)
+    args.music_dir = args.music_dir or music_dir or MUSIC_DIR
+    if not args.music_dir.endswith('/'):
+        args.music_dir += '/'
+    if (args.command == 'ingest') and (args.rhythmbox is not None) and not args.rhythmbox.endswith('/'):
+        args.rhythmbox += '/'
+    return args.func(args, config)
+
+if __name__ == '__main__':
+    sys.exit(main())
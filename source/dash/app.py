@@ -3,46 +3,36 @@ sys.path.insert(0, '..')
 import json
 import pandas as pd
 import flask
+import psycopg2
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
+from dash.dependencies import Input, Output
 from urllib.parse import quote, unquote
 from util import (
-    psql_to_df,
+    get_playlist_tracks,
+    use_replica,
 )
+from similar import SimilarSongs
+from plays import (
+    PlayBuffer,
+    create_play_tables,
+)
+import artwork
 MUSIC_DIR = '/media/ecotner/HDD/Users/27182_000/Music/Saved/'
 
-def get_song_data(dbconfig, limit=10):
-    # query data from postgres
-    query = f"""
-    select
-        songs.song_nm
-        ,artists.artist_nm
-        ,albums.album_nm
-        ,genres.genre_nm
-        ,song_files.file_nm
-    from songs
-        ,artists
-        ,albums
-        ,genres
-        ,song_files
-        ,playlists
-        ,playlist_songs
-    where 1=1
-        -- Filters
-        and playlists.playlist_nm = 'Favorites'
-        -- Join tables
-        and playlists.playlist_id = playlist_songs.playlist_id
-        and playlist_songs.song_id = songs.song_id
-        and songs.artist_id = artists.artist_id
-        and songs.album_id = albums.album_id
-        and songs.genre_id = genres.genre_id
-        and songs.song_id = song_files.song_id
-    order by artists.artist_nm asc
-    limit {limit}
-    """
-    df = psql_to_df(query, dbconfig)
+def get_song_data(dbconfig, limit=10, replica=False):
+    # query data from the denormalized `playlist_tracks` view
+    df = get_playlist_tracks(
+        dbconfig,
+        playlist_nm='Favorites',
+        order_by='artist_nm',
+        limit=limit,
+        cache=True,
+        replica=replica
+    )
+    df = df[['song_id','song_nm','artist_nm','album_nm','genre_nm','file_nm']]
     return df
 
 def generate_table(df, max_rows=10):
@@ -58,23 +48,33 @@ def generate_table(df, max_rows=10):
     )
     return tab
 
-def generate_audio_table(df, max_rows=10):
-    cols = df.columns.tolist()
-    cols.remove('file_nm')
+def generate_audio_table(df, max_rows=10, show_artwork=False):
+    cols = [col for col in df.columns if col not in ['song_id','file_nm']]
     # Header
-    header = html.Tr([html.Th(col) for col in cols]+[html.Th('player')])
+    header = html.Tr(
+        ([html.Th('art')] if show_artwork else []) +
+        [html.Th(col) for col in cols]+[html.Th('player')]
+    )
 
     # Body
     body = list()
     for i in range(min(max_rows, len(df))):
         row = [html.Td(df.iloc[i][col]) for col in cols]
+        if show_artwork:
+            row.insert(0, html.Td(html.Img(
+                src=f"/art/{df.iloc[i]['song_id']}",
+                width=64,
+                height=64,
+            )))
         row.append(html.Td(
             html.Audio(
                 autoPlay=False,
                 loop=False,
                 preload='none',
                 controls=True,
-                src='/music/'+quote(df.iloc[i]['file_nm'])
+                src='/music/'+quote(df.iloc[i]['file_nm']),
+                # Read by assets/plays.js to report plays
+                **{'data-song-id': str(df.iloc[i]['song_id'])}
             )
         ))
         body.append(html.Tr(row))
@@ -103,7 +103,26 @@ def generate_data_table(df, max_rows=10):
     )
     return tab
 
-def build_app(df, limit=10):
+def generate_similar_panel(df, similar, playlist_nm='Favorites'):
+    options = [
+        {'label': f"{row.artist_nm} - {row.song_nm}", 'value': int(row.song_id)}
+        for row in df.drop_duplicates('song_id').itertuples()
+    ]
+    panel = html.Div(children=[
+        html.H2('Similar songs', style={'textAlign': 'center'}),
+        dcc.Dropdown(id='similar-song', options=options, placeholder='Pick a song...'),
+        html.Div(id='similar-table'),
+        html.H3(f'Suggestions for {playlist_nm}'),
+    ])
+    try:
+        ext_df = similar.extend_playlist(playlist_nm, n=10)
+        ext_df['score'] = ext_df.score.round(3)
+        panel.children.append(generate_table(ext_df[['song_nm','artist_nm','score']], max_rows=10))
+    except KeyError:
+        panel.children.append(html.P(f'There is no {playlist_nm} playlist.'))
+    return panel
+
+def build_app(df, limit=10, similar=None, play_buffer=None, artwork_dir=None, dbconfig=None, replica=False):
     external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
     app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
     server = app.server
@@ -115,10 +134,60 @@ def build_app(df, limit=10):
             filename=file_nm
         )
 
-    app.layout = html.Div(children=[
+    if artwork_dir is not None:
+        @server.route('/art/<int:song_id>')
+        def serve_artwork(song_id):
+            # Browsers revalidate on every view and get a 304 while the art is
+            # unchanged; the ETag follows the cached file, so new art from
+            # `music artwork --refresh` shows up straight away
+            try:
+                path = artwork.get_artwork(song_id, dbconfig, MUSIC_DIR, artwork_dir, replica=replica)
+            except (KeyError, psycopg2.OperationalError):
+                # No song file, or not extracted yet and Postgres is unreachable
+                path = None
+            if path is None:
+                response = flask.Response(artwork.PLACEHOLDER_SVG, mimetype='image/svg+xml')
+                response.set_etag('placeholder')
+                response.make_conditional(flask.request)
+            else:
+                response = flask.send_file(path, conditional=True)
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            return response
+
+    if play_buffer is not None:
+        @server.route('/plays', methods=['POST'])
+        def record_play():
+            # Only queues the event; `play_buffer` writes to the database in batches
+            event = flask.request.get_json(force=True, silent=True) or dict()
+            try:
+                play_buffer.record(
+                    event['song_id'],
+                    event.get('event', 'play'),
+                    position=event.get('position')
+                )
+            except (KeyError, TypeError, ValueError):
+                return ('', 400)
+            return ('', 204)
+
+    children = [
         html.H1('Songs', style={'textAlign': 'center'}),
-        generate_audio_table(df, limit)
-    ])
+        generate_audio_table(df, limit, show_artwork=(artwork_dir is not None))
+    ]
+    if similar is not None:
+        children.append(generate_similar_panel(df, similar))
+
+        @app.callback(Output('similar-table', 'children'), [Input('similar-song', 'value')])
+        def show_similar(song_id):
+            if song_id is None:
+                return None
+            try:
+                sim_df = similar.similar_songs(song_id, k=10)
+            except KeyError:
+                return html.P('This song is not in any playlist yet.')
+            sim_df['score'] = sim_df.score.round(3)
+            return generate_table(sim_df[['song_nm','artist_nm','score']], max_rows=10)
+    app.layout = html.Div(children=children)
     return app
 
 if __name__ == '__main__':
@@ -131,7 +200,14 @@ if __name__ == '__main__':
     limit = 50
     df = get_song_data(config, limit)
 
-    # Build app
-    app = build_app(df, limit=limit)
+    # Build app, with the playlist co-occurrence index for the similar songs panel
+    similar = SimilarSongs.from_database(config)
+    artwork.create_artwork_table(config)
+    create_play_tables(config)
+    play_buffer = PlayBuffer(config)
+    app = build_app(
+        df, limit=limit, similar=similar, play_buffer=play_buffer,
+        artwork_dir='../../artwork/', dbconfig=config
+    )
     app.run_server(debug=True)
 
@@ -0,0 +1,36 @@
+// Reports plays from the song table's <audio> players to the /plays
+// endpoint. Media events don't bubble, so they're caught in the capture
+// phase; sendBeacon doesn't hold up the page (or get cancelled on unload).
+(function () {
+    function report(event, audio) {
+        var songId = audio.getAttribute('data-song-id');
+        if (!songId) {
+            return;
+        }
+        var body = JSON.stringify({
+            song_id: Number(songId),
+            event: event,
+            position: audio.currentTime
+        });
+        var blob = new Blob([body], {type: 'application/json'});
+        if (!(navigator.sendBeacon && navigator.sendBeacon('/plays', blob))) {
+            fetch('/plays', {
+                method: 'POST',
+                body: body,
+                headers: {'Content-Type': 'application/json'},
+                keepalive: true
+            });
+        }
+    }
+    // Only count a play when it starts from the beginning, not on resume
+    document.addEventListener('play', function (e) {
+        if ((e.target.tagName === 'AUDIO') && (e.target.currentTime < 1)) {
+            report('play', e.target);
+        }
+    }, true);
+    document.addEventListener('ended', function (e) {
+        if (e.target.tagName === 'AUDIO') {
+            report('finish', e.target);
+        }
+    }, true);
+})();
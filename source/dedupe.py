@@ -0,0 +1,287 @@
+import re
+import numpy as np
+import pandas as pd
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+    _refresh_playlist_tracks,
+)
+from song_matching import (
+    normalize_name,
+    _similarity,
+)
+
+# Tables with names to deduplicate. Albums are only compared with albums of
+# the same artist, since different artists' albums often share a name.
+NAME_TABLES = dict(
+    artists=('artist_id', 'artist_nm', None),
+    genres=('genre_id', 'genre_nm', None),
+    albums=('album_id', 'album_nm', 'artist_id'),
+)
+# Character n-grams names are blocked on
+NGRAM = 3
+# N-grams shared by more names than this (' th', 'the'...) don't block
+MAX_BLOCK = 200
+# Dice coefficient of the n-gram sets below which a pair isn't scored
+MIN_DICE = 0.4
+
+##############################################################################
+##                              Clustering                                  ##
+##############################################################################
+
+def _ngrams(key, n=NGRAM):
+    padded = f' {key} '
+    return {padded[i:i+n] for i in range(max(len(padded) - n + 1, 1))}
+
+def _candidate_pairs(df, n=NGRAM, max_block=MAX_BLOCK, min_dice=MIN_DICE):
+    """
+    Blocking: pairs of names (within a group) that share enough n-grams,
+    found by joining on the n-grams instead of comparing every pair. Names
+    whose keys are identical are always paired. Returns (id_a, id_b) rows.
+    """
+    ids = df.id.to_numpy()
+    grams = pd.DataFrame(
+        [
+            (pos, f'{g}|{gram}')
+            for pos, (g, key) in enumerate(zip(df.group, df.key))
+            for gram in _ngrams(key, n)
+        ],
+        columns=['pos','gram']
+    )
+    n_grams = np.bincount(grams.pos, minlength=len(df))
+    grams['code'] = pd.factorize(grams.gram)[0]
+    sizes = np.bincount(grams.code)[grams.code]
+    grams = grams[(sizes > 1) & (sizes <= max_block)][['pos','code']]
+    pairs = pd.merge(grams, grams, on='code', suffixes=('_a','_b'))
+    pairs = pairs[pairs.pos_a < pairs.pos_b]
+    # Shared n-grams per pair, counted on the pairs packed into one integer
+    packed, shared = np.unique(
+        pairs.pos_a.to_numpy(np.int64)*len(df) + pairs.pos_b.to_numpy(np.int64),
+        return_counts=True
+    )
+    pos_a, pos_b = np.divmod(packed, len(df))
+    keep = 2*shared >= min_dice*(n_grams[pos_a] + n_grams[pos_b])
+    fuzzy = pd.DataFrame(dict(id_a=ids[pos_a[keep]], id_b=ids[pos_b[keep]]))
+
+    # Identical keys, chained to the first name with that key
+    first = df.groupby(['group','key']).id.transform('min')
+    exact = pd.DataFrame(dict(id_a=first.to_numpy(), id_b=ids))
+    exact = exact[exact.id_a != exact.id_b]
+    return pd.concat([fuzzy, exact]).drop_duplicates()
+
+def _components(ids, pairs):
+    """ Connected components of the pairs (union-find): id -> root id. """
+    parent = {i: i for i in ids}
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for a, b in pairs:
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return {i: find(i) for i in ids}
+
+def cluster_names(df, min_score=0.85):
+    """
+    Clusters near-duplicate names. `df` has `id`, `nm` and `songs` columns
+    (and `group`, if names should only be compared within groups). Pairs
+    found by n-gram blocking are scored by the similarity of their
+    normalized names (see `song_matching.normalize_name`); names with
+    different numbers in them ('Vol. 1' and 'Vol. 2') never match. Pairs
+    scoring at least `min_score` are joined into clusters, and each cluster's
+    name with the most songs (then the lowest id) is proposed as canonical.
+    Returns one row per name in a cluster of two or more.
+    """
+    df = df.copy()
+    if 'group' not in df.columns:
+        df['group'] = 0
+    df['key'] = df.nm.fillna('').map(normalize_name)
+    keys = dict(zip(df.id, df.key))
+    pairs = list()
+    for a, b in _candidate_pairs(df).itertuples(index=False):
+        ka, kb = keys[a], keys[b]
+        if re.findall(r'\d+', ka) != re.findall(r'\d+', kb):
+            continue
+        if _similarity(ka, kb) >= min_score:
+            pairs.append((a, b))
+    df['cluster'] = df.id.map(_components(df.id, pairs))
+    df = df[df.groupby('cluster').id.transform('size') > 1]
+    df = df.sort_values(['cluster','songs','id'], ascending=[True,False,True])
+    canonical = df.drop_duplicates('cluster').set_index('cluster')
+    df['canonical_id'] = df.cluster.map(canonical.id)
+    df['canonical_nm'] = df.cluster.map(canonical.nm)
+    df['score'] = [
+        round(_similarity(k, keys[c]), 4) for k, c in zip(df.key, df.canonical_id)
+    ]
+    return df[['cluster','id','nm','songs','canonical_id','canonical_nm','score']].reset_index(drop=True)
+
+def find_duplicates(table, config, min_score=0.85):
+    """
+    Proposed merges for the `artists`, `genres` or `albums` table: one row
+    per near-duplicate name, with the name it would be merged into
+    (`canonical_id`, which maps to itself). Filter the rows before passing
+    them to `merge_names` to accept only some of them.
+    """
+    if table not in NAME_TABLES:
+        raise ValueError(f"table must be one of {list(NAME_TABLES)}, not {table}")
+    id_col, nm_col, group_col = NAME_TABLES[table]
+    group = '' if group_col is None else f',{table}.{group_col} as "group"'
+    query = f"""
+    select
+        {table}.{id_col} as id
+        ,{table}.{nm_col} as nm
+        {group}
+        ,count(songs.song_id) as songs
+    from {table}
+        left join songs on songs.{id_col} = {table}.{id_col}
+    group by 1, 2{'' if group_col is None else ', 3'}
+    """
+    df = psql_to_df(query, config, cache=False)
+    return cluster_names(df, min_score)
+
+##############################################################################
+##                                Merging                                   ##
+##############################################################################
+
+def _resolve(merges):
+    """
+    {old_id: new_id} pairs, from a dict or a `find_duplicates` frame, with
+    chains (a -> b -> c) followed to the end and self-merges dropped.
+    """
+    if isinstance(merges, pd.DataFrame):
+        merges = dict(zip(merges.id, merges.canonical_id))
+    merges = {int(old): int(new) for old, new in merges.items()}
+    resolved = dict()
+    for old in merges:
+        new, seen = merges[old], {old}
+        while new in merges and merges[new] != new:
+            if new in seen:
+                raise ValueError(f"merges of {sorted(seen)} form a cycle")
+            seen.add(new)
+            new = merges[new]
+        if new != old:
+            resolved[old] = new
+    return resolved
+
+def _merge_albums(cur):
+    """
+    Moves songs from the albums in `album_merges` to the albums they're
+    merged into, then deletes them. Returns (songs moved, albums deleted).
+    """
+    cur.execute("""
+    update songs
+    set album_id = album_merges.new_id
+    from album_merges
+    where songs.album_id = album_merges.old_id;
+    """)
+    n_songs = cur.rowcount
+    cur.execute("delete from albums using album_merges where albums.album_id = album_merges.old_id;")
+    return n_songs, cur.rowcount
+
+def merge_names(table, merges, config, refresh_view=True):
+    """
+    Merges artists, genres or albums: each `old_id` in `merges` ({old_id:
+    new_id}, or the rows of `find_duplicates` to accept) is replaced by its
+    `new_id` everywhere it's referenced, and then deleted. Every step is a
+    set-based statement over all the merges at once, and everything happens
+    in one transaction (refreshing `playlist_tracks` too). When artists are
+    merged, their albums with the same name are merged as well. Returns the
+    number of rows changed per table.
+    """
+    if table not in NAME_TABLES:
+        raise ValueError(f"table must be one of {list(NAME_TABLES)}, not {table}")
+    merges = _resolve(merges)
+    if len(merges) == 0:
+        return dict()
+    id_col, nm_col, _ = NAME_TABLES[table]
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute("""
+    create temp table name_merges(
+        old_id integer primary key,
+        new_id integer not null
+    ) on commit drop;
+    """)
+    execute_values(cur, "insert into name_merges (old_id, new_id) values %s", list(merges.items()))
+    cur.execute(f"""
+    select count(*) from {table}
+    where {id_col} in (select old_id from name_merges union select new_id from name_merges)
+    """)
+    if cur.fetchone()[0] != len(set(merges) | set(merges.values())):
+        conn.rollback()
+        cur.close()
+        conn.close()
+        raise KeyError(f"some of the {table} to merge don't exist")
+
+    counts = dict()
+    if table == 'albums':
+        cur.execute("create temp table album_merges on commit drop as select * from name_merges;")
+        counts['songs'], counts['albums'] = _merge_albums(cur)
+    elif table == 'genres':
+        cur.execute("""
+        update songs
+        set genre_id = name_merges.new_id
+        from name_merges
+        where songs.genre_id = name_merges.old_id;
+        """)
+        counts['songs'] = cur.rowcount
+        cur.execute("delete from genres using name_merges where genres.genre_id = name_merges.old_id;")
+        counts['genres'] = cur.rowcount
+    else:
+        # Albums that end up with the same artist and name are merged into
+        # the one that already belonged to the surviving artist (or the first)
+        cur.execute("""
+        create temp table album_merges on commit drop as
+        select old_id, new_id
+        from (
+            select
+                albums.album_id as old_id
+                ,first_value(albums.album_id) over (
+                    partition by coalesce(name_merges.new_id, albums.artist_id), lower(albums.album_nm)
+                    order by (name_merges.old_id is not null), albums.album_id
+                ) as new_id
+            from albums
+                left join name_merges on name_merges.old_id = albums.artist_id
+            where albums.artist_id in (select old_id from name_merges union select new_id from name_merges)
+        ) a
+        where old_id != new_id;
+        """)
+        _, counts['albums_merged'] = _merge_albums(cur)
+        cur.execute("""
+        update songs
+        set artist_id = name_merges.new_id
+        from name_merges
+        where songs.artist_id = name_merges.old_id;
+        """)
+        counts['songs'] = cur.rowcount
+        cur.execute("""
+        update albums
+        set artist_id = name_merges.new_id
+        from name_merges
+        where albums.artist_id = name_merges.old_id;
+        """)
+        counts['albums_moved'] = cur.rowcount
+        cur.execute("select to_regclass('artist_play_counts') is not null")
+        if cur.fetchone()[0]:
+            # Play counts are added up, before the old artists' rows cascade away
+            cur.execute("""
+            insert into artist_play_counts (artist_id, play_count, last_played)
+            select name_merges.new_id, sum(artist_play_counts.play_count), max(artist_play_counts.last_played)
+            from artist_play_counts
+                join name_merges on name_merges.old_id = artist_play_counts.artist_id
+            group by name_merges.new_id
+            on conflict (artist_id) do update set
+                play_count = artist_play_counts.play_count + excluded.play_count
+                ,last_played = greatest(artist_play_counts.last_played, excluded.last_played);
+            """)
+        cur.execute("delete from artists using name_merges where artists.artist_id = name_merges.old_id;")
+        counts['artists'] = cur.rowcount
+    if refresh_view:
+        _refresh_playlist_tracks(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return counts
@@ -0,0 +1,261 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+    list_music_files,
+    _refresh_playlist_tracks,
+)
+
+# Number of bytes hashed from the start and end of each file for the quick
+# fingerprint. Tags usually live in the first block and the tail of the audio
+# stream is effectively unique per file.
+BLOCK_SIZE = 64 * 1024
+
+##############################################################################
+##                            Fingerprint index                             ##
+##############################################################################
+
+def create_fingerprint_table(config):
+    """
+    Creates the `song_fingerprints` table, which sits alongside `song_files`
+    and holds a content fingerprint for every known file.
+    """
+    query = """
+    create table if not exists song_fingerprints(
+        file_nm varchar not null,
+        song_id integer,
+        file_size bigint not null,
+        mtime double precision not null,
+        quick_hash char(32) not null,
+        full_hash char(64),
+        primary key (file_nm),
+        foreign key (song_id) references songs (song_id) on delete set null
+    );
+    create index if not exists song_fingerprints_hash
+        on song_fingerprints (file_size, quick_hash);
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def quick_fingerprint(path, block_size=BLOCK_SIZE):
+    """
+    Hashes the file size together with the leading and trailing blocks of the
+    file. Cheap enough to run on every file, but only reads 2*block_size bytes.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(size).encode())
+    with open(path, 'rb') as fp:
+        h.update(fp.read(block_size))
+        if size > 2*block_size:
+            fp.seek(-block_size, os.SEEK_END)
+            h.update(fp.read(block_size))
+        elif size > block_size:
+            h.update(fp.read())
+    return size, h.hexdigest()
+
+def full_hash(path, chunk_size=1024*1024):
+    """ Computes the SHA-256 of the whole file. """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def full_hashes(file_nms, music_dir, workers=8):
+    """
+    Computes full hashes for many files in parallel. Returns a dictionary
+    mapping file name to hash.
+    """
+    file_nms = list(file_nms)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(lambda f: full_hash(music_dir+f), file_nms)
+        return dict(zip(file_nms, hashes))
+
+def load_fingerprints(config):
+    """ Pulls the whole fingerprint index into a dataframe. """
+    query = """
+    select
+        file_nm
+        ,song_id
+        ,file_size
+        ,mtime
+        ,quick_hash
+        ,full_hash
+    from song_fingerprints
+    """
+    df = psql_to_df(query, config)
+    # Nullable columns come back as NaN; use None so rows can be re-saved
+    df = df.astype(object).where(df.notna(), None)
+    return df
+
+def save_fingerprints(rows, config):
+    """
+    Upserts fingerprint rows (dicts with the `song_fingerprints` columns) in a
+    single batched statement.
+    """
+    if len(rows) == 0:
+        return None
+    cols = ['file_nm','song_id','file_size','mtime','quick_hash','full_hash']
+    query = f"""
+    insert into song_fingerprints ({','.join(cols)})
+    values %s
+    on conflict (file_nm) do update set
+        song_id = excluded.song_id,
+        file_size = excluded.file_size,
+        mtime = excluded.mtime,
+        quick_hash = excluded.quick_hash,
+        full_hash = coalesce(excluded.full_hash, song_fingerprints.full_hash);
+    """
+    values = [tuple(row.get(c) for c in cols) for row in rows]
+    conn = connect(config)
+    cur = conn.cursor()
+    execute_values(cur, query, values)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+##############################################################################
+##                               Scanning                                   ##
+##############################################################################
+
+def scan_music_dir(music_dir, config, use_full_hash=False, workers=8):
+    """
+    Scans the music directory against the fingerprint index. Files whose size
+    and mtime haven't changed reuse their stored fingerprint, so unchanged
+    files are never reread. Returns a dictionary with:
+        new_files: files that aren't in the database under any name
+        renamed: (old_file_nm, new_file_nm, song_id) for files that moved
+        duplicates: lists of local files with identical content
+        fingerprints: the updated fingerprint rows (not yet saved)
+    If `use_full_hash` is set, candidate renames/duplicates are confirmed with
+    a full-content hash computed in parallel.
+    """
+    db_fp = load_fingerprints(config)
+    db_fp = {row['file_nm']: row for row in db_fp.to_dict('records')}
+    query = "select song_id, file_nm from song_files"
+    db_files = psql_to_df(query, config)
+    db_files = dict(zip(db_files.file_nm, db_files.song_id))
+    local_files = list_music_files(music_dir)
+
+    # Fingerprint every local file, reusing the index when stat says unchanged
+    def fingerprint(file_nm):
+        st = os.stat(music_dir+file_nm)
+        row = db_fp.get(file_nm)
+        if (row is not None) and (row['file_size'] == st.st_size) and (row['mtime'] == st.st_mtime):
+            row = dict(row)
+            row['song_id'] = db_files.get(file_nm)
+            return row
+        size, qhash = quick_fingerprint(music_dir+file_nm)
+        return dict(
+            file_nm=file_nm,
+            song_id=db_files.get(file_nm),
+            file_size=size,
+            mtime=st.st_mtime,
+            quick_hash=qhash,
+            full_hash=None,
+        )
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        local_fp = list(pool.map(fingerprint, sorted(local_files)))
+    local_fp = {row['file_nm']: row for row in local_fp}
+
+    # Group local files by content key to find duplicates
+    groups = dict()
+    for row in local_fp.values():
+        groups.setdefault((row['file_size'], row['quick_hash']), []).append(row['file_nm'])
+    # Index fingerprints of files that disappeared from disk, by content key
+    missing = dict()
+    for file_nm, row in db_fp.items():
+        if (file_nm not in local_fp) and (row['song_id'] is not None):
+            missing.setdefault((row['file_size'], row['quick_hash']), []).append(row)
+
+    # Confirm candidates with a full hash if requested
+    if use_full_hash:
+        candidates = {
+            f for fs in groups.values() if len(fs) > 1 for f in fs
+            if local_fp[f]['full_hash'] is None
+        }
+        candidates |= {
+            row['file_nm'] for row in local_fp.values()
+            if (row['file_nm'] not in db_files) and (row['full_hash'] is None)
+            and ((row['file_size'], row['quick_hash']) in missing)
+        }
+        for file_nm, h in full_hashes(candidates, music_dir, workers).items():
+            local_fp[file_nm]['full_hash'] = h
+        groups = dict()
+        for row in local_fp.values():
+            key = (row['file_size'], row['quick_hash'], row['full_hash'])
+            groups.setdefault(key, []).append(row['file_nm'])
+
+    duplicates = [sorted(fs) for fs in groups.values() if len(fs) > 1]
+    renamed = list()
+    new_files = list()
+    for file_nm in sorted(set(local_fp) - set(db_files)):
+        row = local_fp[file_nm]
+        matches = missing.get((row['file_size'], row['quick_hash']), [])
+        if use_full_hash:
+            matches = [
+                m for m in matches
+                if (m['full_hash'] is None) or (m['full_hash'] == row['full_hash'])
+            ]
+        if len(matches) > 0:
+            old = matches.pop(0)
+            renamed.append((old['file_nm'], file_nm, int(old['song_id'])))
+            row['song_id'] = int(old['song_id'])
+        else:
+            new_files.append(file_nm)
+
+    return dict(
+        new_files=new_files,
+        renamed=renamed,
+        duplicates=duplicates,
+        fingerprints=list(local_fp.values()),
+    )
+
+def apply_renames(renamed, config):
+    """
+    Points the `song_files` and `song_fingerprints` rows of renamed files at
+    their new file names, keeping the original `song_id`, and refreshes
+    `playlist_tracks` in the same transaction so the player gets the new names.
+    """
+    if len(renamed) == 0:
+        return None
+    conn = connect(config)
+    cur = conn.cursor()
+    query = """
+    update song_files
+    set file_nm = v.new_file_nm
+    from (values %s) v (old_file_nm, new_file_nm, song_id)
+    where song_files.file_nm = v.old_file_nm
+        and song_files.song_id = v.song_id;
+    """
+    execute_values(cur, query, renamed)
+    query = """
+    delete from song_fingerprints
+    where file_nm in (select v.old_file_nm from (values %s) v (old_file_nm));
+    """
+    execute_values(cur, query, [(old,) for old, _, _ in renamed])
+    _refresh_playlist_tracks(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def update_fingerprint_index(music_dir, config, use_full_hash=False, workers=8):
+    """
+    Runs a scan, applies detected renames and saves the refreshed fingerprint
+    index. Returns the scan result so new files/duplicates can be reported.
+    """
+    result = scan_music_dir(music_dir, config, use_full_hash, workers)
+    apply_renames(result['renamed'], config)
+    save_fingerprints(result['fingerprints'], config)
+    return result
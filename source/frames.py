@@ -0,0 +1,123 @@
+import pandas as pd
+
+# Declared column types for frames built from XML/API records. Numeric values
+# arrive as strings and are parsed; missing values stay missing (nullable
+# dtypes) rather than being zero-filled. Names that repeat a lot (artists,
+# albums, genres, playlists) are categoricals.
+RHYTHMDB_SCHEMA = {
+    'title': 'string',
+    'genre': 'category',
+    'artist': 'category',
+    'album': 'category',
+    'duration': 'Int64',
+    'file-size': 'Int64',
+    'location': 'string',
+    'mountpoint': 'category',
+    'mtime': 'Int64',
+    'first-seen': 'Int64',
+    'last-seen': 'Int64',
+    'bitrate': 'Int64',
+    'date': 'Int64',
+    'media-type': 'category',
+    'composer': 'category',
+    'track-number': 'Int64',
+    'comment': 'string',
+    'album-artist': 'category',
+    'play-count': 'Int64',
+    'last-played': 'Int64',
+    'track-total': 'Int64',
+    'beats-per-minute': 'Float64',
+    'disc-number': 'Int64',
+    'disc-total': 'Int64',
+    'mb-artistsortname': 'category',
+    'mb-trackid': 'string',
+    'mb-artistid': 'category',
+    'mb-albumid': 'category',
+    'mb-albumartistid': 'category',
+    'rating': 'Int64',
+    'album-sortname': 'category',
+}
+
+PLAYLIST_SCHEMA = {
+    'name': 'category',
+    'show-browser': 'category',
+    'browser-position': 'Int64',
+    'search-type': 'category',
+    'type': 'category',
+    'location': 'string',
+}
+
+# Google Music library tracks and playlist entries, as fetched page by page
+GOOGLE_SONG_SCHEMA = {
+    'song_id': 'string',
+    'title': 'string',
+    'artist': 'category',
+    'album': 'category',
+}
+
+GOOGLE_ENTRY_SCHEMA = {
+    'playlist_id': 'category',
+    'song_id': 'string',
+    'pl_entry_id': 'string',
+    # Zero-padded digits, so they sort as strings
+    'position': 'string',
+}
+
+NUMERIC_DTYPES = ['Int8', 'Int16', 'Int32', 'Int64', 'Float32', 'Float64', 'int64', 'float64']
+
+def build_frame(records, schema):
+    """
+    Builds a dataframe from a list of records (dicts or sequences in schema
+    order) and applies the declared `schema` (column -> dtype) one column at a
+    time with vectorized conversions. Columns missing from every record are
+    created empty; columns not in the schema are dropped.
+    """
+    columns = list(schema)
+    if (len(records) > 0) and isinstance(records[0], dict):
+        df = pd.DataFrame.from_records(records, columns=columns)
+    else:
+        df = pd.DataFrame(records, columns=columns)
+    converted = dict()
+    for col, dtype in schema.items():
+        s = df[col]
+        if dtype in NUMERIC_DTYPES:
+            s = pd.to_numeric(s, errors='coerce')
+        converted[col] = s.astype(dtype)
+    return pd.DataFrame(converted, index=df.index)
+
+def concat_frames(frames):
+    """
+    Concatenates frames built with the same schema. Categorical columns are
+    combined with the union of their categories, so they stay categorical
+    (plain `pd.concat` falls back to object columns when categories differ).
+    Chunks whose column is empty or all-null have object categories, so
+    every chunk's categories are cast to those of the first non-empty one.
+    """
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    columns = dict()
+    for col in frames[0].columns:
+        parts = [df[col] for df in frames]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            filled = [p.cat.categories for p in parts if len(p.cat.categories) > 0]
+            if len(filled) > 0:
+                parts = [p.cat.set_categories(p.cat.categories.astype(filled[0].dtype)) for p in parts]
+            columns[col] = pd.Series(pd.api.types.union_categoricals(parts, ignore_order=True))
+        else:
+            columns[col] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def memory_report(df):
+    """
+    Reports the (deep) memory used by each column of a frame, largest first,
+    with a total row at the bottom.
+    """
+    usage = df.memory_usage(index=False, deep=True)
+    report = pd.DataFrame({
+        'dtype': df.dtypes.astype(str),
+        'bytes': usage,
+    }).sort_values('bytes', ascending=False)
+    report.loc['total'] = ['', usage.sum()]
+    report['mb'] = report.bytes / 2**20
+    return report
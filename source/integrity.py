@@ -0,0 +1,128 @@
+import os
+import json
+import tempfile
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from util import (
+    psql_to_df,
+    list_music_files,
+    get_song_metadata,
+)
+
+# Stored durations are rounded to the second, so allow for that
+DURATION_TOLERANCE = 1
+
+def _kbps(bitrate):
+    """ Bitrate in kbps; Rhythmbox stores kbps but mutagen reports bps. """
+    return bitrate // 1000 if bitrate >= 10000 else bitrate
+
+##############################################################################
+##                                Checking                                  ##
+##############################################################################
+
+def _stat(path):
+    """ (size, error) of a file; error is 'missing' or the OSError text. """
+    try:
+        return os.stat(path).st_size, None
+    except FileNotFoundError:
+        return None, 'missing'
+    except OSError as e:
+        return None, str(e)
+
+def _reread(file_nm, music_dir):
+    """ Current duration/bitrate/size of a file, or an error. """
+    import mutagen
+    try:
+        mdata = get_song_metadata(file_nm, music_dir)
+    except (OSError, mutagen.MutagenError) as e:
+        return dict(error=str(e) or type(e).__name__)
+    return {k: mdata.get(k) for k in ['duration', 'bitrate', 'file_size']}
+
+def check_library(config, music_dir, reread=False, workers=32):
+    """
+    Checks every file referenced by `song_files` against the disk. Files are
+    stat'ed in a thread pool, since on a slow or network mount the time is
+    all spent waiting on I/O. Returns a report dictionary with:
+        missing: referenced files that aren't on disk
+        changed: files whose size no longer matches `song_files.file_size`;
+            with `reread`, their metadata (and that of files with no stored
+            size) is read again and every stored field that differs is
+            listed as [stored, actual]
+        orphaned: music files on disk that no song references
+        errors: files that couldn't be checked (permissions, I/O errors)
+        summary: the count of each, and of files checked
+    """
+    query = """
+    select song_id, file_nm, file_size, duration, bitrate
+    from song_files
+    order by file_nm
+    """
+    db_df = psql_to_df(query, config, cache=False)
+    rows = db_df.astype(object).where(db_df.notna(), None).to_dict('records')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # The directory listing runs alongside the stats
+        listing = pool.submit(list_music_files, music_dir)
+        stats = list(pool.map(lambda row: _stat(music_dir+row['file_nm']), rows))
+        orphaned = sorted(listing.result() - set(db_df.file_nm))
+
+        missing, changed, unknown, errors = list(), list(), list(), list()
+        for row, (size, error) in zip(rows, stats):
+            entry = dict(song_id=int(row['song_id']), file_nm=row['file_nm'])
+            if error == 'missing':
+                missing.append(entry)
+            elif error is not None:
+                errors.append(dict(entry, error=error))
+            elif row['file_size'] is None:
+                unknown.append(dict(entry, fields=dict()))
+            elif size != row['file_size']:
+                changed.append(dict(entry, fields=dict(file_size=[int(row['file_size']), size])))
+
+        if reread:
+            # Files with no stored size can only be checked by reading them
+            by_file = {row['file_nm']: row for row in rows}
+            to_read = changed + unknown
+            current = pool.map(lambda entry: _reread(entry['file_nm'], music_dir), to_read)
+            for entry, mdata in zip(to_read, current):
+                if 'error' in mdata:
+                    entry['error'] = mdata['error']
+                    continue
+                stored = by_file[entry['file_nm']]
+                for field in ['duration', 'bitrate']:
+                    old, new = stored[field], mdata[field]
+                    if (old is None) or (new is None):
+                        continue
+                    if (field == 'duration') and (abs(new - old) <= DURATION_TOLERANCE):
+                        continue
+                    if (field == 'bitrate') and (_kbps(new) == _kbps(old)):
+                        continue
+                    if new != old:
+                        entry['fields'][field] = [int(old), int(new)]
+            changed += [entry for entry in unknown if ('error' in entry) or (len(entry['fields']) > 0)]
+
+    return dict(
+        checked_at=datetime.now(timezone.utc).isoformat(),
+        music_dir=music_dir,
+        summary=dict(
+            checked=len(rows),
+            # Files with no stored size whose metadata wasn't reread
+            unverified=0 if reread else len(unknown),
+            missing=len(missing),
+            changed=len(changed),
+            orphaned=len(orphaned),
+            errors=len(errors),
+        ),
+        missing=missing,
+        changed=changed,
+        orphaned=orphaned,
+        errors=errors,
+    )
+
+def write_report(report, path):
+    """ Writes a report from `check_library` as JSON, atomically. """
+    out_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fp:
+        json.dump(report, fp, indent=2)
+    os.replace(tmp_path, path)
+    return path
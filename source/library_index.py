@@ -0,0 +1,222 @@
+import sys
+import numpy as np
+from util import psql_to_df
+
+##############################################################################
+##                              Helpers                                     ##
+##############################################################################
+
+def _csr(rows, cols, n_rows, order=None):
+    """
+    Builds a CSR-style adjacency (indptr, indices) from parallel arrays of
+    row and column positions. Entries within a row follow `order` if given,
+    otherwise their original order.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int32)
+    keys = (rows,) if order is None else (np.asarray(order), rows)
+    perm = np.lexsort(keys)
+    indptr = np.zeros(n_rows+1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+    return indptr, cols[perm]
+
+def _positions(ids, lookup_ids):
+    """
+    Maps IDs to their positions in the sorted array `ids`; IDs that aren't
+    present (or are null) map to -1.
+    """
+    lookup_ids = _floats(lookup_ids)
+    valid = ~np.isnan(lookup_ids)
+    pos = np.full(len(lookup_ids), -1, dtype=np.int32)
+    if len(ids) == 0:
+        return pos
+    idx = np.searchsorted(ids, lookup_ids[valid].astype(np.int64))
+    idx = np.minimum(idx, len(ids)-1)
+    found = ids[idx] == lookup_ids[valid]
+    pos[np.flatnonzero(valid)[found]] = idx[found]
+    return pos
+
+def _floats(values):
+    """ Converts a (possibly nullable) column to floats, with NaN for nulls. """
+    if hasattr(values, 'to_numpy'):
+        return values.to_numpy(dtype=np.float64, na_value=np.nan)
+    return np.asarray(values, dtype=np.float64)
+
+def _intern(names):
+    """ Interns names so repeated strings share one object. """
+    return np.array([None if n is None else sys.intern(str(n)) for n in names], dtype=object)
+
+##############################################################################
+##                              LibraryIndex                                ##
+##############################################################################
+
+class LibraryIndex:
+    """
+    Compact, array-backed copy of the library for fast repeated lookups.
+    Songs, artists, albums, genres and playlists are each stored as a sorted
+    ID array plus parallel columns; songs refer to their artist/album/genre by
+    position. Playlist->song, song->playlist and artist->song adjacency are
+    kept in CSR form, so lookups are O(1) to find a row and O(k) to read its k
+    neighbours, without any joins.
+    """
+
+    def __init__(self, songs, artists, albums, genres, playlists, playlist_songs):
+        # Dimension tables, sorted by ID
+        artists = artists.sort_values('artist_id')
+        self.artist_ids = artists.artist_id.to_numpy(np.int64)
+        self.artist_names = _intern(artists.artist_nm)
+        albums = albums.sort_values('album_id')
+        self.album_ids = albums.album_id.to_numpy(np.int64)
+        self.album_names = _intern(albums.album_nm)
+        genres = genres.sort_values('genre_id')
+        self.genre_ids = genres.genre_id.to_numpy(np.int64)
+        self.genre_names = _intern(genres.genre_nm)
+        playlists = playlists.sort_values('playlist_id')
+        self.playlist_ids = playlists.playlist_id.to_numpy(np.int64)
+        self.playlist_names = _intern(playlists.playlist_nm)
+
+        # Songs, with foreign keys as positions into the dimension arrays
+        songs = songs.sort_values('song_id')
+        self.song_ids = songs.song_id.to_numpy(np.int64)
+        self.song_names = _intern(songs.song_nm)
+        self.song_artist = _positions(self.artist_ids, songs.artist_id)
+        self.song_album = _positions(self.album_ids, songs.album_id)
+        self.song_genre = _positions(self.genre_ids, songs.genre_id)
+
+        # Name lookups (case-insensitive); duplicate names keep every position
+        self._artist_lookup = dict()
+        for i, nm in enumerate(self.artist_names):
+            self._artist_lookup.setdefault(nm.lower(), []).append(i)
+        self._playlist_lookup = {nm: i for i, nm in enumerate(self.playlist_names)}
+
+        # Adjacency
+        pl_pos = _positions(self.playlist_ids, playlist_songs.playlist_id)
+        song_pos = _positions(self.song_ids, playlist_songs.song_id)
+        keep = (pl_pos >= 0) & (song_pos >= 0)
+        pl_pos, song_pos = pl_pos[keep], song_pos[keep]
+        order = _floats(playlist_songs.playlist_order)[keep]
+        self.playlist_indptr, self.playlist_songs = _csr(
+            pl_pos, song_pos, len(self.playlist_ids), order
+        )
+        self.song_pl_indptr, self.song_playlists = _csr(
+            song_pos, pl_pos, len(self.song_ids)
+        )
+        has_artist = self.song_artist >= 0
+        self.artist_indptr, self.artist_songs = _csr(
+            self.song_artist[has_artist],
+            np.flatnonzero(has_artist),
+            len(self.artist_ids),
+        )
+
+    @classmethod
+    def from_database(cls, config):
+        """ Loads the index with one narrow query per table. """
+        tables = dict(
+            songs="select song_id, song_nm, artist_id, album_id, genre_id from songs",
+            artists="select artist_id, artist_nm from artists",
+            albums="select album_id, album_nm from albums",
+            genres="select genre_id, genre_nm from genres",
+            playlists="select playlist_id, playlist_nm from playlists",
+            playlist_songs="select playlist_id, song_id, playlist_order from playlist_songs",
+        )
+        frames = {k: psql_to_df(query, config) for k, query in tables.items()}
+        return cls(**frames)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir):
+        """ Loads the index from a snapshot written by `snapshot.export_snapshot`. """
+        from snapshot import load_snapshot
+        snap = load_snapshot(snapshot_dir)
+        lib, pls = snap['library'], snap['playlists']
+        songs = lib.drop_duplicates('song_id')
+        return cls(
+            songs=songs[['song_id','song_nm','artist_id','album_id','genre_id']],
+            artists=lib[['artist_id','artist_nm']].drop_duplicates('artist_id'),
+            albums=lib[['album_id','album_nm']].dropna().drop_duplicates('album_id'),
+            genres=lib[['genre_id','genre_nm']].dropna().drop_duplicates('genre_id'),
+            playlists=pls[['playlist_id','playlist_nm']].drop_duplicates('playlist_id'),
+            playlist_songs=pls[['playlist_id','song_id','playlist_order']],
+        )
+
+    # Position lookups
+    def _song_pos(self, song_id):
+        i = np.searchsorted(self.song_ids, song_id)
+        if (i >= len(self.song_ids)) or (self.song_ids[i] != song_id):
+            raise KeyError(f"song_id {song_id} is not in the library")
+        return i
+
+    def _artist_pos(self, artist_nm):
+        pos = self._artist_lookup.get(artist_nm.lower())
+        if pos is None:
+            raise KeyError(f"artist_nm {artist_nm} is not in the library")
+        return pos
+
+    def _playlist_pos(self, playlist_nm):
+        pos = self._playlist_lookup.get(playlist_nm)
+        if pos is None:
+            raise KeyError(f"playlist_nm {playlist_nm} is not in the library")
+        return pos
+
+    # Public lookups
+    def song(self, song_id):
+        """ Returns the names of a song's fields as a dictionary. """
+        i = self._song_pos(song_id)
+        get = lambda names, j: names[j] if j >= 0 else None
+        return dict(
+            song_id=int(song_id),
+            song_nm=self.song_names[i],
+            artist_nm=get(self.artist_names, self.song_artist[i]),
+            album_nm=get(self.album_names, self.song_album[i]),
+            genre_nm=get(self.genre_names, self.song_genre[i]),
+        )
+
+    def songs_by_artist(self, artist_nm):
+        """ song_ids of every song by an artist (case-insensitive). """
+        pos = self._artist_pos(artist_nm)
+        songs = [self.artist_songs[self.artist_indptr[j]:self.artist_indptr[j+1]] for j in pos]
+        return self.song_ids[np.concatenate(songs)]
+
+    def playlist_song_ids(self, playlist_nm):
+        """ song_ids of a playlist, in playlist order. """
+        j = self._playlist_pos(playlist_nm)
+        songs = self.playlist_songs[self.playlist_indptr[j]:self.playlist_indptr[j+1]]
+        return self.song_ids[songs]
+
+    def playlists_with_song(self, song_id):
+        """ Names of the playlists a song is in. """
+        i = self._song_pos(song_id)
+        pls = self.song_playlists[self.song_pl_indptr[i]:self.song_pl_indptr[i+1]]
+        return self.playlist_names[np.unique(pls)].tolist()
+
+    def playlists_with_artist(self, artist_nm):
+        """
+        Names of the playlists containing any song by an artist, mapped to the
+        number of that artist's songs in each.
+        """
+        songs = np.concatenate([
+            self.artist_songs[self.artist_indptr[j]:self.artist_indptr[j+1]]
+            for j in self._artist_pos(artist_nm)
+        ])
+        if len(songs) == 0:
+            return dict()
+        starts, ends = self.song_pl_indptr[songs], self.song_pl_indptr[songs+1]
+        pls = np.concatenate([self.song_playlists[a:b] for a, b in zip(starts, ends)])
+        pls, counts = np.unique(pls, return_counts=True)
+        return dict(zip(self.playlist_names[pls].tolist(), counts.tolist()))
+
+    @property
+    def nbytes(self):
+        """ Approximate memory held by the numeric arrays, in bytes. """
+        return sum(
+            v.nbytes for v in vars(self).values()
+            if isinstance(v, np.ndarray) and (v.dtype != object)
+        )
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def __repr__(self):
+        return (
+            f"LibraryIndex({len(self.song_ids)} songs, {len(self.artist_ids)} artists, "
+            f"{len(self.playlist_ids)} playlists)"
+        )
@@ -0,0 +1,213 @@
+import os
+import re
+import tempfile
+from itertools import groupby
+from urllib.parse import quote
+from xml.sax.saxutils import escape, quoteattr
+from util import connect
+
+FORMATS = ['m3u8', 'xspf', 'rhythmbox']
+# Rows fetched from the server-side cursor per round trip
+ITERSIZE = 2000
+# Characters GLib leaves unescaped in file:// URIs (besides letters, digits
+# and -._~), so locations match what Rhythmbox writes itself
+URI_SAFE = "/!$&'()*+,;=:@"
+
+# Every playlist's songs in order, one file per song (the first, if a song
+# has several). Songs without a file can't be played, so they're left out.
+EXPORT_QUERY = """
+select
+    playlists.playlist_id
+    ,playlists.playlist_nm
+    ,songs.song_nm
+    ,artists.artist_nm
+    ,albums.album_nm
+    ,song_file.file_nm
+    ,song_file.duration
+from playlists
+    join playlist_songs on playlist_songs.playlist_id = playlists.playlist_id
+    join songs on songs.song_id = playlist_songs.song_id
+    join artists on artists.artist_id = songs.artist_id
+    left join albums on albums.album_id = songs.album_id
+    join lateral (
+        select song_files.file_nm, song_files.duration
+        from song_files
+        where song_files.song_id = songs.song_id
+        order by song_files.file_nm
+        limit 1
+    ) song_file on true
+order by playlists.playlist_id, playlist_songs.playlist_order, playlist_songs.song_id
+"""
+
+##############################################################################
+##                                Writers                                   ##
+##############################################################################
+
+def file_uri(file_nm, music_dir):
+    """ Percent-encoded file:// URI of a song file, as Rhythmbox writes them. """
+    return 'file://' + quote(music_dir+file_nm, safe=URI_SAFE)
+
+def playlist_file_nm(playlist_nm, ext):
+    """ File name for a playlist, with path separators and control characters removed. """
+    name = re.sub(r'[/\\\x00-\x1f]', '_', playlist_nm).strip() or '_'
+    return f'{name}.{ext}'
+
+class _AtomicFile:
+    """
+    Text file written to a temporary name and moved into place on close, so
+    an interrupted export never leaves a half-written playlist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        self.fp = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def write(self, s):
+        self.fp.write(s)
+
+    def close(self):
+        self.fp.close()
+        os.replace(self.tmp_path, self.path)
+        return self.path
+
+class M3U8Writer:
+    """
+    One extended M3U playlist per playlist. Entries are plain UTF-8 paths
+    (what M3U8 players expect), not URIs.
+    """
+    ext = 'm3u8'
+
+    def __init__(self, out_dir, music_dir):
+        self.out_dir = out_dir
+        self.music_dir = music_dir
+        self.paths = list()
+        self._used = set()
+
+    def _open(self, playlist_nm):
+        # Playlist names aren't unique, so later duplicates get a number
+        file_nm, n = playlist_file_nm(playlist_nm, self.ext), 1
+        while file_nm.lower() in self._used:
+            n += 1
+            file_nm = playlist_file_nm(f'{playlist_nm} ({n})', self.ext)
+        self._used.add(file_nm.lower())
+        return _AtomicFile(os.path.join(self.out_dir, file_nm))
+
+    def start_playlist(self, playlist_nm):
+        self.fp = self._open(playlist_nm)
+        self.fp.write(f'#EXTM3U\n#PLAYLIST:{playlist_nm}\n')
+
+    def add_song(self, song):
+        duration = -1 if song['duration'] is None else int(song['duration'])
+        title = f"{song['artist_nm']} - {song['song_nm']}".replace('\n', ' ')
+        self.fp.write(f"#EXTINF:{duration},{title}\n{self.music_dir}{song['file_nm']}\n")
+
+    def end_playlist(self):
+        self.paths.append(self.fp.close())
+
+    def close(self):
+        return self.paths
+
+class XSPFWriter(M3U8Writer):
+    """ One XSPF playlist per playlist, with file:// URI locations. """
+    ext = 'xspf'
+
+    def start_playlist(self, playlist_nm):
+        self.fp = self._open(playlist_nm)
+        self.fp.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+            f'  <title>{escape(playlist_nm)}</title>\n'
+            '  <trackList>\n'
+        )
+
+    def add_song(self, song):
+        fields = [
+            ('location', file_uri(song['file_nm'], self.music_dir)),
+            ('title', song['song_nm']),
+            ('creator', song['artist_nm']),
+            ('album', song['album_nm']),
+            # XSPF durations are in milliseconds
+            ('duration', None if song['duration'] is None else int(song['duration'])*1000),
+        ]
+        self.fp.write('    <track>\n')
+        for tag, value in fields:
+            if value is not None:
+                self.fp.write(f'      <{tag}>{escape(str(value))}</{tag}>\n')
+        self.fp.write('    </track>\n')
+
+    def end_playlist(self):
+        self.fp.write('  </trackList>\n</playlist>\n')
+        self.paths.append(self.fp.close())
+
+class RhythmboxWriter:
+    """ Every playlist as a static playlist in a single Rhythmbox `playlists.xml`. """
+
+    def __init__(self, out_dir, music_dir):
+        self.music_dir = music_dir
+        self.fp = _AtomicFile(os.path.join(out_dir, 'playlists.xml'))
+        self.fp.write('<?xml version="1.0"?>\n<rhythmdb-playlists>\n')
+
+    def start_playlist(self, playlist_nm):
+        self.fp.write(
+            f'  <playlist name={quoteattr(playlist_nm)} show-browser="true" '
+            'browser-position="180" search-type="search-match" type="static">\n'
+        )
+
+    def add_song(self, song):
+        location = escape(file_uri(song['file_nm'], self.music_dir))
+        self.fp.write(f'    <location>{location}</location>\n')
+
+    def end_playlist(self):
+        self.fp.write('  </playlist>\n')
+
+    def close(self):
+        self.fp.write('</rhythmdb-playlists>\n')
+        return [self.fp.close()]
+
+WRITERS = dict(m3u8=M3U8Writer, xspf=XSPFWriter, rhythmbox=RhythmboxWriter)
+
+##############################################################################
+##                                 Export                                   ##
+##############################################################################
+
+def _stream_songs(config, itersize=ITERSIZE):
+    """
+    Yields every playlist song as a dict, in playlist order, from a
+    server-side cursor so only `itersize` rows are in memory at a time.
+    """
+    conn = connect(config)
+    cur = conn.cursor(name='playlist_export')
+    cur.itersize = itersize
+    try:
+        cur.execute(EXPORT_QUERY)
+        for row in cur:
+            yield dict(zip(
+                ['playlist_id','playlist_nm','song_nm','artist_nm','album_nm','file_nm','duration'],
+                row
+            ))
+    finally:
+        cur.close()
+        conn.rollback()
+        conn.close()
+
+def export_playlists(config, out_dir, music_dir, fmt='m3u8'):
+    """
+    Exports every playlist to `out_dir`: one .m3u8 or .xspf file per
+    playlist, or a single Rhythmbox playlists.xml. Songs are streamed from
+    the database and written as they arrive, so memory use doesn't grow
+    with the number of playlists. `music_dir` is where the new player will
+    find the files. Returns the paths written.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"fmt must be one of {FORMATS}, not {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+    writer = WRITERS[fmt](out_dir, music_dir)
+    for _, songs in groupby(_stream_songs(config), key=lambda song: song['playlist_id']):
+        first = next(songs)
+        writer.start_playlist(first['playlist_nm'])
+        writer.add_song(first)
+        for song in songs:
+            writer.add_song(song)
+        writer.end_playlist()
+    return writer.close()
@@ -0,0 +1,307 @@
+import re
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+    refresh_playlist_tracks,
+)
+
+# `playlist_songs.playlist_order` values are spaced this far apart, so a song
+# can be inserted between two neighbours by taking the midpoint. Only when two
+# neighbours end up adjacent does the playlist have to be renumbered.
+ORDER_GAP = 1024
+
+##############################################################################
+##                             Order planning                               ##
+##############################################################################
+
+def entries_to_move(current, target):
+    """
+    Finds the smallest set of items that have to move to turn `current` into
+    `target` (both permutations of the same items): everything outside the
+    longest increasing subsequence of target positions.
+    """
+    rank = {s: i for i, s in enumerate(target)}
+    seq = [rank[s] for s in current]
+    # Patience sorting for the LIS, keeping back-pointers
+    tails, tails_idx, prev = list(), list(), [-1]*len(seq)
+    for i, r in enumerate(seq):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            prev[i] = tails_idx[lo-1]
+        if lo == len(tails):
+            tails.append(r)
+            tails_idx.append(i)
+        else:
+            tails[lo] = r
+            tails_idx[lo] = i
+    keep = set()
+    i = tails_idx[-1] if len(tails_idx) > 0 else -1
+    while i >= 0:
+        keep.add(current[i])
+        i = prev[i]
+    return [s for s in target if s not in keep]
+
+def plan_orders(target, orders, gap=ORDER_GAP):
+    """
+    Works out `playlist_order` values that put the songs in `target` order,
+    given the current `orders` (song_id -> playlist_order) of songs already in
+    the playlist. Songs that don't need to move keep their values; the rest
+    are spread through the gaps around them. Returns only the song_id ->
+    playlist_order pairs that change (every song, if the playlist had to be
+    rebalanced).
+    """
+    current = sorted((s for s in target if s in orders), key=orders.get)
+    moving = set(entries_to_move(current, [s for s in target if s in orders]))
+    fixed = {s: orders[s] for s in current if s not in moving}
+    new = dict()
+    i, n = 0, len(target)
+    while i < n:
+        if target[i] in fixed:
+            i += 1
+            continue
+        # Find the run of songs between two fixed neighbours
+        j = i
+        while (j < n) and (target[j] not in fixed):
+            j += 1
+        run = target[i:j]
+        lo = fixed[target[i-1]] if i > 0 else None
+        hi = fixed[target[j]] if j < n else None
+        if (lo is None) and (hi is None):
+            values = [k*gap for k in range(len(run))]
+        elif lo is None:
+            values = [hi - (len(run)-k)*gap for k in range(len(run))]
+        elif hi is None:
+            values = [lo + (k+1)*gap for k in range(len(run))]
+        else:
+            step = (hi - lo) / (len(run) + 1)
+            if step < 1:
+                return {s: k*gap for k, s in enumerate(target)}
+            values = [lo + int(step*(k+1)) for k in range(len(run))]
+        new.update(zip(run, values))
+        i = j
+    return {s: o for s, o in new.items() if orders.get(s) != o}
+
+##############################################################################
+##                            Playlist editing                              ##
+##############################################################################
+
+def create_playlist_order_index(config):
+    """ Indexes `playlist_songs` so neighbour lookups don't scan the playlist. """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute("""
+    create index if not exists playlist_songs_order
+        on playlist_songs (playlist_id, playlist_order);
+    """)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _rebalance(cur, playlist_id, gap=ORDER_GAP):
+    """ Renumbers a whole playlist to evenly gapped orders in one statement. """
+    query = """
+    update playlist_songs
+    set playlist_order = v.new_order
+    from (
+        select
+            song_id
+            ,(row_number() over (order by playlist_order, song_id) - 1) * %s new_order
+        from playlist_songs
+        where playlist_id = %s
+    ) v
+    where playlist_songs.playlist_id = %s
+        and playlist_songs.song_id = v.song_id;
+    """
+    cur.execute(query, (gap, playlist_id, playlist_id))
+    return None
+
+def _slot(cur, playlist_id, song_id, before_song_id=None, gap=ORDER_GAP):
+    """
+    Finds a free `playlist_order` value just before `before_song_id` (or at
+    the end of the playlist), ignoring `song_id` itself. Returns None if the
+    neighbours are adjacent and the playlist needs to be rebalanced first.
+    """
+    if before_song_id is None:
+        query = """
+        select max(playlist_order)
+        from playlist_songs
+        where playlist_id = %s and song_id <> %s;
+        """
+        cur.execute(query, (playlist_id, song_id))
+        lo = cur.fetchone()[0]
+        return 0 if lo is None else lo + gap
+    query = """
+    select
+        hi.playlist_order
+        ,(
+            select max(playlist_order)
+            from playlist_songs lo
+            where lo.playlist_id = hi.playlist_id
+                and lo.playlist_order < hi.playlist_order
+                and lo.song_id <> %s
+        )
+    from playlist_songs hi
+    where hi.playlist_id = %s and hi.song_id = %s;
+    """
+    cur.execute(query, (song_id, playlist_id, before_song_id))
+    row = cur.fetchone()
+    if row is None:
+        raise KeyError(f"song_id {before_song_id} is not in playlist {playlist_id}")
+    hi, lo = row
+    if lo is None:
+        return hi - gap
+    if hi - lo < 2:
+        return None
+    return (lo + hi) // 2
+
+def _place(playlist_id, song_id, config, before_song_id, query, refresh_view):
+    """ Shared body of `insert_song`/`move_song`. """
+    conn = connect(config)
+    cur = conn.cursor()
+    order = _slot(cur, playlist_id, song_id, before_song_id)
+    if order is None:
+        _rebalance(cur, playlist_id)
+        order = _slot(cur, playlist_id, song_id, before_song_id)
+    cur.execute(query, (order, playlist_id, song_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+    if refresh_view:
+        refresh_playlist_tracks(config)
+    return order
+
+def insert_song(playlist_id, song_id, config, before_song_id=None, refresh_view=True):
+    """
+    Inserts a song into a playlist just before `before_song_id`, or at the end
+    if that isn't given. Only the new row is written (unless the gap was used
+    up and the playlist was rebalanced). Returns the new `playlist_order`.
+    """
+    query = """
+    insert into playlist_songs
+        (playlist_order, playlist_id, song_id)
+    values (%s, %s, %s);
+    """
+    return _place(playlist_id, song_id, config, before_song_id, query, refresh_view)
+
+def move_song(playlist_id, song_id, config, before_song_id=None, refresh_view=True):
+    """
+    Moves a song already in a playlist to just before `before_song_id`, or to
+    the end if that isn't given. Returns the new `playlist_order`.
+    """
+    query = """
+    update playlist_songs
+    set playlist_order = %s
+    where playlist_id = %s and song_id = %s;
+    """
+    return _place(playlist_id, song_id, config, before_song_id, query, refresh_view)
+
+def remove_song(playlist_id, song_id, config, refresh_view=True):
+    """ Removes a song from a playlist without renumbering the rest. """
+    conn = connect(config)
+    cur = conn.cursor()
+    query = "delete from playlist_songs where playlist_id = %s and song_id = %s;"
+    cur.execute(query, (playlist_id, song_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+    if refresh_view:
+        refresh_playlist_tracks(config)
+    return None
+
+def rebalance_playlist(playlist_id, config):
+    """ Spreads a playlist's orders back out to multiples of ORDER_GAP. """
+    conn = connect(config)
+    cur = conn.cursor()
+    _rebalance(cur, playlist_id)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def sort_key(name):
+    """
+    Sorting form of a name: lowercase, without a leading 'the '. Missing
+    names (None, or NaN from a dataframe) sort as ''.
+    """
+    if not isinstance(name, str):
+        name = ''
+    return re.sub(r'^the ', '', name.lower())
+
+def _plan_sort(df):
+    """
+    New orders that sort each playlist in `df` (playlist_id, playlist_nm,
+    song_id, playlist_order, sort_nm) by `sort_key(sort_nm)`, keeping the
+    current order between ties. Returns the (playlist_id, song_id,
+    playlist_order) rows to update and the number of them per playlist.
+    """
+    # Songs without an album/genre come back as NaN, which sorts as ''
+    df = df.assign(sort_key=df.sort_nm.map(sort_key))
+    updates, changed = list(), dict()
+    for (playlist_id, pl_nm), pl_df in df.groupby(['playlist_id', 'playlist_nm']):
+        orders = dict(zip(pl_df.song_id, pl_df.playlist_order))
+        target = pl_df.sort_values(['sort_key', 'playlist_order'], kind='stable').song_id.tolist()
+        new = plan_orders(target, orders)
+        updates += [(playlist_id, s, o) for s, o in new.items()]
+        changed[pl_nm] = len(new)
+    return updates, changed
+
+def sort_playlists(config, playlist_nm=None, by='artist_nm', dry_run=False):
+    """
+    Sorts every playlist (or just `playlist_nm`) by artist, or by song, album
+    or genre name, keeping the current order between ties. Only songs that
+    actually have to move are written, in one batched update. Returns the
+    number of rows changed per playlist.
+    """
+    columns = dict(
+        artist_nm='artists.artist_nm',
+        song_nm='songs.song_nm',
+        album_nm='albums.album_nm',
+        genre_nm='genres.genre_nm',
+    )
+    if by not in columns:
+        raise ValueError(f"by must be one of {list(columns)}, not {by}")
+    query = f"""
+    select
+        playlist_songs.playlist_id
+        ,playlists.playlist_nm
+        ,playlist_songs.song_id
+        ,playlist_songs.playlist_order
+        ,{columns[by]} sort_nm
+    from playlist_songs
+        join playlists on playlists.playlist_id = playlist_songs.playlist_id
+        join songs on songs.song_id = playlist_songs.song_id
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+        left join genres on genres.genre_id = songs.genre_id
+    """
+    values = None
+    if playlist_nm is not None:
+        query += " where playlists.playlist_nm = %s"
+        values = (playlist_nm,)
+    df = psql_to_df(query, config, values)
+    updates, changed = _plan_sort(df)
+    if dry_run or (len(updates) == 0):
+        return changed
+    conn = connect(config)
+    cur = conn.cursor()
+    query = """
+    update playlist_songs
+    set playlist_order = v.playlist_order
+    from (values %s) v (playlist_id, song_id, playlist_order)
+    where playlist_songs.playlist_id = v.playlist_id
+        and playlist_songs.song_id = v.song_id;
+    """
+    execute_values(cur, query, [tuple(int(x) for x in row) for row in updates])
+    conn.commit()
+    cur.close()
+    conn.close()
+    refresh_playlist_tracks(config)
+    return changed
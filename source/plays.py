@@ -0,0 +1,304 @@
+import time
+import atexit
+import threading
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from collections import Counter
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+)
+
+EVENTS = ['play', 'finish', 'skip']
+
+##############################################################################
+##                                 Tables                                   ##
+##############################################################################
+
+def create_play_tables(config):
+    """
+    Creates the play-tracking tables:
+        plays: one row per play event reported by a player
+        song_play_counts: per-song rollup (plays, finishes, last played)
+        artist_play_counts: per-artist rollup of the song counts
+    """
+    query = """
+    create table if not exists plays(
+        play_id bigserial,
+        song_id integer not null,
+        event varchar not null,
+        played_at timestamptz not null,
+        position float,
+        primary key (play_id),
+        foreign key (song_id) references songs (song_id) on delete cascade
+    );
+    create index if not exists plays_song_id on plays (song_id, played_at);
+    create table if not exists song_play_counts(
+        song_id integer not null,
+        play_count integer not null default 0,
+        finish_count integer not null default 0,
+        skip_count integer not null default 0,
+        last_played timestamptz,
+        primary key (song_id),
+        foreign key (song_id) references songs (song_id) on delete cascade
+    );
+    create table if not exists artist_play_counts(
+        artist_id integer not null,
+        play_count integer not null default 0,
+        last_played timestamptz,
+        primary key (artist_id),
+        foreign key (artist_id) references artists (artist_id) on delete cascade
+    );
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _write_events(cur, events):
+    """
+    Inserts a batch of (song_id, event, played_at, position) events and adds
+    them to the rollups, with one statement per table. Events for songs that
+    no longer exist are dropped. Returns the number of events written.
+    """
+    query = """
+    insert into plays (song_id, event, played_at, position)
+    select v.song_id, v.event, v.played_at::timestamptz, v.position::float
+    from (values %s) v (song_id, event, played_at, position)
+        join songs on songs.song_id = v.song_id
+    returning song_id, event, played_at;
+    """
+    written = execute_values(cur, query, events, page_size=len(events), fetch=True)
+    counts = dict()
+    for song_id, event, played_at in written:
+        c = counts.setdefault(song_id, dict(play=0, finish=0, skip=0, last_played=None))
+        c[event] += 1
+        if (event == 'play') and ((c['last_played'] is None) or (played_at > c['last_played'])):
+            c['last_played'] = played_at
+    rows = [(s, c['play'], c['finish'], c['skip'], c['last_played']) for s, c in counts.items()]
+    if len(rows) == 0:
+        return 0
+    query = """
+    insert into song_play_counts (song_id, play_count, finish_count, skip_count, last_played)
+    values %s
+    on conflict (song_id) do update set
+        play_count = song_play_counts.play_count + excluded.play_count
+        ,finish_count = song_play_counts.finish_count + excluded.finish_count
+        ,skip_count = song_play_counts.skip_count + excluded.skip_count
+        ,last_played = greatest(song_play_counts.last_played, excluded.last_played);
+    """
+    execute_values(cur, query, rows, page_size=len(rows))
+    query = """
+    insert into artist_play_counts (artist_id, play_count, last_played)
+    select songs.artist_id, sum(v.play_count), max(v.last_played::timestamptz)
+    from (values %s) v (song_id, play_count, last_played)
+        join songs on songs.song_id = v.song_id
+    group by songs.artist_id
+    on conflict (artist_id) do update set
+        play_count = artist_play_counts.play_count + excluded.play_count
+        ,last_played = greatest(artist_play_counts.last_played, excluded.last_played);
+    """
+    execute_values(cur, query, [(r[0], r[1], r[4]) for r in rows], page_size=len(rows))
+    return len(written)
+
+def record_plays(events, config):
+    """ Writes a batch of (song_id, event, played_at, position) events right away. """
+    conn = connect(config)
+    cur = conn.cursor()
+    n = _write_events(cur, events)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return n
+
+##############################################################################
+##                           Write-behind buffer                            ##
+##############################################################################
+
+class PlayBuffer:
+    """
+    Collects play events in memory and writes them in batches from a
+    background thread, once `max_batch` events are waiting or every
+    `flush_interval` seconds, so recording a play never waits on the
+    database. If a flush fails the events are kept for the next one (up to
+    `max_pending`; beyond that the oldest are dropped and counted).
+    Pending events are flushed when the process exits.
+    """
+
+    def __init__(self, config, max_batch=100, flush_interval=5.0, max_pending=100_000):
+        self.config = config
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.stats = Counter()
+        self._pending = list()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='PlayBuffer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close, raise_errors=False)
+
+    def record(self, song_id, event='play', played_at=None, position=None):
+        """ Queues one play event; returns without touching the database. """
+        if event not in EVENTS:
+            raise ValueError(f"event must be one of {EVENTS}, not {event}")
+        played_at = played_at or datetime.now(timezone.utc)
+        position = None if position is None else float(position)
+        with self._lock:
+            self._pending.append((int(song_id), event, played_at, position))
+            self.stats['recorded'] += 1
+            n = len(self._pending)
+        if n >= self.max_batch:
+            self._wake.set()
+        return None
+
+    def flush(self):
+        """ Writes every pending event now. Returns the number written. """
+        with self._flush_lock:
+            with self._lock:
+                events, self._pending = self._pending, list()
+            if len(events) == 0:
+                return 0
+            start = time.perf_counter()
+            try:
+                n = record_plays(events, self.config)
+            except Exception:
+                with self._lock:
+                    self._pending = events + self._pending
+                    overflow = len(self._pending) - self.max_pending
+                    if overflow > 0:
+                        del self._pending[:overflow]
+                        self.stats['dropped'] += overflow
+                self.stats['failed_flushes'] += 1
+                raise
+            self.stats['flushes'] += 1
+            self.stats['written'] += n
+            self.stats['flush_ms'] += (time.perf_counter() - start) * 1000
+            return n
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # Kept for the next attempt; see `stats['failed_flushes']`
+                pass
+
+    def close(self, raise_errors=True):
+        """ Stops the background thread and flushes what's left. """
+        if self._closed:
+            return None
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        try:
+            self.flush()
+        except Exception:
+            if raise_errors:
+                raise
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+##############################################################################
+##                            Counts and imports                            ##
+##############################################################################
+
+def get_play_counts(config, by='song', limit=None):
+    """ Most played songs (or artists), with their counts and last play. """
+    if by == 'song':
+        query = """
+        select
+            songs.song_id
+            ,songs.song_nm
+            ,artists.artist_nm
+            ,song_play_counts.play_count
+            ,song_play_counts.finish_count
+            ,song_play_counts.skip_count
+            ,song_play_counts.last_played
+        from song_play_counts
+            join songs on songs.song_id = song_play_counts.song_id
+            join artists on artists.artist_id = songs.artist_id
+        order by song_play_counts.play_count desc, songs.song_id
+        """
+    elif by == 'artist':
+        query = """
+        select
+            artists.artist_id
+            ,artists.artist_nm
+            ,artist_play_counts.play_count
+            ,artist_play_counts.last_played
+        from artist_play_counts
+            join artists on artists.artist_id = artist_play_counts.artist_id
+        order by artist_play_counts.play_count desc, artists.artist_id
+        """
+    else:
+        raise ValueError(f"by must be 'song' or 'artist', not {by}")
+    values = list()
+    if limit is not None:
+        query += " limit %s"
+        values.append(int(limit))
+    return psql_to_df(query, config, values)
+
+def import_rhythmbox_play_counts(rb_dir, music_dir, config):
+    """
+    Seeds the song rollup with Rhythmbox's `play-count`/`last-played`
+    (keeping whichever count is higher), then rebuilds the artist rollup
+    from the song counts. Returns the number of songs updated.
+    """
+    from rhythmbox import location_to_file_nm
+    rows = list()
+    for _, elem in ET.iterparse(rb_dir+'rhythmdb.xml'):
+        if elem.tag != 'entry':
+            continue
+        if elem.get('type') == 'song':
+            fields = {e.tag: e.text for e in elem}
+            play_count = int(fields.get('play-count') or 0)
+            last_played = fields.get('last-played')
+            if (play_count > 0) or last_played:
+                rows.append((
+                    location_to_file_nm(fields['location'], music_dir),
+                    play_count,
+                    datetime.fromtimestamp(int(last_played), timezone.utc) if last_played else None,
+                ))
+        elem.clear()
+    if len(rows) == 0:
+        return 0
+    conn = connect(config)
+    cur = conn.cursor()
+    query = """
+    insert into song_play_counts (song_id, play_count, last_played)
+    select song_files.song_id, max(v.play_count), max(v.last_played::timestamptz)
+    from (values %s) v (file_nm, play_count, last_played)
+        join song_files on song_files.file_nm = v.file_nm
+    group by song_files.song_id
+    on conflict (song_id) do update set
+        play_count = greatest(song_play_counts.play_count, excluded.play_count)
+        ,last_played = greatest(song_play_counts.last_played, excluded.last_played);
+    """
+    execute_values(cur, query, rows, page_size=len(rows))
+    n = cur.rowcount
+    cur.execute("""
+    insert into artist_play_counts (artist_id, play_count, last_played)
+    select songs.artist_id, sum(song_play_counts.play_count), max(song_play_counts.last_played)
+    from song_play_counts
+        join songs on songs.song_id = song_play_counts.song_id
+    group by songs.artist_id
+    on conflict (artist_id) do update set
+        play_count = excluded.play_count
+        ,last_played = excluded.last_played;
+    """)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return n
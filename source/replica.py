@@ -0,0 +1,373 @@
+import os
+import json
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from decimal import Decimal
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+from util import (
+    connect,
+    cache_scope,
+    query_cache,
+    read_replica,
+)
+
+# Mirrored tables and the column changes are tracked by. Tables without a
+# primary key are tracked by a column that groups their rows (a song's files,
+# a playlist's songs): a change to any row recopies the whole group.
+REPLICA_TABLES = dict(
+    genres='genre_id',
+    artists='artist_id',
+    albums='album_id',
+    songs='song_id',
+    song_files='song_id',
+    playlists='playlist_id',
+    playlist_songs='playlist_id',
+)
+# Mirrored too, if they exist
+OPTIONAL_TABLES = dict(
+    song_artwork='song_id',
+    song_play_counts='song_id',
+    artist_play_counts='artist_id',
+    google_song_map='song_id',
+    smart_playlists='playlist_nm',
+    smart_playlist_songs='playlist_nm',
+)
+# Rows fetched per round trip when copying
+ITERSIZE = 5000
+
+# `util.PLAYLIST_TRACKS_QUERY` for SQLite, which has no lateral joins
+PLAYLIST_TRACKS_QUERY = """
+select
+    playlists.playlist_id
+    ,playlists.playlist_nm
+    ,playlist_songs.playlist_order
+    ,songs.song_id
+    ,songs.song_nm
+    ,artists.artist_id
+    ,artists.artist_nm
+    ,albums.album_id
+    ,albums.album_nm
+    ,genres.genre_id
+    ,genres.genre_nm
+    ,song_files.file_nm
+    ,song_files.duration
+    ,song_files.bitrate
+from playlist_songs
+    join playlists on playlists.playlist_id = playlist_songs.playlist_id
+    join songs on songs.song_id = playlist_songs.song_id
+    join artists on artists.artist_id = songs.artist_id
+    left join albums on albums.album_id = songs.album_id
+    left join genres on genres.genre_id = songs.genre_id
+    left join song_files on song_files.rowid = (
+        select first_file.rowid
+        from song_files first_file
+        where first_file.song_id = songs.song_id
+        order by first_file.file_nm
+        limit 1
+    )
+"""
+PLAYLIST_TRACKS_TABLES = {'playlists', 'playlist_songs', 'songs', 'artists', 'albums', 'genres', 'song_files'}
+
+##############################################################################
+##                            Change tracking                               ##
+##############################################################################
+
+def enable_change_tracking(config):
+    """
+    Creates `replica_changes`, the log of changed rows, and the triggers that
+    fill it: after every statement on a mirrored table, the distinct key
+    values of the rows it touched (old and new) are logged, so replicas only
+    recopy those. A truncate logs a null key, which recopies the table. Each
+    change records the id of the transaction that made it, so a refresh can
+    tell which changes its last snapshot couldn't see yet.
+    """
+    query = """
+    create table if not exists replica_changes(
+        change_id bigserial,
+        table_nm varchar not null,
+        key_value varchar,
+        txid bigint not null default txid_current(),
+        changed_at timestamptz not null default now(),
+        primary key (change_id)
+    );
+    alter table replica_changes add column if not exists txid bigint not null default txid_current();
+    create index if not exists replica_changes_txid on replica_changes (txid);
+
+    create or replace function log_replica_change() returns trigger as $$
+    begin
+        if tg_op = 'TRUNCATE' then
+            insert into replica_changes (table_nm, key_value) values (tg_table_name, null);
+        end if;
+        if tg_op in ('INSERT', 'UPDATE') then
+            insert into replica_changes (table_nm, key_value)
+            select distinct tg_table_name, to_jsonb(new_rows) ->> tg_argv[0] from new_rows;
+        end if;
+        if tg_op in ('UPDATE', 'DELETE') then
+            insert into replica_changes (table_nm, key_value)
+            select distinct tg_table_name, to_jsonb(old_rows) ->> tg_argv[0] from old_rows;
+        end if;
+        return null;
+    end;
+    $$ language plpgsql;
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    for table, key in _existing_tables(cur).items():
+        cur.execute(f"""
+        drop trigger if exists {table}_replica_insert on {table};
+        create trigger {table}_replica_insert
+            after insert on {table} referencing new table as new_rows
+            for each statement execute procedure log_replica_change('{key}');
+        drop trigger if exists {table}_replica_update on {table};
+        create trigger {table}_replica_update
+            after update on {table} referencing old table as old_rows new table as new_rows
+            for each statement execute procedure log_replica_change('{key}');
+        drop trigger if exists {table}_replica_delete on {table};
+        create trigger {table}_replica_delete
+            after delete on {table} referencing old table as old_rows
+            for each statement execute procedure log_replica_change('{key}');
+        drop trigger if exists {table}_replica_truncate on {table};
+        create trigger {table}_replica_truncate
+            after truncate on {table}
+            for each statement execute procedure log_replica_change('{key}');
+        """)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def prune_changes(config, snapshot):
+    """
+    Deletes the logged changes a replica refreshed at `snapshot` has seen;
+    only safe once every replica has been refreshed past them.
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute("delete from replica_changes where txid_visible_in_snapshot(txid, %s::txid_snapshot);", (snapshot,))
+    n = cur.rowcount
+    conn.commit()
+    cur.close()
+    conn.close()
+    return n
+
+def _existing_tables(cur):
+    """ table -> key column of the mirrored tables that exist. """
+    tables = dict(REPLICA_TABLES, **OPTIONAL_TABLES)
+    cur.execute("""
+    select table_name
+    from information_schema.tables
+    where table_schema = current_schema() and table_name = any(%s)
+    """, (list(tables),))
+    existing = {row[0] for row in cur.fetchall()}
+    return {table: key for table, key in tables.items() if table in existing}
+
+##############################################################################
+##                              Replicating                                 ##
+##############################################################################
+
+def _sqlite_type(data_type):
+    if data_type in ['smallint', 'integer', 'bigint', 'boolean']:
+        return 'integer'
+    if data_type in ['real', 'double precision', 'numeric']:
+        return 'real'
+    return 'text'
+
+def _adapt(value):
+    """ A Postgres value as SQLite stores it: timestamps as ISO text, JSON as text. """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return value
+
+def _snapshot(config):
+    """
+    Connection whose transaction sees one consistent snapshot of the
+    database, and that snapshot (which transactions it sees). Nothing is
+    locked, so writers carry on while the replica copies: the next refresh
+    picks up whatever this snapshot didn't see, whatever order the writers
+    commit in.
+    """
+    conn = connect(config)
+    conn.set_isolation_level(ISOLATION_LEVEL_REPEATABLE_READ)
+    cur = conn.cursor()
+    # The first statement fixes the transaction's snapshot
+    cur.execute("select txid_current_snapshot()::text")
+    snapshot = cur.fetchone()[0]
+    cur.close()
+    return conn, snapshot
+
+def _copy_rows(conn, lite, table, where=None, values=None, itersize=ITERSIZE):
+    """ Copies a table's rows (optionally filtered) through a server-side cursor. """
+    cur = conn.cursor(name=f'replica_{table}')
+    cur.itersize = itersize
+    cur.execute(f"select * from {table}" + ('' if where is None else f" where {where}"), values)
+    n = 0
+    rows = cur.fetchmany(itersize)
+    if len(rows) > 0:
+        columns = [col.name for col in cur.description]
+        query = f"insert into {table} ({', '.join(columns)}) values ({', '.join('?' for _ in columns)})"
+    while len(rows) > 0:
+        lite.executemany(query, [tuple(map(_adapt, row)) for row in rows])
+        n += len(rows)
+        rows = cur.fetchmany(itersize)
+    cur.close()
+    return n
+
+def _build_playlist_tracks(lite):
+    """ (Re)builds `playlist_tracks` as a table, with the Postgres view's indexes. """
+    lite.executescript(f"""
+    drop table if exists playlist_tracks;
+    create table playlist_tracks as {PLAYLIST_TRACKS_QUERY};
+    create index playlist_tracks_pk on playlist_tracks (playlist_id, playlist_order, song_id);
+    create index playlist_tracks_playlist_nm on playlist_tracks (playlist_nm);
+    """)
+    return None
+
+def _save_state(lite, config, snapshot):
+    lite.execute("delete from replica_state")
+    lite.execute(
+        "insert into replica_state (source, snapshot, refreshed_at) values (?, ?, ?)",
+        (json.dumps(cache_scope(config)), snapshot, datetime.now(timezone.utc).isoformat())
+    )
+    return None
+
+def full_copy(config, path, itersize=ITERSIZE):
+    """
+    Copies every mirrored table from one snapshot into a new SQLite file,
+    which then replaces `path` (readers of the old file are unaffected).
+    Change tracking is enabled first, so later refreshes can be incremental.
+    Returns a summary of what was copied.
+    """
+    enable_change_tracking(config)
+    conn, snapshot = _snapshot(config)
+    cur = conn.cursor()
+    tables = _existing_tables(cur)
+    cur.execute("""
+    select table_name, column_name, data_type
+    from information_schema.columns
+    where table_schema = current_schema() and table_name = any(%s)
+    order by table_name, ordinal_position
+    """, (list(tables),))
+    columns = dict()
+    for table, column, data_type in cur.fetchall():
+        columns.setdefault(table, list()).append(f"{column} {_sqlite_type(data_type)}")
+    cur.close()
+
+    out_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(out_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, suffix='.tmp')
+    os.close(fd)
+    counts = dict()
+    try:
+        lite = sqlite3.connect(tmp_path)
+        lite.execute("create table replica_state (source text, snapshot text, refreshed_at text)")
+        for table, key in tables.items():
+            lite.execute(f"create table {table} ({', '.join(columns[table])})")
+            lite.execute(f"create index {table}_{key} on {table} ({key})")
+            counts[table] = _copy_rows(conn, lite, table, itersize=itersize)
+        _build_playlist_tracks(lite)
+        _save_state(lite, config, snapshot)
+        lite.commit()
+        lite.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    finally:
+        conn.rollback()
+        conn.close()
+    _invalidate(path, tables)
+    return dict(full=True, snapshot=snapshot, rows=counts)
+
+def refresh(config, path, prune=False, itersize=ITERSIZE):
+    """
+    Brings the replica at `path` up to date by recopying only the rows whose
+    keys were logged in `replica_changes` by transactions its last refresh
+    didn't see. Falls back
+    to a full copy if there is no replica yet, it was copied from another
+    database, or the schema changed. With `prune`, the applied changes are
+    deleted from the log (only safe with a single replica). Returns a
+    summary of what was recopied.
+    """
+    if not os.path.exists(path):
+        return full_copy(config, path, itersize)
+    lite = sqlite3.connect(path, timeout=30)
+    try:
+        source, since = lite.execute("select source, snapshot from replica_state").fetchone()
+        replicated = {row[0] for row in lite.execute("select name from sqlite_master where type = 'table'")}
+    except (sqlite3.Error, TypeError):
+        source, since, replicated = None, None, set()
+    if source != json.dumps(cache_scope(config)):
+        lite.close()
+        return full_copy(config, path, itersize)
+
+    conn, snapshot = _snapshot(config)
+    cur = conn.cursor()
+    tables = _existing_tables(cur)
+    if not set(tables) <= replicated:
+        # A table appeared since the last copy
+        cur.close()
+        conn.rollback()
+        conn.close()
+        lite.close()
+        return full_copy(config, path, itersize)
+    cur.execute("""
+    select table_nm, array_agg(distinct key_value)
+    from replica_changes
+    where txid >= txid_snapshot_xmin(%s::txid_snapshot)
+        and not txid_visible_in_snapshot(txid, %s::txid_snapshot)
+    group by table_nm
+    """, (since, since))
+    changed = {table: keys for table, keys in cur.fetchall() if table in tables}
+    cur.close()
+
+    counts = dict()
+    try:
+        for table, keys in changed.items():
+            key = tables[table]
+            if None in keys:
+                # Truncated: recopy the whole table
+                lite.execute(f"delete from {table}")
+                counts[table] = _copy_rows(conn, lite, table, itersize=itersize)
+                continue
+            # Keys are logged as text; compare them as what the column holds
+            key_type = {row[1]: row[2].lower() for row in lite.execute(f"pragma table_info({table})")}[key]
+            if key_type == 'integer':
+                keys = [int(k) for k in keys]
+            lite.execute(f"delete from {table} where {key} in (select value from json_each(?))", (json.dumps(keys),))
+            counts[table] = _copy_rows(conn, lite, table, f"{key} = any(%s)", (keys,), itersize)
+        if len(changed.keys() & PLAYLIST_TRACKS_TABLES) > 0:
+            _build_playlist_tracks(lite)
+        _save_state(lite, config, snapshot)
+        lite.commit()
+    except sqlite3.OperationalError:
+        # The schema changed (a column was added, say)
+        counts = None
+    finally:
+        lite.close()
+    if counts is None:
+        conn.rollback()
+        conn.close()
+        return full_copy(config, path, itersize)
+    if prune:
+        cur = conn.cursor()
+        cur.execute("delete from replica_changes where txid_visible_in_snapshot(txid, %s::txid_snapshot);", (snapshot,))
+        cur.close()
+        conn.commit()
+    conn.close()
+    _invalidate(path, changed)
+    return dict(full=False, snapshot=snapshot, rows=counts)
+
+def _invalidate(path, tables):
+    """ Drops cached results read from the replica if this process is using it. """
+    if read_replica.path == os.path.abspath(path):
+        read_replica.use(path)
+        query_cache.invalidate(set(tables) | {'playlist_tracks'}, read_replica.scope)
+    return None
@@ -0,0 +1,322 @@
+import xml.etree.ElementTree as ET
+from urllib.parse import unquote
+import pandas as pd
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    refresh_playlist_tracks,
+    collect_orphans,
+)
+from playlist_order import ORDER_GAP
+from frames import (
+    build_frame,
+    RHYTHMDB_SCHEMA,
+)
+
+##############################################################################
+##                             Parsing the XML                              ##
+##############################################################################
+
+def location_to_file_nm(location, music_dir):
+    """
+    Converts a Rhythmbox location URI (percent-encoded) to a file name
+    relative to the music directory.
+    """
+    path = unquote(location)
+    if path.startswith('file://'):
+        path = path[len('file://'):]
+    if path.startswith(music_dir):
+        path = path[len(music_dir):]
+    return path
+
+def parse_rhythmdb(path, music_dir):
+    """
+    Reads every song entry in `rhythmdb.xml` into a frame with the same
+    column names as the database. Entries are cleared as they're read so the
+    whole tree is never held in memory.
+    """
+    rows = list()
+    for _, elem in ET.iterparse(path):
+        if elem.tag != 'entry':
+            continue
+        if elem.get('type') == 'song':
+            rows.append({e.tag: e.text for e in elem})
+        elem.clear()
+    rb_df = build_frame(rows, RHYTHMDB_SCHEMA)
+    cols = {
+        'title': 'song_nm',
+        'artist': 'artist_nm',
+        'album': 'album_nm',
+        'genre': 'genre_nm',
+        'beats-per-minute': 'beats_per_min',
+        'file-size': 'file_size',
+    }
+    rb_df = rb_df.rename(columns=cols)
+    rb_df['file_nm'] = rb_df.location.map(lambda s: location_to_file_nm(s, music_dir))
+    rb_df['song_nm'] = rb_df.song_nm.fillna(rb_df.file_nm)
+    rb_df['artist_nm'] = rb_df.artist_nm.astype('string').fillna('Unknown').astype('category')
+    cols = ['file_nm','song_nm','artist_nm','album_nm','genre_nm','bitrate','beats_per_min','duration','file_size']
+    rb_df = rb_df[cols].drop_duplicates('file_nm')
+    return rb_df
+
+def parse_playlists(path, music_dir):
+    """
+    Reads every static playlist in `playlists.xml` into a frame of
+    (playlist_nm, file_nm, position). Automatic playlists are skipped; see
+    `smart_playlists.import_rhythmbox_smart_playlists`.
+    """
+    rows = list()
+    for playlist in ET.parse(path).getroot():
+        if (len(list(playlist)) == 0) or (playlist[0].tag == 'conjunction'):
+            continue
+        for i, loc in enumerate(playlist):
+            if (loc.text is None) or (loc.text.strip() == ''):
+                continue
+            rows.append([playlist.get('name'), location_to_file_nm(loc.text, music_dir), i])
+    return pd.DataFrame(rows, columns=['playlist_nm','file_nm','position'])
+
+##############################################################################
+##                           Incremental merge                              ##
+##############################################################################
+
+def create_merge_indexes(config):
+    """
+    Creates the unique indexes the upserts below conflict on. Fails if the
+    database already has duplicate names, which have to be merged first.
+    """
+    query = """
+    create unique index if not exists artists_artist_nm on artists (artist_nm);
+    create unique index if not exists genres_genre_nm on genres (genre_nm);
+    create unique index if not exists albums_artist_album on albums (artist_id, album_nm);
+    create unique index if not exists playlists_playlist_nm on playlists (playlist_nm);
+    create unique index if not exists song_files_file_nm on song_files (file_nm);
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _load_temp_tables(cur, rb_df, pl_df):
+    """ Loads the parsed XML into temp tables for set-based merging. """
+    cur.execute("""
+    create temp table rb_songs(
+        file_nm varchar primary key,
+        song_nm varchar,
+        artist_nm varchar,
+        album_nm varchar,
+        genre_nm varchar,
+        bitrate integer,
+        beats_per_min float,
+        duration integer,
+        file_size integer
+    ) on commit drop;
+    create temp table rb_playlist_songs(
+        playlist_nm varchar,
+        file_nm varchar,
+        position integer
+    ) on commit drop;
+    """)
+    for table, df in [('rb_songs', rb_df), ('rb_playlist_songs', pl_df)]:
+        df = df.astype(object).where(df.notna(), None)
+        # psycopg2 can't adapt numpy scalars, so unwrap them
+        rows = [
+            tuple(v.item() if hasattr(v, 'item') else v for v in row)
+            for row in df.itertuples(index=False)
+        ]
+        execute_values(cur, f"insert into {table} values %s", rows)
+    cur.execute("analyze rb_songs; analyze rb_playlist_songs;")
+    return None
+
+# Statements run in order, each reporting its row count under the given key.
+# New IDs continue from the current maximum so existing IDs never change.
+MERGE_STEPS = [
+    ('artists_inserted', """
+    insert into artists (artist_id, artist_nm)
+    select
+        (select coalesce(max(artist_id), -1) from artists) + row_number() over (order by artist_nm)
+        ,artist_nm
+    from (select distinct artist_nm from rb_songs) r
+    where not exists (select 1 from artists a where a.artist_nm = r.artist_nm)
+    on conflict (artist_nm) do nothing;
+    """),
+    ('genres_inserted', """
+    insert into genres (genre_id, genre_nm)
+    select
+        (select coalesce(max(genre_id), -1) from genres) + row_number() over (order by genre_nm)
+        ,genre_nm
+    from (select distinct genre_nm from rb_songs where genre_nm is not null) r
+    where not exists (select 1 from genres g where g.genre_nm = r.genre_nm)
+    on conflict (genre_nm) do nothing;
+    """),
+    ('albums_inserted', """
+    insert into albums (album_id, artist_id, album_nm)
+    select
+        (select coalesce(max(album_id), -1) from albums) + row_number() over (order by a.artist_id, r.album_nm)
+        ,a.artist_id
+        ,r.album_nm
+    from (select distinct artist_nm, album_nm from rb_songs where album_nm is not null) r
+        join artists a on a.artist_nm = r.artist_nm
+    where not exists (
+        select 1 from albums al
+        where al.artist_id = a.artist_id and al.album_nm = r.album_nm
+    )
+    on conflict (artist_id, album_nm) do nothing;
+    """),
+    ('songs_updated', """
+    update songs
+    set
+        song_nm = r.song_nm
+        ,artist_id = a.artist_id
+        ,album_id = al.album_id
+        ,genre_id = g.genre_id
+    from rb_songs r
+        join song_files f on f.file_nm = r.file_nm
+        join artists a on a.artist_nm = r.artist_nm
+        left join albums al on al.artist_id = a.artist_id and al.album_nm = r.album_nm
+        left join genres g on g.genre_nm = r.genre_nm
+    where songs.song_id = f.song_id
+        and (songs.song_nm, songs.artist_id, songs.album_id, songs.genre_id)
+            is distinct from (r.song_nm, a.artist_id, al.album_id, g.genre_id);
+    """),
+    (None, """
+    create temp table rb_new_songs on commit drop as
+    select
+        (select coalesce(max(song_id), -1) from songs) + row_number() over (order by r.file_nm) song_id
+        ,r.file_nm
+    from rb_songs r
+    where not exists (select 1 from song_files f where f.file_nm = r.file_nm);
+    """),
+    ('songs_inserted', """
+    insert into songs (song_id, song_nm, artist_id, album_id, genre_id)
+    select n.song_id, r.song_nm, a.artist_id, al.album_id, g.genre_id
+    from rb_new_songs n
+        join rb_songs r on r.file_nm = n.file_nm
+        join artists a on a.artist_nm = r.artist_nm
+        left join albums al on al.artist_id = a.artist_id and al.album_nm = r.album_nm
+        left join genres g on g.genre_nm = r.genre_nm;
+    """),
+    ('song_files_upserted', """
+    insert into song_files (song_id, file_nm, bitrate, beats_per_min, duration, file_size)
+    select
+        coalesce(f.song_id, n.song_id)
+        ,r.file_nm
+        ,r.bitrate
+        ,r.beats_per_min
+        ,r.duration
+        ,r.file_size
+    from rb_songs r
+        left join song_files f on f.file_nm = r.file_nm
+        left join rb_new_songs n on n.file_nm = r.file_nm
+    on conflict (file_nm) do update set
+        bitrate = excluded.bitrate
+        ,beats_per_min = excluded.beats_per_min
+        ,duration = excluded.duration
+        ,file_size = excluded.file_size
+    where (song_files.bitrate, song_files.beats_per_min, song_files.duration, song_files.file_size)
+        is distinct from (excluded.bitrate, excluded.beats_per_min, excluded.duration, excluded.file_size);
+    """),
+    (None, """
+    create temp table rb_gone_songs on commit drop as
+    select f.song_id
+    from song_files f
+        left join rb_songs r on r.file_nm = f.file_nm
+    group by f.song_id
+    having count(r.file_nm) = 0;
+    """),
+    ('song_files_deleted', """
+    delete from song_files f
+    where not exists (select 1 from rb_songs r where r.file_nm = f.file_nm);
+    """),
+    (None, """
+    delete from playlist_songs
+    where song_id in (select song_id from rb_gone_songs);
+    """),
+    ('songs_deleted', """
+    delete from songs
+    where song_id in (select song_id from rb_gone_songs);
+    """),
+    ('playlists_inserted', """
+    insert into playlists (playlist_id, playlist_nm)
+    select
+        (select coalesce(max(playlist_id), -1) from playlists) + row_number() over (order by playlist_nm)
+        ,playlist_nm
+    from (select distinct playlist_nm from rb_playlist_songs) r
+    where not exists (select 1 from playlists p where p.playlist_nm = r.playlist_nm)
+    on conflict (playlist_nm) do nothing;
+    """),
+    ('playlist_songs_deleted', """
+    delete from playlist_songs ps
+    using playlists p
+    where p.playlist_id = ps.playlist_id
+        and p.playlist_nm in (select playlist_nm from rb_playlist_songs)
+        and not exists (
+            select 1
+            from rb_playlist_songs r
+                join song_files f on f.file_nm = r.file_nm
+            where r.playlist_nm = p.playlist_nm
+                and f.song_id = ps.song_id
+        );
+    """),
+    ('playlist_songs_inserted', f"""
+    insert into playlist_songs (playlist_id, song_id, playlist_order)
+    select
+        n.playlist_id
+        ,n.song_id
+        ,coalesce(m.max_order, -{ORDER_GAP}) + {ORDER_GAP} * row_number() over (
+            partition by n.playlist_id order by n.position
+        )
+    from (
+        select distinct on (p.playlist_id, f.song_id)
+            p.playlist_id, f.song_id, r.position
+        from rb_playlist_songs r
+            join playlists p on p.playlist_nm = r.playlist_nm
+            join song_files f on f.file_nm = r.file_nm
+        where not exists (
+            select 1 from playlist_songs ps
+            where ps.playlist_id = p.playlist_id and ps.song_id = f.song_id
+        )
+        order by p.playlist_id, f.song_id, r.position
+    ) n
+        left join (
+            select playlist_id, max(playlist_order) max_order
+            from playlist_songs
+            group by playlist_id
+        ) m on m.playlist_id = n.playlist_id;
+    """),
+]
+
+def sync_rhythmbox(rb_dir, music_dir, config, dry_run=False, gc=True):
+    """
+    Merges the current Rhythmbox `rhythmdb.xml`/`playlists.xml` into the
+    database, applying only the inserts/updates/deletes needed. Songs are
+    matched by file name, names by exact value, and existing IDs are kept.
+    Songs new to a playlist are appended to it; playlists that aren't in
+    Rhythmbox are left alone. With `dry_run` the merge is rolled back, so the
+    returned row counts show what would change.
+    """
+    rb_df = parse_rhythmdb(rb_dir+'rhythmdb.xml', music_dir)
+    pl_df = parse_playlists(rb_dir+'playlists.xml', music_dir)
+    if len(rb_df) == 0:
+        raise ValueError(f"No songs found in {rb_dir}rhythmdb.xml; refusing to delete the whole library")
+    conn = connect(config)
+    cur = conn.cursor()
+    _load_temp_tables(cur, rb_df, pl_df)
+    counts = dict()
+    for key, query in MERGE_STEPS:
+        cur.execute(query)
+        if key is not None:
+            counts[key] = cur.rowcount
+    if dry_run:
+        conn.rollback()
+    else:
+        conn.commit()
+    cur.close()
+    conn.close()
+    if not dry_run:
+        if gc:
+            counts.update({f'{k}_deleted': v for k, v in collect_orphans(config).items()})
+        refresh_playlist_tracks(config)
+    return counts
@@ -0,0 +1,305 @@
+from itertools import count, groupby
+from contextlib import contextmanager
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    get_song_metadata,
+    _collect_orphans,
+    _refresh_playlist_tracks,
+)
+
+##############################################################################
+##                                Session                                   ##
+##############################################################################
+
+class Session:
+    """
+    Unit of work for maintenance: holds one connection, queues operations
+    (adding, renaming and deleting songs, collecting orphans, raw
+    statements) and only writes them on `flush`, batching each run of
+    operations of the same kind into a few set-based statements. Everything
+    is committed at once by `commit`, which also refreshes `playlist_tracks`
+    in the same transaction, so a session either happens entirely or not at
+    all. Used as a context manager it commits on success and rolls back if
+    the block raises:
+
+        with Session(config) as s:
+            song_id = s.add_song('new.mp3', 'Song', 'Artist', music_dir=MUSIC_DIR)
+            s.rename_song(song_id, 'Better Name')
+            s.delete_songs([1234])
+
+    Each flush runs inside a savepoint; if one fails, only that flush is
+    undone (and its operations dropped), and the error is raised.
+    """
+
+    def __init__(self, config, refresh_view=True):
+        self.config = config
+        self.refresh_view = refresh_view
+        self.conn = connect(config)
+        self.cur = self.conn.cursor()
+        self._pending = list()
+        self._next_song_id = None
+        self._savepoints = count()
+        self._changed = False
+
+    def add_song(self, file_nm, song_nm, artist_nm, genre_nm=None, album_nm=None, music_dir=None):
+        """
+        Queues a new song. Its artist/genre/album are looked up by name
+        (case-insensitively) when the session flushes, and created if they
+        don't exist. With `music_dir`, the file's duration/bitrate/size are
+        stored too. Returns the new song_id, so later operations in the same
+        session can refer to it.
+        """
+        if self._next_song_id is None:
+            self.cur.execute("select coalesce(max(song_id), -1) + 1 from songs")
+            self._next_song_id = self.cur.fetchone()[0]
+        song_id = self._next_song_id
+        self._next_song_id += 1
+        metadata = dict() if music_dir is None else get_song_metadata(file_nm, music_dir)
+        self._pending.append(('add', dict(
+            song_id=song_id,
+            file_nm=file_nm,
+            song_nm=song_nm,
+            artist_nm=artist_nm,
+            genre_nm=genre_nm,
+            album_nm=album_nm,
+            duration=metadata.get('duration'),
+            bitrate=metadata.get('bitrate'),
+            file_size=metadata.get('file_size'),
+        )))
+        return song_id
+
+    def rename_song(self, song_id, new_song_nm):
+        """ Queues a change of a song's name. """
+        self._pending.append(('rename', (int(song_id), new_song_nm)))
+        return None
+
+    def delete_songs(self, song_ids, collect_orphans=False):
+        """
+        Queues deleting songs (and their files/playlist entries). With
+        `collect_orphans`, artists/albums/genres left without songs are
+        removed afterwards.
+        """
+        self._pending.append(('delete', [int(s) for s in song_ids]))
+        if collect_orphans:
+            self.collect_orphans()
+        return None
+
+    def collect_orphans(self):
+        """ Queues removing artists, albums and genres that have no songs. """
+        self._pending.append(('orphans', None))
+        return None
+
+    def execute(self, query, values=None):
+        """ Queues any other statement, to run in order with the rest. """
+        self._pending.append(('execute', (query, values)))
+        return None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _lookup(self, query, names):
+        """ name key -> id for the names that exist; raises on duplicates. """
+        rows = execute_values(self.cur, query, names, page_size=len(names), fetch=True)
+        found = dict()
+        for key, row_id in ((tuple(r[:-1]), r[-1]) for r in rows):
+            if key in found:
+                raise IndexError(f"{key} has more than one entry in the database!")
+            found[key] = row_id
+        return found
+
+    def _new_ids(self, table, id_col, keys):
+        """ Allocates consecutive ids after the current maximum. """
+        self.cur.execute(f"select coalesce(max({id_col}), -1) + 1 from {table}")
+        start = self.cur.fetchone()[0]
+        return {key: start + i for i, key in enumerate(keys)}
+
+    def _flush_adds(self, songs):
+        """
+        Inserts a batch of new songs: one lookup and one insert per table
+        for their artists/genres/albums, then one insert each into `songs`
+        and `song_files`.
+        """
+        # Artists
+        keys = sorted({(s['artist_nm'].lower(),) for s in songs})
+        query = """
+        select lower(artists.artist_nm), artists.artist_id
+        from artists
+            join (values %s) v (nm) on lower(artists.artist_nm) = v.nm
+        """
+        artist_ids = self._lookup(query, keys)
+        new = self._new_ids('artists', 'artist_id', [k for k in keys if k not in artist_ids])
+        if len(new) > 0:
+            names = {(s['artist_nm'].lower(),): s['artist_nm'] for s in reversed(songs)}
+            rows = [(i, names[k]) for k, i in new.items()]
+            execute_values(self.cur, "insert into artists (artist_id, artist_nm) values %s", rows)
+        artist_ids.update(new)
+        for s in songs:
+            s['artist_id'] = artist_ids[(s['artist_nm'].lower(),)]
+
+        # Genres
+        keys = sorted({(s['genre_nm'].lower(),) for s in songs if s['genre_nm'] is not None})
+        genre_ids = dict()
+        if len(keys) > 0:
+            query = """
+            select lower(genres.genre_nm), genres.genre_id
+            from genres
+                join (values %s) v (nm) on lower(genres.genre_nm) = v.nm
+            """
+            genre_ids = self._lookup(query, keys)
+            new = self._new_ids('genres', 'genre_id', [k for k in keys if k not in genre_ids])
+            if len(new) > 0:
+                names = {(s['genre_nm'].lower(),): s['genre_nm'] for s in reversed(songs) if s['genre_nm']}
+                rows = [(i, names[k]) for k, i in new.items()]
+                execute_values(self.cur, "insert into genres (genre_id, genre_nm) values %s", rows)
+            genre_ids.update(new)
+        for s in songs:
+            s['genre_id'] = None if s['genre_nm'] is None else genre_ids[(s['genre_nm'].lower(),)]
+
+        # Albums, which belong to an artist
+        keys = sorted({(s['album_nm'].lower(), s['artist_id']) for s in songs if s['album_nm'] is not None})
+        album_ids = dict()
+        if len(keys) > 0:
+            query = """
+            select lower(albums.album_nm), albums.artist_id, albums.album_id
+            from albums
+                join (values %s) v (nm, artist_id)
+                    on lower(albums.album_nm) = v.nm and albums.artist_id = v.artist_id
+            """
+            album_ids = self._lookup(query, keys)
+            new = self._new_ids('albums', 'album_id', [k for k in keys if k not in album_ids])
+            if len(new) > 0:
+                names = {(s['album_nm'].lower(), s['artist_id']): s['album_nm'] for s in reversed(songs) if s['album_nm']}
+                rows = [(i, k[1], names[k]) for k, i in new.items()]
+                execute_values(self.cur, "insert into albums (album_id, artist_id, album_nm) values %s", rows)
+            album_ids.update(new)
+        for s in songs:
+            s['album_id'] = None if s['album_nm'] is None else album_ids[(s['album_nm'].lower(), s['artist_id'])]
+
+        # Songs and their files
+        query = "insert into songs (song_id, song_nm, artist_id, album_id, genre_id) values %s"
+        rows = [(s['song_id'], s['song_nm'], s['artist_id'], s['album_id'], s['genre_id']) for s in songs]
+        execute_values(self.cur, query, rows, page_size=len(rows))
+        query = "insert into song_files (song_id, file_nm, duration, bitrate, file_size) values %s"
+        rows = [(s['song_id'], s['file_nm'], s['duration'], s['bitrate'], s['file_size']) for s in songs]
+        execute_values(self.cur, query, rows, page_size=len(rows))
+        return None
+
+    def _flush_renames(self, renames):
+        # The last rename of a song wins
+        rows = list(dict(renames).items())
+        query = """
+        update songs
+        set song_nm = v.song_nm
+        from (values %s) v (song_id, song_nm)
+        where songs.song_id = v.song_id;
+        """
+        execute_values(self.cur, query, rows, page_size=len(rows))
+        return None
+
+    def _flush_deletes(self, batches):
+        values = (sorted({s for batch in batches for s in batch}),)
+        self.cur.execute("delete from song_files where song_id = any(%s);", values)
+        self.cur.execute("delete from playlist_songs where song_id = any(%s);", values)
+        self.cur.execute("delete from songs where song_id = any(%s);", values)
+        return None
+
+    def _flush_group(self, kind, payloads):
+        if kind == 'add':
+            self._flush_adds(payloads)
+        elif kind == 'rename':
+            self._flush_renames(payloads)
+        elif kind == 'delete':
+            self._flush_deletes(payloads)
+        elif kind == 'orphans':
+            _collect_orphans(self.cur)
+        else:
+            for query, values in payloads:
+                self.cur.execute(query, values)
+        return None
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Runs a block in its own savepoint: whatever it queued is flushed at
+        the end, and if it raises, everything it did is undone (the rest of
+        the session is kept) and the error is raised.
+        """
+        self.flush()
+        name = f"session_{next(self._savepoints)}"
+        self.cur.execute(f"savepoint {name}")
+        try:
+            yield self
+            self.flush()
+        except Exception:
+            self._pending = list()
+            self.cur.execute(f"rollback to savepoint {name}")
+            raise
+        self.cur.execute(f"release savepoint {name}")
+        return None
+
+    def flush(self):
+        """
+        Writes the queued operations in order, batching consecutive
+        operations of the same kind. Nothing is committed yet. Returns the
+        number of operations written.
+        """
+        if len(self._pending) == 0:
+            return 0
+        pending, self._pending = self._pending, list()
+        name = f"session_{next(self._savepoints)}"
+        self.cur.execute(f"savepoint {name}")
+        try:
+            for kind, ops in groupby(pending, key=lambda op: op[0]):
+                self._flush_group(kind, [payload for _, payload in ops])
+        except Exception:
+            self.cur.execute(f"rollback to savepoint {name}")
+            raise
+        self.cur.execute(f"release savepoint {name}")
+        self._changed = True
+        return len(pending)
+
+    def commit(self):
+        """
+        Flushes, refreshes `playlist_tracks` (if it exists) if anything
+        changed, and commits everything in one transaction.
+        """
+        self.flush()
+        if self._changed and self.refresh_view:
+            _refresh_playlist_tracks(self.cur)
+        self.conn.commit()
+        self._changed = False
+        # Other writers may have added songs since
+        self._next_song_id = None
+        return None
+
+    def rollback(self):
+        """ Drops queued operations and undoes everything since the last commit. """
+        self._pending = list()
+        self.conn.rollback()
+        self._changed = False
+        self._next_song_id = None
+        return None
+
+    def close(self):
+        """ Closes the connection; anything not committed is lost. """
+        if not self.conn.closed:
+            self.cur.close()
+            self.conn.close()
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __repr__(self):
+        return f"Session({len(self._pending)} queued)"
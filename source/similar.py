@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from util import psql_to_df
+
+##############################################################################
+##                              Helpers                                     ##
+##############################################################################
+
+def _membership(playlist_songs):
+    """ Distinct (playlist_id, song_id) pairs as an int64 frame. """
+    pairs = playlist_songs[['playlist_id','song_id']].dropna().drop_duplicates()
+    return pairs.astype(np.int64).reset_index(drop=True)
+
+def _top_k(scores, k, exclude=None):
+    """
+    Top `k` columns of every row of a sparse score matrix, as (row, rank,
+    column, score) arrays, without densifying it. Entries where the column
+    equals `exclude[row]` are dropped (a song isn't similar to itself).
+    """
+    scores = scores.tocsr()
+    scores.eliminate_zeros()
+    scores.sort_indices()
+    rows = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+    cols, data = scores.indices, scores.data
+    if exclude is not None:
+        keep = cols != exclude[rows]
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+    # Sort by row, then best score first, with one sort on a combined key
+    # (scores are cosines in (0, 1], so rows don't overlap); ties keep
+    # column order
+    order = np.argsort(2.0*rows - data, kind='stable')
+    rows, cols, data = rows[order], cols[order], data[order]
+    counts = np.bincount(rows, minlength=scores.shape[0])
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    rank = np.arange(len(rows)) - starts
+    keep = rank < k
+    return rows[keep], rank[keep], cols[keep], data[keep]
+
+##############################################################################
+##                              SimilarSongs                                ##
+##############################################################################
+
+class SimilarSongs:
+    """
+    "Songs like this one", from playlist co-occurrence. Songs are rows of a
+    sparse song x playlist matrix; two songs are similar in proportion to
+    the playlists they share (cosine similarity of their rows). The top `k`
+    neighbours of every song are precomputed with sparse matrix products,
+    and `update` only recomputes the songs a playlist change can affect.
+    """
+
+    def __init__(self, playlist_songs, songs=None, playlists=None, k=20, block_nnz=20_000_000):
+        self.k = k
+        self.block_nnz = block_nnz
+        self.songs = None if songs is None else songs.set_index('song_id')
+        self.playlists = dict() if playlists is None else dict(zip(playlists.playlist_nm, playlists.playlist_id))
+        self.pairs = _membership(playlist_songs)
+        self._build_matrix()
+        self.top_ids = np.full((len(self.song_ids), k), -1, dtype=np.int64)
+        self.top_scores = np.zeros((len(self.song_ids), k), dtype=np.float32)
+        self._compute_rows(np.arange(len(self.song_ids)))
+
+    @classmethod
+    def from_database(cls, config, k=20, replica=False):
+        """
+        Loads playlist membership (and names for display) from the database,
+        or from the local replica with `replica`.
+        """
+        query = "select playlist_id, song_id from playlist_songs"
+        playlist_songs = psql_to_df(query, config, cache=True, replica=replica)
+        query = """
+        select songs.song_id, songs.song_nm, artists.artist_nm
+        from songs
+            join artists on artists.artist_id = songs.artist_id
+        """
+        songs = psql_to_df(query, config, cache=True, replica=replica)
+        playlists = psql_to_df("select playlist_id, playlist_nm from playlists", config, cache=True, replica=replica)
+        return cls(playlist_songs, songs, playlists, k)
+
+    def _build_matrix(self):
+        """ Builds the row-normalized song x playlist matrix from `pairs`. """
+        self.song_ids = np.unique(self.pairs.song_id.to_numpy())
+        self.playlist_ids = np.unique(self.pairs.playlist_id.to_numpy())
+        rows = np.searchsorted(self.song_ids, self.pairs.song_id.to_numpy())
+        cols = np.searchsorted(self.playlist_ids, self.pairs.playlist_id.to_numpy())
+        counts = np.bincount(rows, minlength=len(self.song_ids))
+        weights = 1 / np.sqrt(counts[rows])
+        # Upper bound on the nonzeros each song's row of scores can have
+        sizes = np.bincount(cols, minlength=len(self.playlist_ids))
+        self._row_nnz = np.bincount(rows, weights=sizes[cols], minlength=len(self.song_ids))
+        self.matrix = sp.csr_matrix(
+            (weights.astype(np.float32), (rows, cols)),
+            shape=(len(self.song_ids), len(self.playlist_ids)),
+        )
+        self._matrix_t = self.matrix.T.tocsr()
+        return None
+
+    def _compute_rows(self, rows):
+        """
+        Recomputes the top-k neighbours of the songs at positions `rows`, in
+        blocks sized so each block's score matrix stays under `block_nnz`
+        nonzeros (songs in big playlists get smaller blocks).
+        """
+        bounds = np.cumsum(self._row_nnz[rows]) // self.block_nnz
+        splits = np.flatnonzero(np.diff(bounds)) + 1
+        for block in np.split(rows, splits):
+            if len(block) == 0:
+                continue
+            scores = self.matrix[block] @ self._matrix_t
+            r, rank, cols, data = _top_k(scores, self.k, exclude=block)
+            self.top_ids[block] = -1
+            self.top_scores[block] = 0
+            self.top_ids[block[r], rank] = self.song_ids[cols]
+            self.top_scores[block[r], rank] = data
+        return None
+
+    def update(self, playlist_songs):
+        """
+        Brings the index up to date with new playlist membership. A song's
+        neighbours can only change if it shares a playlist (before or after)
+        with a song that was added to or removed from a playlist, so only
+        those songs are recomputed. Returns how many songs were recomputed.
+        """
+        new_pairs = _membership(playlist_songs)
+        diff = pd.concat([self.pairs, new_pairs]).drop_duplicates(keep=False)
+        if len(diff) == 0:
+            return 0
+        both = pd.concat([self.pairs, new_pairs])
+        touched = both.playlist_id[both.song_id.isin(diff.song_id)].unique()
+        affected = both.song_id[both.playlist_id.isin(touched)].unique()
+        # Carry over the neighbours of everything else by song_id
+        old_ids, old_top_ids, old_top_scores = self.song_ids, self.top_ids, self.top_scores
+        self.pairs = new_pairs
+        self._build_matrix()
+        self.top_ids = np.full((len(self.song_ids), self.k), -1, dtype=np.int64)
+        self.top_scores = np.zeros((len(self.song_ids), self.k), dtype=np.float32)
+        pos = np.searchsorted(old_ids, self.song_ids)
+        pos = np.minimum(pos, max(0, len(old_ids)-1))
+        kept = (len(old_ids) > 0) & (old_ids[pos] == self.song_ids) & ~np.isin(self.song_ids, affected)
+        self.top_ids[kept] = old_top_ids[pos[kept]]
+        self.top_scores[kept] = old_top_scores[pos[kept]]
+        self._compute_rows(np.flatnonzero(~kept))
+        return int((~kept).sum())
+
+    def refresh(self, config):
+        """ Reloads playlist membership from the database and updates the index. """
+        playlist_songs = psql_to_df("select playlist_id, song_id from playlist_songs", config)
+        playlists = psql_to_df("select playlist_id, playlist_nm from playlists", config)
+        self.playlists = dict(zip(playlists.playlist_nm, playlists.playlist_id))
+        return self.update(playlist_songs)
+
+    def _frame(self, song_ids, scores):
+        df = pd.DataFrame(dict(song_id=song_ids, score=scores))
+        if self.songs is not None:
+            df = df.join(self.songs, on='song_id')
+        return df
+
+    def _song_pos(self, song_id):
+        i = np.searchsorted(self.song_ids, song_id)
+        if (i >= len(self.song_ids)) or (self.song_ids[i] != song_id):
+            raise KeyError(f"song_id {song_id} isn't in any playlist")
+        return i
+
+    def similar_songs(self, song_id, k=10):
+        """
+        The `k` songs most often found in the same playlists as `song_id`,
+        best first, with their cosine similarity.
+        """
+        i = self._song_pos(song_id)
+        if k <= self.k:
+            keep = self.top_ids[i, :k] >= 0
+            return self._frame(self.top_ids[i, :k][keep], self.top_scores[i, :k][keep])
+        # More than were precomputed; score this one song directly
+        _, _, cols, data = _top_k(self.matrix[[i]] @ self._matrix_t, k, exclude=np.array([i]))
+        return self._frame(self.song_ids[cols], data)
+
+    def extend_playlist(self, playlist, n=10):
+        """
+        Suggests `n` songs to add to a playlist (given by name, or as a list
+        of song_ids): those with the highest total similarity to all of its
+        songs, excluding the ones already in it.
+        """
+        if isinstance(playlist, str):
+            if playlist not in self.playlists:
+                raise KeyError(f"playlist_nm {playlist} is not in the library")
+            song_ids = self.pairs.song_id[self.pairs.playlist_id == self.playlists[playlist]]
+        else:
+            song_ids = pd.Series(playlist, dtype=np.int64)
+        song_ids = song_ids[song_ids.isin(self.song_ids)].to_numpy()
+        if len(song_ids) == 0:
+            return self._frame([], [])
+        members = np.searchsorted(self.song_ids, song_ids)
+        profile = sp.csr_matrix(self.matrix[members].sum(axis=0))
+        scores = (profile @ self._matrix_t).toarray().ravel()
+        scores[members] = 0
+        n = min(n, int((scores > 0).sum()))
+        best = np.argpartition(-scores, n-1)[:n] if n > 0 else np.array([], dtype=np.int64)
+        best = best[np.argsort(-scores[best], kind='stable')]
+        return self._frame(self.song_ids[best], scores[best])
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    def __repr__(self):
+        return (
+            f"SimilarSongs({len(self.song_ids)} songs, {len(self.playlist_ids)} playlists, "
+            f"k={self.k})"
+        )
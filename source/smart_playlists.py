@@ -0,0 +1,435 @@
+import json
+import xml.etree.ElementTree as ET
+from util import (
+    connect,
+    psql_to_df,
+)
+
+# Fields a rule can test, and the SQL they compile to (over the library query
+# in `compile_smart_playlist`). Text fields are compared case-insensitively.
+TEXT_FIELDS = {
+    'title': 'songs.song_nm',
+    'artist': 'artists.artist_nm',
+    'album': 'albums.album_nm',
+    'genre': 'genres.genre_nm',
+    'file_nm': 'song_files.file_nm',
+}
+NUMBER_FIELDS = {
+    'duration': 'song_files.duration',
+    'bitrate': 'song_files.bitrate',
+    'bpm': 'song_files.beats_per_min',
+    'file_size': 'song_files.file_size',
+}
+TEXT_OPS = {
+    '=': "lower({col}) = lower(%s)",
+    '!=': "lower({col}) is distinct from lower(%s)",
+    'contains': "lower({col}) like %s",
+    'not_contains': "coalesce(lower({col}), '') not like %s",
+    'starts_with': "lower({col}) like %s",
+    'ends_with': "lower({col}) like %s",
+}
+NUMBER_OPS = ['=', '!=', '<', '<=', '>', '>=']
+LIMIT_BY = {
+    'count': '1',
+    'duration': 'coalesce(song_files.duration, 0)',
+    'file_size': 'coalesce(song_files.file_size, 0)',
+}
+
+##############################################################################
+##                              Rule compiler                               ##
+##############################################################################
+#
+# A rule is either a condition, [field, op, value], or a group of rules:
+#     {'all': [rule, ...]}    every rule matches
+#     {'any': [rule, ...]}    at least one rule matches
+# e.g. songs over 5 minutes that are reggae or by Bob Marley:
+#     {'all': [
+#         ['duration', '>', 300],
+#         {'any': [['genre', '=', 'reggae'], ['artist', 'contains', 'marley']]},
+#     ]}
+# The special field 'playlist' ('=' or '!=') tests membership of a playlist.
+
+def _like_pattern(op, value):
+    if op in ['=', '!=']:
+        return value
+    value = str(value).lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    if op in ['contains', 'not_contains']:
+        return f'%{value}%'
+    if op == 'starts_with':
+        return f'{value}%'
+    return f'%{value}'
+
+def compile_rule(rule):
+    """
+    Compiles a rule to a SQL condition over the library query plus its
+    values. Raises ValueError for unknown fields/operators.
+    """
+    if isinstance(rule, dict):
+        if (len(rule) != 1) or (list(rule)[0] not in ['all', 'any']):
+            raise ValueError(f"rule groups must be {{'all': [...]}} or {{'any': [...]}}, not {rule}")
+        key, rules = list(rule.items())[0]
+        if len(rules) == 0:
+            return ('true' if key == 'all' else 'false'), []
+        parts = [compile_rule(r) for r in rules]
+        joiner = ' and ' if key == 'all' else ' or '
+        sql = '(' + joiner.join(p[0] for p in parts) + ')'
+        return sql, [v for p in parts for v in p[1]]
+    field, op, value = rule
+    if field == 'playlist':
+        if op not in ['=', '!=']:
+            raise ValueError(f"playlist rules only support '=' and '!=', not {op}")
+        sql = """exists (
+            select 1
+            from playlist_songs
+                join playlists on playlists.playlist_id = playlist_songs.playlist_id
+            where playlist_songs.song_id = songs.song_id
+                and playlists.playlist_nm = %s
+        )"""
+        return (sql if op == '=' else 'not '+sql), [value]
+    if field in TEXT_FIELDS:
+        if op not in TEXT_OPS:
+            raise ValueError(f"{field} rules support {list(TEXT_OPS)}, not {op}")
+        return TEXT_OPS[op].format(col=TEXT_FIELDS[field]), [_like_pattern(op, value)]
+    if field in NUMBER_FIELDS:
+        if op not in NUMBER_OPS:
+            raise ValueError(f"{field} rules support {NUMBER_OPS}, not {op}")
+        op = 'is distinct from' if op == '!=' else op
+        return f"{NUMBER_FIELDS[field]} {op} %s", [float(value)]
+    raise ValueError(f"unknown field {field}; expected one of "
+                     f"{list(TEXT_FIELDS)+list(NUMBER_FIELDS)+['playlist']}")
+
+def compile_smart_playlist(rules, sort_by='artist', descending=False, limit_value=None, limit_by='count'):
+    """
+    Compiles a smart playlist to one query returning (song_id, position).
+    The library joins are the same as the `playlist_tracks` view's; the
+    optional limit keeps songs (in sort order) until their count, total
+    duration (seconds) or total file size (bytes) reaches `limit_value`.
+    """
+    fields = dict(TEXT_FIELDS, **NUMBER_FIELDS)
+    if sort_by not in fields:
+        raise ValueError(f"sort_by must be one of {list(fields)}, not {sort_by}")
+    if limit_by not in LIMIT_BY:
+        raise ValueError(f"limit_by must be one of {list(LIMIT_BY)}, not {limit_by}")
+    where, values = compile_rule(rules)
+    direction = 'desc' if descending else 'asc'
+    order = f"{fields[sort_by]} {direction} nulls last, songs.song_id"
+    query = f"""
+    select
+        songs.song_id
+        ,row_number() over (order by {order}) - 1 position
+        ,sum({LIMIT_BY[limit_by]}) over (order by {order} rows unbounded preceding) running_total
+    from songs
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+        left join genres on genres.genre_id = songs.genre_id
+        left join lateral (
+            select file_nm, duration, bitrate, beats_per_min, file_size
+            from song_files
+            where song_files.song_id = songs.song_id
+            order by file_nm
+            limit 1
+        ) song_files on true
+    where {where}
+    """
+    if limit_value is None:
+        query = f"select song_id, position from ({query}) q"
+    else:
+        query = f"select song_id, position from ({query}) q where running_total <= %s"
+        values = values + [limit_value]
+    return query, values
+
+##############################################################################
+##                          Storage and evaluation                          ##
+##############################################################################
+
+def create_smart_playlist_tables(config):
+    """
+    Creates the tables smart playlists need, plus the indexes their queries
+    use:
+        smart_playlists: each playlist's rules, sort and limit, and the
+            library version its cached results were computed at
+        smart_playlist_songs: the cached results
+        library_version: a counter bumped (by statement-level triggers) on
+            every change to the library tables, so caches go stale on ingest
+    """
+    query = """
+    create table if not exists smart_playlists(
+        playlist_nm varchar not null,
+        rules jsonb not null,
+        sort_by varchar not null default 'artist',
+        descending boolean not null default false,
+        limit_value float,
+        limit_by varchar not null default 'count',
+        cached_version bigint,
+        primary key (playlist_nm)
+    );
+    create table if not exists smart_playlist_songs(
+        playlist_nm varchar not null,
+        song_id integer not null,
+        position integer not null,
+        primary key (playlist_nm, position),
+        foreign key (playlist_nm) references smart_playlists (playlist_nm)
+            on delete cascade on update cascade,
+        foreign key (song_id) references songs (song_id) on delete cascade
+    );
+    create table if not exists library_version(
+        version bigint not null
+    );
+    insert into library_version (version)
+    select 0 where not exists (select 1 from library_version);
+
+    create or replace function bump_library_version() returns trigger as $$
+    begin
+        update library_version set version = version + 1;
+        return null;
+    end;
+    $$ language plpgsql;
+
+    create index if not exists songs_artist_id on songs (artist_id);
+    create index if not exists songs_album_id on songs (album_id);
+    create index if not exists songs_genre_id on songs (genre_id);
+    create index if not exists song_files_song_id on song_files (song_id, file_nm);
+    create index if not exists artists_lower_artist_nm on artists (lower(artist_nm));
+    create index if not exists albums_lower_album_nm on albums (lower(album_nm));
+    create index if not exists genres_lower_genre_nm on genres (lower(genre_nm));
+    create index if not exists smart_playlist_songs_song_id on smart_playlist_songs (song_id);
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    tables = ['songs', 'song_files', 'artists', 'albums', 'genres', 'playlists', 'playlist_songs']
+    for table in tables:
+        cur.execute(f"""
+        drop trigger if exists {table}_bump_library_version on {table};
+        create trigger {table}_bump_library_version
+            after insert or update or delete or truncate on {table}
+            for each statement execute procedure bump_library_version();
+        """)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def save_smart_playlist(playlist_nm, rules, config, sort_by='artist', descending=False,
+                        limit_value=None, limit_by='count'):
+    """
+    Saves (or replaces) a smart playlist. The rules are compiled first, so
+    invalid ones are rejected before anything is written.
+    """
+    compile_smart_playlist(rules, sort_by, descending, limit_value, limit_by)
+    query = """
+    insert into smart_playlists
+        (playlist_nm, rules, sort_by, descending, limit_value, limit_by, cached_version)
+    values (%s, %s, %s, %s, %s, %s, null)
+    on conflict (playlist_nm) do update set
+        rules = excluded.rules
+        ,sort_by = excluded.sort_by
+        ,descending = excluded.descending
+        ,limit_value = excluded.limit_value
+        ,limit_by = excluded.limit_by
+        ,cached_version = null;
+    """
+    values = (playlist_nm, json.dumps(rules), sort_by, descending, limit_value, limit_by)
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query, values)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def delete_smart_playlist(playlist_nm, config):
+    """ Deletes a smart playlist (and its cached results). """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute("delete from smart_playlists where playlist_nm = %s", (playlist_nm,))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _refresh(cur, playlist_nm):
+    """
+    Recomputes a smart playlist's cached results if the library changed
+    since they were computed. Returns True if they were recomputed.
+    """
+    query = """
+    select rules, sort_by, descending, limit_value, limit_by, cached_version
+        ,(select version from library_version)
+    from smart_playlists
+    where playlist_nm = %s
+    for update;
+    """
+    cur.execute(query, (playlist_nm,))
+    row = cur.fetchone()
+    if row is None:
+        raise KeyError(f"smart playlist {playlist_nm} does not exist")
+    rules, sort_by, descending, limit_value, limit_by, cached_version, version = row
+    if cached_version == version:
+        return False
+    query, values = compile_smart_playlist(rules, sort_by, descending, limit_value, limit_by)
+    cur.execute("delete from smart_playlist_songs where playlist_nm = %s", (playlist_nm,))
+    cur.execute(
+        "insert into smart_playlist_songs (playlist_nm, song_id, position) "
+        f"select %s, song_id, position from ({query}) r",
+        [playlist_nm] + values
+    )
+    query = "update smart_playlists set cached_version = %s where playlist_nm = %s"
+    cur.execute(query, (version, playlist_nm))
+    return True
+
+def get_smart_playlist(playlist_nm, config):
+    """
+    Gets a smart playlist's songs in order, recomputing them first only if
+    the library changed since the last evaluation.
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    _refresh(cur, playlist_nm)
+    conn.commit()
+    cur.close()
+    conn.close()
+    query = """
+    select
+        smart_playlist_songs.position
+        ,songs.song_id
+        ,songs.song_nm
+        ,artists.artist_nm
+        ,albums.album_nm
+        ,genres.genre_nm
+    from smart_playlist_songs
+        join songs on songs.song_id = smart_playlist_songs.song_id
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+        left join genres on genres.genre_id = songs.genre_id
+    where smart_playlist_songs.playlist_nm = %s
+    order by smart_playlist_songs.position
+    """
+    return psql_to_df(query, config, (playlist_nm,))
+
+def list_smart_playlists(config):
+    """ Lists the smart playlists with their rules and cached song counts. """
+    query = """
+    select
+        smart_playlists.*
+        ,(smart_playlists.cached_version = library_version.version) is true up_to_date
+        ,(select count(*) from smart_playlist_songs s where s.playlist_nm = smart_playlists.playlist_nm) n_songs
+    from smart_playlists, library_version
+    order by playlist_nm
+    """
+    return psql_to_df(query, config)
+
+##############################################################################
+##                          Rhythmbox conversion                            ##
+##############################################################################
+
+RB_PROPS = {
+    'title': 'title',
+    'artist': 'artist',
+    'album': 'album',
+    'genre': 'genre',
+    'duration': 'duration',
+    'bitrate': 'bitrate',
+    'beats-per-minute': 'bpm',
+    'file-size': 'file_size',
+}
+RB_OPS = {
+    'equals': '=',
+    'not-equal': '!=',
+    'greater': '>',
+    'less': '<',
+    'like': 'contains',
+    'not-like': 'not_contains',
+    'prefix': 'starts_with',
+    'suffix': 'ends_with',
+}
+RB_SORT_KEYS = {
+    'Title': 'title',
+    'Artist': 'artist',
+    'Album': 'album',
+    'Genre': 'genre',
+    'Time': 'duration',
+    'Quality': 'bitrate',
+    'Beats': 'bpm',
+}
+
+def rules_from_rhythmbox(conjunction):
+    """
+    Converts a Rhythmbox `<conjunction>` element to a rule. Its criteria are
+    ANDed, `<disjunction/>` separates OR'd groups, and `<subquery>` nests.
+    Criteria on properties the database doesn't store (rating, play count,
+    dates, ...) raise ValueError.
+    """
+    groups = [[]]
+    for elem in conjunction:
+        if elem.tag == 'disjunction':
+            groups.append([])
+            continue
+        if elem.tag == 'subquery':
+            groups[-1].append(rules_from_rhythmbox(elem.find('conjunction')))
+            continue
+        prop = elem.get('prop', '')
+        # Every automatic playlist is restricted to songs, which is all the
+        # database holds anyway
+        if prop == 'type':
+            continue
+        prop = prop.replace('-folded', '').replace('-sort-key', '')
+        if prop not in RB_PROPS:
+            raise ValueError(f"Rhythmbox property {prop} isn't stored in the database")
+        if elem.tag not in RB_OPS:
+            raise ValueError(f"Rhythmbox criterion {elem.tag} isn't supported")
+        groups[-1].append([RB_PROPS[prop], RB_OPS[elem.tag], elem.text or ''])
+    groups = [{'all': g} if len(g) != 1 else g[0] for g in groups if len(g) > 0]
+    if len(groups) == 0:
+        return {'all': []}
+    return {'any': groups} if len(groups) > 1 else groups[0]
+
+def parse_smart_playlists(path):
+    """
+    Reads the automatic playlists in Rhythmbox's `playlists.xml` as keyword
+    arguments for `save_smart_playlist` (or the error for the ones that
+    can't be converted), keyed by playlist name.
+    """
+    playlists = dict()
+    for playlist in ET.parse(path).getroot():
+        conjunction = playlist.find('conjunction')
+        if conjunction is None:
+            continue
+        try:
+            rules = rules_from_rhythmbox(conjunction)
+        except ValueError as e:
+            playlists[playlist.get('name')] = e
+            continue
+        limit_value, limit_by = None, 'count'
+        if playlist.get('limit-count'):
+            limit_value = float(playlist.get('limit-count'))
+        elif playlist.get('limit-time'):
+            limit_value, limit_by = float(playlist.get('limit-time')), 'duration'
+        elif playlist.get('limit-size'):
+            # Rhythmbox's size limit is in MB
+            limit_value, limit_by = float(playlist.get('limit-size'))*1024*1024, 'file_size'
+        playlists[playlist.get('name')] = dict(
+            rules=rules,
+            sort_by=RB_SORT_KEYS.get(playlist.get('sort-key'), 'artist'),
+            descending=(playlist.get('sort-direction') == '1'),
+            limit_value=limit_value,
+            limit_by=limit_by,
+        )
+    return playlists
+
+def import_rhythmbox_smart_playlists(rb_dir, config):
+    """
+    Saves every Rhythmbox automatic playlist as a smart playlist. Returns
+    the playlists that couldn't be converted, mapped to the reason.
+    """
+    skipped = dict()
+    for playlist_nm, kwargs in parse_smart_playlists(rb_dir+'playlists.xml').items():
+        if isinstance(kwargs, ValueError):
+            skipped[playlist_nm] = str(kwargs)
+            continue
+        try:
+            save_smart_playlist(playlist_nm, config=config, **kwargs)
+        except ValueError as e:
+            # Converted, but the rules (or sorting/limit) don't compile
+            skipped[playlist_nm] = str(e)
+    return skipped
@@ -0,0 +1,116 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from util import psql_to_df
+
+# Every song with its artist/album/genre/file, one row per song file. Songs
+# without an album, genre or file are kept.
+LIBRARY_QUERY = """
+select
+    songs.song_id
+    ,songs.song_nm
+    ,artists.artist_id
+    ,artists.artist_nm
+    ,albums.album_id
+    ,albums.album_nm
+    ,genres.genre_id
+    ,genres.genre_nm
+    ,song_files.file_nm
+    ,song_files.bitrate
+    ,song_files.beats_per_min
+    ,song_files.duration
+    ,song_files.file_size
+from songs
+    join artists on artists.artist_id = songs.artist_id
+    left join albums on albums.album_id = songs.album_id
+    left join genres on genres.genre_id = songs.genre_id
+    left join song_files on song_files.song_id = songs.song_id
+order by songs.song_id
+"""
+
+PLAYLISTS_QUERY = """
+select
+    playlists.playlist_id
+    ,playlists.playlist_nm
+    ,playlist_songs.song_id
+    ,playlist_songs.playlist_order
+from playlists
+    join playlist_songs on playlist_songs.playlist_id = playlists.playlist_id
+order by playlists.playlist_id, playlist_songs.playlist_order
+"""
+
+# Integer ID columns that may be null after the left joins
+NULLABLE_INTS = ['album_id', 'genre_id', 'bitrate', 'duration', 'file_size']
+
+# Repeated names are stored once per distinct value
+DICTIONARY_COLUMNS = ['artist_nm', 'album_nm', 'genre_nm', 'playlist_nm']
+
+##############################################################################
+##                                 Export                                   ##
+##############################################################################
+
+def _to_arrow(df):
+    """
+    Converts a frame to an Arrow table with nullable integer columns and the
+    repeated name columns dictionary-encoded.
+    """
+    for col in NULLABLE_INTS:
+        if col in df.columns:
+            df[col] = df[col].astype('Int64')
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in DICTIONARY_COLUMNS:
+        if col in table.column_names:
+            i = table.column_names.index(col)
+            table = table.set_column(i, col, table.column(col).dictionary_encode())
+    return table
+
+def export_snapshot(config, snapshot_dir, fmt='arrow'):
+    """
+    Dumps the whole denormalized library to `snapshot_dir`, as `library` and
+    `playlists` tables. The default 'arrow' format (uncompressed Arrow IPC)
+    can be memory-mapped by `load_snapshot`; 'parquet' is smaller on disk but
+    has to be decoded on load. Returns the paths written.
+    """
+    if fmt not in ['arrow', 'parquet']:
+        raise ValueError(f"fmt must be 'arrow' or 'parquet', not {fmt}")
+    os.makedirs(snapshot_dir, exist_ok=True)
+    paths = list()
+    for name, query in [('library', LIBRARY_QUERY), ('playlists', PLAYLISTS_QUERY)]:
+        table = _to_arrow(psql_to_df(query, config))
+        path = os.path.join(snapshot_dir, f'{name}.{fmt}')
+        tmp_path = path + '.tmp'
+        if fmt == 'arrow':
+            with pa.OSFile(tmp_path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            pq.write_table(table, tmp_path, use_dictionary=True)
+        # Swap in atomically so readers never see a half-written snapshot
+        os.replace(tmp_path, path)
+        paths.append(path)
+    return paths
+
+##############################################################################
+##                                  Load                                    ##
+##############################################################################
+
+def load_snapshot(snapshot_dir, as_pandas=True):
+    """
+    Loads a snapshot written by `export_snapshot` without touching the
+    database. Arrow files are memory-mapped, so loading is nearly free and
+    pages are only read when used. Returns a dictionary of dataframes (or
+    Arrow tables, if `as_pandas` is False) keyed by 'library'/'playlists';
+    dictionary columns become pandas categoricals.
+    """
+    tables = dict()
+    for name in ['library', 'playlists']:
+        path = os.path.join(snapshot_dir, f'{name}.arrow')
+        if os.path.exists(path):
+            source = pa.memory_map(path, 'r')
+            table = pa.ipc.open_file(source).read_all()
+        else:
+            table = pq.read_table(os.path.join(snapshot_dir, f'{name}.parquet'))
+        if as_pandas:
+            table = table.to_pandas()
+        tables[name] = table
+    return tables
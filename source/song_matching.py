@@ -0,0 +1,220 @@
+import re
+import unicodedata
+from difflib import SequenceMatcher
+import pandas as pd
+from psycopg2.extras import execute_values
+from util import (
+    connect,
+    psql_to_df,
+)
+from playlist_order import sort_key
+
+# Confidence given to exact matches on the normalized names: with the album,
+# and without it (same title/artist, album missing or different)
+EXACT_CONFIDENCE = 1.0
+EXACT_NO_ALBUM_CONFIDENCE = 0.95
+# Weights of the title/artist/album similarity in a fuzzy match's score
+WEIGHTS = dict(title=0.6, artist=0.3, album=0.1)
+
+##############################################################################
+##                              Normalizing                                 ##
+##############################################################################
+
+# Version/featuring notes that differ between services for the same track.
+# A ' - ' suffix is only a note if it's the last segment and made up of
+# qualifiers/years ('2011 Remaster', 'Single Version') or is 'Live at ...',
+# so 'Song - Live Forever' keeps its second half.
+_QUALIFIER = r"(?:remaster(?:ed)?|version|edit|mono|stereo|live|single|radio|album|original|digital|edition|\d{4})"
+_EXTRA = re.compile(
+    r"[\(\[][^\)\]]*\b(?:feat|ft|featuring|remaster(?:ed)?|version|edit|mono|stereo|live)\b[^\)\]]*[\)\]]"
+    rf"|\s-\s{_QUALIFIER}(?:\s{_QUALIFIER})*\s*$"
+    r"|\s-\slive\s(?:at|in|from|on)\s(?:(?!\s-\s).)*$"
+    r"|\s(?:feat|ft|featuring)\.?\s.*$"
+)
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+def normalize_name(name):
+    """
+    Matching form of a title/artist/album name: the `sort_key` form
+    (lowercase, no leading 'the '), without accents, version/featuring
+    notes and punctuation, and with '&' spelled out.
+    """
+    s = name or ''
+    if not s.isascii():
+        s = unicodedata.normalize('NFKD', s)
+        s = ''.join(c for c in s if not unicodedata.combining(c))
+    s = _EXTRA.sub('', s.lower())
+    s = s.replace('&', ' and ')
+    s = _PUNCTUATION.sub('', s)
+    s = _SPACES.sub(' ', s).strip()
+    return sort_key(s)
+
+def normalize_frame(df):
+    """ Adds normalized `title`, `artist` and `album` columns (`*_key`). """
+    df = df.copy()
+    for col in ['title', 'artist', 'album']:
+        # Artists and albums repeat a lot, so each distinct name is done once
+        names = df[col].astype(object).where(df[col].notna(), '').astype(str)
+        unique = names.unique()
+        df[col+'_key'] = names.map(dict(zip(unique, map(normalize_name, unique))))
+    return df
+
+##############################################################################
+##                                Matching                                  ##
+##############################################################################
+
+def _similarity(a, b):
+    if a == b:
+        return 1.0
+    if (len(a) == 0) or (len(b) == 0):
+        return 0.0
+    return SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+def _exact_matches(local, remote):
+    """
+    Hash join on the normalized title and artist. When a title/artist has
+    several candidates, the ones whose album also matches are paired first.
+    Returns (song_id, google_id, confidence) rows.
+    """
+    pairs = pd.merge(
+        local[['song_id','title_key','artist_key','album_key']],
+        remote[['google_id','title_key','artist_key','album_key']],
+        on=['title_key','artist_key'],
+        suffixes=('_local','_remote'),
+    )
+    same_album = (pairs.album_key_local == pairs.album_key_remote) & (pairs.album_key_local != '')
+    pairs['confidence'] = same_album.map({True: EXACT_CONFIDENCE, False: EXACT_NO_ALBUM_CONFIDENCE})
+    return pairs[['song_id','google_id','confidence']]
+
+def _candidate_pairs(local, remote, prefix=4):
+    """
+    Blocking: only pairs that share the start of the artist (and first
+    letter of the title), or the start of the title (and first letter of
+    the artist), are scored, so a misspelling in one of them still finds
+    its match without comparing every pair.
+    """
+    blocks = list()
+    for a, b in [('artist_key','title_key'), ('title_key','artist_key')]:
+        keys = [
+            df[a].str[:prefix].str.replace(' ', '') + '|' + df[b].str[:1]
+            for df in [local, remote]
+        ]
+        blocks.append(pd.merge(
+            pd.DataFrame(dict(block=keys[0], local_idx=local.index)),
+            pd.DataFrame(dict(block=keys[1], remote_idx=remote.index)),
+            on='block',
+        )[['local_idx','remote_idx']])
+    return pd.concat(blocks).drop_duplicates()
+
+def _fuzzy_matches(local, remote, min_score):
+    """ Scores the blocked candidate pairs; returns those above `min_score`. """
+    if (len(local) == 0) or (len(remote) == 0):
+        return pd.DataFrame(columns=['song_id','google_id','confidence'])
+    candidates = _candidate_pairs(local, remote)
+    cols = ['title_key', 'artist_key', 'album_key']
+    l_keys = local.reindex(columns=['song_id']+cols).to_dict('index')
+    r_keys = remote.reindex(columns=['google_id']+cols).to_dict('index')
+    rows = list()
+    for i, j in zip(candidates.local_idx, candidates.remote_idx):
+        l, r = l_keys[i], r_keys[j]
+        score = (
+            WEIGHTS['title']*_similarity(l['title_key'], r['title_key'])
+            + WEIGHTS['artist']*_similarity(l['artist_key'], r['artist_key'])
+        )
+        # Cheap bound before comparing albums: skip pairs that can't make it
+        if score + WEIGHTS['album'] < min_score:
+            continue
+        score += WEIGHTS['album']*_similarity(l['album_key'], r['album_key'])
+        if score >= min_score:
+            rows.append((l['song_id'], r['google_id'], round(score, 4)))
+    return pd.DataFrame(rows, columns=['song_id','google_id','confidence'])
+
+def _one_to_one(pairs):
+    """ Greedily keeps the best-scoring pairs so each side is used once. """
+    pairs = pairs.sort_values(['confidence','song_id','google_id'], ascending=[False,True,True])
+    used_local, used_remote, keep = set(), set(), list()
+    for s, g, c in zip(pairs.song_id, pairs.google_id, pairs.confidence):
+        if (s in used_local) or (g in used_remote):
+            continue
+        used_local.add(s)
+        used_remote.add(g)
+        keep.append((s, g, c))
+    return pd.DataFrame(keep, columns=['song_id','google_id','confidence'])
+
+def match_songs(local_df, remote_df, min_score=0.85):
+    """
+    Matches local songs (song_id, title, artist, album) to Google tracks
+    (google_id, title, artist, album). Exact matches on the normalized
+    names are found with a hash join; only what's left is fuzzy matched,
+    within blocks. Each song and track is used at most once. Returns
+    (song_id, google_id, confidence, method) rows.
+    """
+    local = normalize_frame(local_df).reset_index(drop=True)
+    remote = normalize_frame(remote_df).reset_index(drop=True)
+    exact = _one_to_one(_exact_matches(local, remote))
+    exact['method'] = 'exact'
+    local = local[~local.song_id.isin(exact.song_id)]
+    remote = remote[~remote.google_id.isin(exact.google_id)]
+    fuzzy = _one_to_one(_fuzzy_matches(local, remote, min_score))
+    fuzzy['method'] = 'fuzzy'
+    return pd.concat([exact, fuzzy], ignore_index=True)
+
+##############################################################################
+##                               Database                                   ##
+##############################################################################
+
+def get_local_songs(config, unlinked_only=True):
+    """ Songs with their title/artist/album, optionally only unlinked ones. """
+    query = """
+    select
+        songs.song_id
+        ,songs.song_nm title
+        ,artists.artist_nm artist
+        ,albums.album_nm album
+    from songs
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+    """
+    if unlinked_only:
+        query += """
+        where not exists (
+            select 1 from google_song_map where google_song_map.song_id = songs.song_id
+        )
+        """
+    return psql_to_df(query, config, cache=False)
+
+def save_matches(matches, config):
+    """ Upserts matched (song_id, google_id, confidence) into `google_song_map`. """
+    if len(matches) == 0:
+        return 0
+    query = """
+    insert into google_song_map (song_id, google_id, confidence)
+    values %s
+    on conflict (song_id) do update set
+        google_id = excluded.google_id
+        ,confidence = excluded.confidence;
+    """
+    rows = [(int(s), g, float(c)) for s, g, c in zip(matches.song_id, matches.google_id, matches.confidence)]
+    conn = connect(config)
+    cur = conn.cursor()
+    execute_values(cur, query, rows, page_size=len(rows))
+    conn.commit()
+    cur.close()
+    conn.close()
+    return len(rows)
+
+def link_library(library_df, config, min_score=0.85, dry_run=False):
+    """
+    Links the Google library (`library_df`, as from
+    `sort_playlist.get_all_songs`) to the database. Songs and tracks that are
+    already linked are left alone. Returns the new matches.
+    """
+    local_df = get_local_songs(config)
+    linked = psql_to_df("select google_id from google_song_map", config, cache=False)
+    remote_df = library_df.rename(columns={'song_id': 'google_id'})
+    remote_df = remote_df[~remote_df.google_id.isin(linked.google_id)]
+    matches = match_songs(local_df, remote_df, min_score)
+    if not dry_run:
+        save_matches(matches, config)
+    return matches
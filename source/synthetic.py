@@ -0,0 +1,188 @@
+import os
+import struct
+import random
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+import mutagen
+from mutagen.easyid3 import EasyID3
+
+# One MPEG-1 Layer III frame: 128 kbps, 44.1 kHz, no padding (417 bytes,
+# 1152 samples). A run of silent frames is a valid MP3 that mutagen can read.
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00'*413
+MP3_FRAME_SECONDS = 1152 / 44100
+
+SYLLABLES = [
+    'ka', 'lo', 'mi', 'ra', 'zen', 'tor', 'vel', 'sha', 'du', 'bex',
+    'no', 'qui', 'fa', 'lux', 'ster', 'mo', 'ri', 'pan', 'gle', 'tha',
+]
+
+GENRES = [
+    'Rock', 'Hip Hop', 'Funk', 'Reggae', 'Jazz', 'Blues', 'Electronic',
+    'Classical', 'Pop', 'Metal', 'Soul', 'Country', 'Folk', 'Punk',
+    # Near-duplicates, like the ones in the real library
+    'rock', 'Hip-Hop', 'Electronica', 'Reggea',
+]
+
+##############################################################################
+##                              Audio files                                 ##
+##############################################################################
+
+def _atom(name, payload=b''):
+    return struct.pack('>I4s', 8+len(payload), name) + payload
+
+def _full_atom(name, payload):
+    return _atom(name, b'\x00\x00\x00\x00' + payload)
+
+def make_mp3(path, tags, seconds=0.2):
+    """ Writes a small silent MP3 with ID3 tags (easy tag names). """
+    n_frames = max(1, int(seconds / MP3_FRAME_SECONDS))
+    with open(path, 'wb') as fp:
+        fp.write(MP3_FRAME * n_frames)
+    id3 = EasyID3()
+    for k, v in tags.items():
+        id3[k] = v
+    id3.save(path)
+    return None
+
+def make_m4a(path, tags, seconds=0.2):
+    """
+    Writes a minimal M4A container (ftyp, a moov with one sound track and an
+    empty mdat) with iTunes-style tags. It has no real audio, but mutagen
+    reads its length and tags like any other M4A.
+    """
+    timescale = 44100
+    duration = int(seconds * timescale)
+    matrix = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+    mvhd = _full_atom(b'mvhd',
+        struct.pack('>IIII', 0, 0, timescale, duration)
+        + struct.pack('>IH', 0x10000, 0x100) + b'\x00'*10 + matrix
+        + b'\x00'*24 + struct.pack('>I', 2)
+    )
+    mdhd = _full_atom(b'mdhd', struct.pack('>IIIIHH', 0, 0, timescale, duration, 0x55c4, 0))
+    hdlr = _full_atom(b'hdlr', struct.pack('>I4s', 0, b'soun') + b'\x00'*13)
+    stbl = _atom(b'stbl', _full_atom(b'stsd', struct.pack('>I', 0)))
+    trak = _atom(b'trak', _atom(b'mdia', mdhd + hdlr + _atom(b'minf', stbl)))
+    ftyp = _atom(b'ftyp', b'M4A ' + struct.pack('>I', 0) + b'M4A isommp42')
+    with open(path, 'wb') as fp:
+        fp.write(ftyp + _atom(b'moov', mvhd + trak) + _atom(b'mdat', b'\x00'*1024))
+    file = mutagen.File(path, easy=True)
+    file.add_tags()
+    for k, v in tags.items():
+        file[k] = v
+    file.save()
+    return None
+
+##############################################################################
+##                              Library layout                              ##
+##############################################################################
+
+def _name(rng, n_syllables):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(n_syllables)).capitalize()
+
+def _zipf_choice(rng, items, s=1.1):
+    """ Picks items with a Zipf-like skew, so a few artists have most songs. """
+    weights = [1 / (i+1)**s for i in range(len(items))]
+    return lambda: rng.choices(items, weights)[0]
+
+def plan_library(n_songs, seed=0, m4a_fraction=0.2, n_playlists=None):
+    """
+    Plans a synthetic library (without writing anything): a list of song dicts
+    and a dictionary of playlist name -> list of song indices. Artist sizes are
+    skewed, some songs have no album/genre, and some names differ only by case
+    or have odd characters, like a real library.
+    """
+    rng = random.Random(seed)
+    n_artists = max(1, n_songs // 10)
+    artists = list(dict.fromkeys(
+        ('The ' if rng.random() < 0.1 else '') + _name(rng, rng.randint(1, 3)) + ' ' + _name(rng, 2)
+        for _ in range(n_artists)
+    ))
+    pick_artist = _zipf_choice(rng, artists)
+    albums = dict()
+    songs = list()
+    for i in range(n_songs):
+        artist = pick_artist()
+        if artist not in albums:
+            albums[artist] = [_name(rng, 3) for _ in range(rng.randint(1, 4))]
+        title = ' '.join(_name(rng, rng.randint(1, 3)) for _ in range(rng.randint(1, 4)))
+        if rng.random() < 0.02:
+            title += " (Live) & 'Friends' #" + str(i)
+        ext = '.m4a' if rng.random() < m4a_fraction else '.mp3'
+        songs.append(dict(
+            title=title,
+            artist=artist,
+            album=rng.choice(albums[artist]) if rng.random() < 0.9 else None,
+            genre=rng.choice(GENRES) if rng.random() < 0.95 else None,
+            file_nm=f'{artist} - {title} {i}{ext}'.replace('/', '-'),
+            duration=rng.randint(90, 420),
+            bitrate=rng.choice([128, 192, 256, 320]),
+            play_count=int(rng.expovariate(0.2)),
+        ))
+    n_playlists = n_playlists or max(2, n_songs // 200)
+    playlists = dict()
+    for j in range(n_playlists):
+        size = min(n_songs, int(rng.paretovariate(1.2) * 20))
+        playlists[f'Playlist {j} {_name(rng, 2)}'] = rng.sample(range(n_songs), size)
+    return songs, playlists
+
+def _location(music_dir, file_nm):
+    return 'file://' + quote(music_dir + file_nm)
+
+def write_rhythmbox_xml(rb_dir, music_dir, songs, playlists):
+    """ Writes `rhythmdb.xml`/`playlists.xml` matching the planned library. """
+    os.makedirs(rb_dir, exist_ok=True)
+    with open(os.path.join(rb_dir, 'rhythmdb.xml'), 'w') as fp:
+        fp.write('<?xml version="1.0" standalone="yes"?>\n<rhythmdb version="2.0">\n')
+        for song in songs:
+            fields = [
+                ('title', song['title']),
+                ('genre', song['genre']),
+                ('artist', song['artist']),
+                ('album', song['album']),
+                ('duration', song['duration']),
+                ('location', _location(music_dir, song['file_nm'])),
+                ('bitrate', song['bitrate']),
+                ('play-count', song['play_count']),
+                ('media-type', 'audio/mpeg'),
+            ]
+            fp.write('  <entry type="song">\n')
+            for tag, value in fields:
+                if value is not None:
+                    fp.write(f'    <{tag}>{escape(str(value))}</{tag}>\n')
+            fp.write('  </entry>\n')
+        fp.write('</rhythmdb>\n')
+    with open(os.path.join(rb_dir, 'playlists.xml'), 'w') as fp:
+        fp.write('<?xml version="1.0"?>\n<rhythmdb-playlists>\n')
+        for name, idx in playlists.items():
+            fp.write(
+                f'  <playlist name="{escape(name)}" show-browser="true" '
+                'browser-position="180" search-type="search-match" type="static">\n'
+            )
+            for i in idx:
+                fp.write(f'    <location>{escape(_location(music_dir, songs[i]["file_nm"]))}</location>\n')
+            fp.write('  </playlist>\n')
+        fp.write('</rhythmdb-playlists>\n')
+    return None
+
+def generate_library(out_dir, n_songs, seed=0, m4a_fraction=0.2, n_playlists=None, seconds=0.2):
+    """
+    Generates a synthetic library under `out_dir`: a `music/` directory of small
+    tagged MP3/M4A files and a `rhythmbox/` directory with matching
+    `rhythmdb.xml`/`playlists.xml`. Existing files are kept, so regenerating
+    the same size is cheap. Returns (music_dir, rb_dir), both ending in '/'.
+    """
+    music_dir = os.path.join(os.path.abspath(out_dir), 'music') + '/'
+    rb_dir = os.path.join(os.path.abspath(out_dir), 'rhythmbox') + '/'
+    os.makedirs(music_dir, exist_ok=True)
+    songs, playlists = plan_library(n_songs, seed, m4a_fraction, n_playlists)
+    for song in songs:
+        path = music_dir + song['file_nm']
+        if os.path.exists(path):
+            continue
+        tags = {k: song[k] for k in ['title', 'artist', 'album', 'genre'] if song[k] is not None}
+        if path.endswith('.m4a'):
+            make_m4a(path, tags, seconds)
+        else:
+            make_mp3(path, tags, seconds)
+    write_rhythmbox_xml(rb_dir, music_dir, songs, playlists)
+    return music_dir, rb_dir
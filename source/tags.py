@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from psycopg2.extras import execute_values
+import mutagen
+from mutagen.id3 import ID3
+from mutagen.wave import WAVE
+from mutagen.aiff import AIFF
+from util import (
+    connect,
+    psql_to_df,
+)
+
+# Database columns and the (format-independent) tag each one is written to.
+# Mutagen's "easy" interface maps these to ID3 frames for MP3 and to atoms
+# for M4A, so the same names work for both.
+TAG_FIELDS = {
+    'song_nm': 'title',
+    'artist_nm': 'artist',
+    'album_nm': 'album',
+    'genre_nm': 'genre',
+}
+# Formats mutagen has no easy interface for: their ID3 tags only take frame
+# objects, so their files are reported as errors instead of read/written
+NO_EASY_TAGS = (WAVE, AIFF)
+
+##############################################################################
+##                              Reading tags                                ##
+##############################################################################
+
+def _open_easy(path):
+    """ Opens a file with easy tags; raises ValueError if it has none. """
+    file = mutagen.File(path, easy=True)
+    if file is None:
+        raise ValueError(f"{path} is not a recognized audio file")
+    if isinstance(file, NO_EASY_TAGS) or isinstance(file.tags, ID3):
+        raise ValueError(f"{path}: {type(file).__name__} tags aren't supported")
+    return file
+
+def read_tags(path):
+    """
+    Reads the title/artist/album/genre tags of a file, keyed by database
+    column name. Missing tags are None.
+    """
+    file = _open_easy(path)
+    tags = file.tags or dict()
+    return {col: (tags.get(tag) or [None])[0] for col, tag in TAG_FIELDS.items()}
+
+def get_db_tags(config, song_ids=None):
+    """ Gets the tag fields of every song file (optionally only some songs). """
+    query = """
+    select
+        songs.song_id
+        ,song_files.file_nm
+        ,songs.song_nm
+        ,artists.artist_nm
+        ,albums.album_nm
+        ,genres.genre_nm
+    from songs
+        join song_files on song_files.song_id = songs.song_id
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+        left join genres on genres.genre_id = songs.genre_id
+    """
+    values = None
+    if song_ids is not None:
+        query += " where songs.song_id = any(%s)"
+        values = ([int(s) for s in song_ids],)
+    df = psql_to_df(query, config, values)
+    return df.astype(object).where(df.notna(), None)
+
+def find_tag_drift(config, music_dir, song_ids=None, workers=8):
+    """
+    Compares the database fields with the tags in each file, reading files in
+    a thread pool. Returns one row per file whose tags differ, with the
+    database values and a dictionary of the differing fields.
+    """
+    db_df = get_db_tags(config, song_ids)
+    def compare(row):
+        path = music_dir+row['file_nm']
+        try:
+            file_tags = read_tags(path)
+        except Exception as e:
+            # One unreadable file mustn't stop the others
+            return dict(row, diff=None, error=str(e))
+        diff = {
+            col: (file_tags[col], row[col]) for col in TAG_FIELDS
+            if (row[col] is not None) and (file_tags[col] != row[col])
+        }
+        return dict(row, diff=diff, error=None)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(compare, db_df.to_dict('records')))
+    rows = [r for r in rows if (r['error'] is not None) or (len(r['diff']) > 0)]
+    return pd.DataFrame(rows, columns=list(db_df.columns)+['diff','error'])
+
+##############################################################################
+##                              Writing tags                                ##
+##############################################################################
+
+def write_tags(path, fields):
+    """
+    Writes tag fields (keyed by database column name) to a file atomically:
+    the tags are written to a copy in the same directory, which then replaces
+    the original, so a crash never leaves a half-written file behind.
+    """
+    _open_easy(path)
+    dir_nm, base_nm = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.'+base_nm, suffix='.tmp', dir=dir_nm)
+    os.close(fd)
+    try:
+        shutil.copy2(path, tmp_path)
+        file = mutagen.File(tmp_path, easy=True)
+        if file.tags is None:
+            file.add_tags()
+        for col, value in fields.items():
+            file[TAG_FIELDS[col]] = value
+        file.save()
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+def write_back_tags(config, music_dir, song_ids=None, workers=8, dry_run=False):
+    """
+    Writes the database's title/artist/album/genre into the tags of every file
+    that's out of sync (optionally only for some songs), in a thread pool.
+    Files already in sync are skipped. The new file sizes are saved back to
+    `song_files` in one batched update. Returns the drift report with a
+    'status' column ('written', 'dry_run' or the error message).
+    """
+    drift = find_tag_drift(config, music_dir, song_ids, workers)
+    todo = drift[drift.error.isna()]
+    def write(row):
+        fields = {col: new for col, (_, new) in row['diff'].items()}
+        try:
+            return 'written', write_tags(music_dir+row['file_nm'], fields)
+        except Exception as e:
+            # Reported per file, so the sizes of the files written still get saved
+            return str(e), None
+    if dry_run or (len(todo) == 0):
+        results = [('dry_run', None)]*len(todo)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(write, todo.to_dict('records')))
+    drift['status'] = drift.error
+    drift.loc[todo.index, 'status'] = [status for status, _ in results]
+    sizes = [
+        (size, row.file_nm) for (status, size), row in zip(results, todo.itertuples())
+        if status == 'written'
+    ]
+    if len(sizes) > 0:
+        query = """
+        update song_files
+        set file_size = v.file_size
+        from (values %s) v (file_size, file_nm)
+        where song_files.file_nm = v.file_nm;
+        """
+        conn = connect(config)
+        cur = conn.cursor()
+        execute_values(cur, query, sizes)
+        conn.commit()
+        cur.close()
+        conn.close()
+    return drift
@@ -1,27 +1,574 @@
 import psycopg2 as pg
+import psycopg2.extensions
 import pandas as pd
 import glob
 import os
 import re
-import mutagen
+import json
+import sqlite3
+import time
+import threading
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+
+##############################################################################
+##                           Query instrumentation                          ##
+##############################################################################
+
+class QueryBudgetExceeded(AssertionError):
+    """ Raised when an operation makes more queries/connections than allowed. """
+
+# Query logs currently recording; every statement run through `connect` is
+# appended to each of them.
+_active_logs = list()
+_active_lock = threading.Lock()
+_connection_ids = itertools.count()
+
+def normalize_sql(query):
+    """
+    Reduces a statement to its "shape": literals replaced with `?`, value
+    lists collapsed and whitespace squashed, so repeats of the same statement
+    with different values group together.
+    """
+    query = re.sub(r"'(?:[^']|'')*'", '?', query)
+    query = re.sub(r"\b\d+(?:\.\d+)?\b", '?', query)
+    query = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*", '(...)', query)
+    query = re.sub(r"\s+", ' ', query).strip().lower()
+    return query
+
+class QueryLog:
+    """
+    Record of every statement run during a logical operation: its SQL shape,
+    duration, row count and the connection it ran on.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.records = list()
+        self.connections = 0
+        self.elapsed = 0.0
+
+    def _record(self, query, duration, rows, conn_id):
+        self.records.append(dict(
+            sql=normalize_sql(query),
+            duration=duration,
+            rows=rows,
+            conn_id=conn_id,
+        ))
+
+    @property
+    def queries(self):
+        return len(self.records)
+
+    def summary(self):
+        """ Per-shape counts, total/mean latency (ms) and rows, busiest first. """
+        df = pd.DataFrame(self.records, columns=['sql','duration','rows','conn_id'])
+        df['ms'] = df.duration * 1000
+        summary = df.groupby('sql').agg(
+            count=('ms', 'size'),
+            total_ms=('ms', 'sum'),
+            mean_ms=('ms', 'mean'),
+            rows=('rows', 'sum'),
+            connections=('conn_id', 'nunique'),
+        )
+        return summary.sort_values(['count', 'total_ms'], ascending=False)
+
+    def repeated(self, threshold=5):
+        """
+        Statement shapes run at least `threshold` times, which usually means a
+        per-item query inside a loop (the N+1 pattern).
+        """
+        counts = dict()
+        for r in self.records:
+            counts[r['sql']] = counts.get(r['sql'], 0) + 1
+        return {sql: n for sql, n in counts.items() if n >= threshold}
+
+    def check_budget(self, max_queries=None, max_connections=None, max_repeats=None):
+        """ Raises QueryBudgetExceeded if the operation went over budget. """
+        problems = list()
+        if (max_queries is not None) and (self.queries > max_queries):
+            problems.append(f"{self.queries} queries (budget {max_queries})")
+        if (max_connections is not None) and (self.connections > max_connections):
+            problems.append(f"{self.connections} connections (budget {max_connections})")
+        if max_repeats is not None:
+            for sql, n in self.repeated(max_repeats+1).items():
+                problems.append(f"{n} repeats of `{sql[:80]}` (budget {max_repeats})")
+        if len(problems) > 0:
+            name = self.name or 'operation'
+            raise QueryBudgetExceeded(f"{name} exceeded its query budget: " + '; '.join(problems))
+        return None
+
+    def __repr__(self):
+        name = f"{self.name!r}, " if self.name else ''
+        return (
+            f"QueryLog({name}{self.queries} queries, {self.connections} connections, "
+            f"{self.elapsed*1000:.1f} ms)"
+        )
+
+@contextmanager
+def track_queries(name=None, max_queries=None, max_connections=None, max_repeats=None):
+    """
+    Records every statement run (from any helper) inside the `with` block:
+
+        with track_queries('add song', max_connections=1) as log:
+            add_new_song_to_db(song_config, config)
+        log.summary()
+
+    If any budget is given and exceeded, QueryBudgetExceeded is raised when the
+    block exits, so tests can pin down how many round-trips an operation makes.
+    """
+    log = QueryLog(name)
+    with _active_lock:
+        _active_logs.append(log)
+    start = time.perf_counter()
+    try:
+        yield log
+    finally:
+        log.elapsed = time.perf_counter() - start
+        with _active_lock:
+            _active_logs.remove(log)
+    log.check_budget(max_queries, max_connections, max_repeats)
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    """
+    Connection with a serial number, so logs can tell connections apart. It
+    also remembers which tables it wrote to, so their cached query results
+    can be dropped again once the writes are committed.
+    """
+    log_id = None
+    cache_scope = None
+    written_tables = None
+
+    def commit(self):
+        super().commit()
+        if self.written_tables:
+            query_cache.invalidate(self.written_tables, self.cache_scope)
+            self.written_tables = set()
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """
+    Cursor that reports its statements to any active QueryLog, and drops
+    cached results for the tables its statements write to.
+    """
+
+    def execute(self, query, vars=None):
+        self._note_writes(query)
+        if len(_active_logs) == 0:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._log(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        self._note_writes(query)
+        if len(_active_logs) == 0:
+            return super().executemany(query, vars_list)
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._log(query, time.perf_counter() - start)
+
+    def _text(self, query):
+        if isinstance(query, bytes):
+            return query.decode(self.connection.encoding, 'replace')
+        if not isinstance(query, str):
+            return query.as_string(self)
+        return query
+
+    def _note_writes(self, query):
+        if not query_cache.enabled:
+            return None
+        tables = written_tables(self._text(query))
+        if len(tables) > 0:
+            conn = self.connection
+            conn.written_tables = (conn.written_tables or set()) | tables
+            # Dropped now too, so nothing caches the old rows in the meantime
+            query_cache.invalidate(tables, conn.cache_scope)
+        return None
+
+    def _log(self, query, duration):
+        query = self._text(query)
+        for log in list(_active_logs):
+            log._record(query, duration, self.rowcount, self.connection.log_id)
+
+def connect(config):
+    """
+    Opens a database connection whose cursors are instrumented. All helpers
+    connect through here so `track_queries` sees every statement.
+    """
+    conn = pg.connect(
+        connection_factory=InstrumentedConnection,
+        cursor_factory=InstrumentedCursor,
+        **config
+    )
+    conn.log_id = next(_connection_ids)
+    conn.cache_scope = cache_scope(config)
+    for log in list(_active_logs):
+        log.connections += 1
+    return conn
+
+##############################################################################
+##                           Query result cache                             ##
+##############################################################################
+
+# Tables whose rows can change as a side effect of writing to another one
+# (cascading foreign keys and the `library_version` triggers), so dropping
+# cached results for a table drops them for these too.
+CACHE_DEPENDENTS = {
+    'songs': [
+        'song_files', 'smart_playlist_songs', 'plays', 'song_play_counts',
+        'google_song_map', 'song_fingerprints', 'library_version',
+    ],
+    'artists': ['artist_play_counts', 'library_version'],
+    'albums': ['library_version'],
+    'genres': ['library_version'],
+    'song_files': ['library_version'],
+    'playlists': ['library_version'],
+    'playlist_songs': ['library_version'],
+    'smart_playlists': ['smart_playlist_songs'],
+}
+
+def _strip_literals(query):
+    return re.sub(r"'(?:[^']|'')*'", "''", query.lower())
+
+# Words that can follow a table name in a `from` list, so they aren't aliases
+_CLAUSE_WORDS = {
+    'join', 'left', 'right', 'inner', 'outer', 'full', 'cross', 'natural', 'lateral',
+    'on', 'using', 'where', 'group', 'order', 'having', 'window', 'limit', 'offset',
+    'fetch', 'for', 'union', 'intersect', 'except', 'returning', 'set', 'tablesample',
+}
+_FROM = re.compile(r"\b(?:from|join)\s+(?:(?:lateral|only)\s+)?")
+_NAME = re.compile(r"\s*([a-z_][\w.]*)(\s*\()?")
+_ALIAS = re.compile(r"\s+(?:as\s+)?([a-z_]\w*)")
+_COMMA = re.compile(r"\s*,")
+
+def read_tables(query):
+    """
+    Tables (and views) a query reads from: the names after `from`/`join`,
+    and the rest of a comma-separated `from` list. Schemas are dropped, and
+    names of CTEs are included (which only means extra invalidations).
+    """
+    query = _strip_literals(query)
+    tables = set()
+    for match in _FROM.finditer(query):
+        pos = match.end()
+        while True:
+            name = _NAME.match(query, pos)
+            # Subqueries, functions (`generate_series(...)`, `extract(... from now())`)
+            if (name is None) or (name.group(2) is not None) or (name.group(1) in _CLAUSE_WORDS):
+                break
+            tables.add(name.group(1).split('.')[-1])
+            pos = name.end()
+            alias = _ALIAS.match(query, pos)
+            if (alias is not None) and (alias.group(1) not in _CLAUSE_WORDS):
+                pos = alias.end()
+            comma = _COMMA.match(query, pos)
+            if comma is None:
+                break
+            pos = comma.end()
+    return tables
+
+def written_tables(query):
+    """ Tables a statement writes to (inserts, updates, deletes, DDL, view refreshes). """
+    query = re.sub(r"\s+", ' ', _strip_literals(query))
+    # `on conflict ... do update` and `for [no key] update` locks aren't writes of their own
+    pattern = (
+        r"\b(?:insert\s+into|(?<!do )(?<!for )(?<!key )update|delete\s+from|truncate(?:\s+table)?"
+        r"|refresh\s+materialized\s+view(?:\s+concurrently)?"
+        r"|(?:alter|drop)\s+(?:table|materialized\s+view)(?:\s+if\s+exists)?)"
+        r"\s+(?:only\s+)?([a-z_][\w.]*)"
+    )
+    return {t.split('.')[-1] for t in re.findall(pattern, query)}
+
+def cache_scope(config):
+    """ Identifies the database a config points at, so caches don't mix databases. """
+    return tuple(str(config.get(k)) for k in ['host', 'port', 'dbname', 'user'])
+
+class QueryCache:
+    """
+    LRU cache of `psql_to_df` results, keyed by database, SQL (whitespace
+    normalized) and values. Entries expire after `ttl` seconds, and the
+    least recently used are evicted past `max_entries` or `max_bytes`.
+    Every statement that writes to a table drops the entries that read from
+    it (see `InstrumentedCursor`), so results are only stale when something
+    outside this process changes the database, and then for at most `ttl`.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=256*1024**2, ttl=60.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = True
+        self.nbytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, expirations=0, invalidations=0)
+        self.shapes = dict()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def key(self, query, values, scope):
+        return (scope, re.sub(r"\s+", ' ', query).strip(), repr(values))
+
+    def get(self, key):
+        """ Returns a copy of a cached result (or None), updating the stats. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None) and (time.monotonic() - entry['created'] > self.ttl):
+                self._drop(key)
+                self.stats['expirations'] += 1
+                entry = None
+            shape = self.shapes.setdefault(normalize_sql(key[1]), dict(hits=0, misses=0))
+            if entry is None:
+                self.stats['misses'] += 1
+                shape['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            shape['hits'] += 1
+        return entry['df'].copy()
+
+    def generation(self):
+        return self._generation
+
+    def put(self, key, df, generation):
+        """
+        Caches a result, unless something was invalidated since `generation`
+        (the query may have raced with a write) or it's too big to be worth it.
+        """
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        if nbytes > self.max_bytes // 4:
+            return None
+        tables = read_tables(key[1])
+        with self._lock:
+            if generation != self._generation:
+                return None
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = dict(df=df.copy(), tables=tables, nbytes=nbytes, created=time.monotonic())
+            self.nbytes += nbytes
+            while (len(self._entries) > self.max_entries) or (self.nbytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+        return None
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.nbytes -= entry['nbytes']
+
+    def invalidate(self, tables, scope=None):
+        """
+        Drops every cached result that read from any of `tables` (or from a
+        table they cascade to) in the database `scope`, or in any database.
+        """
+        tables = set(tables)
+        for table in list(tables):
+            tables |= set(CACHE_DEPENDENTS.get(table, []))
+        with self._lock:
+            self._generation += 1
+            stale = [
+                key for key, entry in self._entries.items()
+                if ((scope is None) or (key[0] == scope)) and (entry['tables'] & tables)
+            ]
+            for key in stale:
+                self._drop(key)
+            self.stats['invalidations'] += len(stale)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.nbytes = 0
+        return None
+
+    @property
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total > 0 else 0.0
+
+    def summary(self):
+        """ Hits, misses and hit rate per query shape, most used first. """
+        df = pd.DataFrame.from_dict(self.shapes, orient='index', columns=['hits','misses'])
+        df.index.name = 'sql'
+        df['hit_rate'] = df.hits / (df.hits + df.misses)
+        return df.sort_values(['hits','misses'], ascending=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return (
+            f"QueryCache({len(self._entries)} entries, {self.nbytes/1024**2:.1f} MB, "
+            f"hit rate {self.hit_rate:.1%}, {self.stats})"
+        )
+
+query_cache = QueryCache()
+
+##############################################################################
+##                              Read replica                                ##
+##############################################################################
+
+# `= any(%s)` (a list parameter), a tuple `in %s`, or a plain `%s`
+_PARAM = re.compile(r"(=\s*any\s*\(\s*%s\s*\)|%s)", re.IGNORECASE)
+
+def _sqlite_value(value):
+    """ A query parameter as sqlite3 can bind it (numpy scalars, datetimes). """
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+def to_sqlite(query, values=None):
+    """
+    Rewrites a query written for psycopg2 so sqlite3 can run it: `%s`
+    placeholders become `?` (tuples expand to `(?, ...)`), `= any(%s)`
+    becomes an `in` over the list passed as JSON, and `ilike` becomes `like`
+    (which is case-insensitive in SQLite). Returns (query, parameters).
+    """
+    query = re.sub(r"\bilike\b", 'like', query, flags=re.IGNORECASE)
+    if values is None:
+        # psycopg2 leaves the query alone when there are no values
+        return query, list()
+    values = iter(values)
+    parts = _PARAM.split(query)
+    params = list()
+    for i in range(1, len(parts), 2):
+        value = next(values)
+        if parts[i] != '%s':
+            parts[i] = ' in (select value from json_each(?))'
+            params.append(json.dumps([_sqlite_value(v) for v in value]))
+        elif isinstance(value, tuple):
+            parts[i] = '(' + ', '.join('?' for _ in value) + ')'
+            params += [_sqlite_value(v) for v in value]
+        else:
+            parts[i] = '?'
+            params.append(_sqlite_value(value))
+    for i in range(0, len(parts), 2):
+        parts[i] = parts[i].replace('%%', '%')
+    return ''.join(parts), params
+
+class ReadReplica:
+    """
+    Local SQLite copy of the database (see `replica.py`) that
+    `psql_to_df(..., replica=True)` reads from, so browsing works offline
+    and without the round trips. Only queries that write nothing and read
+    just the tables the replica has are routed; anything SQLite can't run
+    (Postgres-only syntax or functions) falls back to Postgres.
+
+    Results are only as fresh as the last refresh, and can differ from
+    Postgres: `lower`/`like` only fold ASCII letters, nulls sort first, and
+    timestamps/booleans come back as text/integers. So only display code
+    should read from it, never anything that decides what to write.
+    """
+
+    def __init__(self):
+        self.path = None
+        self.tables = frozenset()
+        self.stats = dict(reads=0, fallbacks=0)
+
+    def use(self, path):
+        """ Starts reading from the replica at `path`, or stops with None. """
+        if path is None:
+            self.path, self.tables = None, frozenset()
+            return None
+        path = os.path.abspath(path)
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        rows = conn.execute("select name from sqlite_master where type in ('table', 'view')").fetchall()
+        conn.close()
+        self.path, self.tables = path, frozenset(r[0] for r in rows) - {'replica_state'}
+        return None
+
+    @property
+    def scope(self):
+        """ Cache scope of results read from the replica. """
+        return ('replica', self.path)
+
+    def can_serve(self, query, values=None):
+        if (self.path is None) or isinstance(values, dict):
+            return False
+        if len(written_tables(query)) > 0:
+            return False
+        tables = read_tables(query)
+        return (len(tables) > 0) and (tables <= self.tables)
+
+    def read(self, query, values=None):
+        """ Runs a query on the replica; raises sqlite3.Error if it can't. """
+        query, params = to_sqlite(query, values)
+        conn = sqlite3.connect(f'file:{self.path}?mode=ro', uri=True, timeout=30)
+        try:
+            cur = conn.execute(query, params)
+            columns = [col[0] for col in cur.description]
+            data = cur.fetchall()
+        finally:
+            conn.close()
+        self.stats['reads'] += 1
+        return pd.DataFrame(data, columns=columns)
+
+    def __repr__(self):
+        return f"ReadReplica({self.path}, {self.stats})"
+
+read_replica = ReadReplica()
+
+def use_replica(path):
+    """
+    Sets the SQLite replica (made by `music replicate`) at `path` as the one
+    `psql_to_df(..., replica=True)` reads from; None unsets it. Other reads
+    always go to Postgres.
+    """
+    read_replica.use(path)
+    return None
 
 ##############################################################################
 ##                         PostgreSQL interaction                           ##
 ##############################################################################
 
-def psql_to_df(query, config):
+def psql_to_df(query, config, values=None, cache=False, replica=False):
     """
-    Runs a query against a database with the given configuration, and returns
-    a dataframe as output.
+    Runs a query (with optional values) against a database with the given
+    configuration, and returns a dataframe as output. With `cache`, results
+    are served from `query_cache` when possible (used by the Dash app).
+    With `replica`, the query reads from the local replica instead if one
+    is set (see `use_replica`).
     """
-    conn = pg.connect(**config)
+    replicated = replica and read_replica.can_serve(query, values)
+    use_cache = cache and query_cache.enabled
+    if use_cache:
+        scope = read_replica.scope if replicated else cache_scope(config)
+        key = query_cache.key(query, values, scope)
+        df = query_cache.get(key)
+        if df is not None:
+            return df
+        generation = query_cache.generation()
+    if replicated:
+        try:
+            df = read_replica.read(query, values)
+        except sqlite3.Error:
+            # Postgres-only syntax; Postgres can answer it
+            read_replica.stats['fallbacks'] += 1
+            if use_cache:
+                key = query_cache.key(query, values, cache_scope(config))
+        else:
+            if use_cache:
+                query_cache.put(key, df, generation)
+            return df
+    conn = connect(config)
     cur = conn.cursor()
-    cur.execute(query)
+    if values is None:
+        cur.execute(query)
+    else:
+        cur.execute(query, values)
     columns = [col.name for col in cur.description]
     data = cur.fetchall()
     cur.close()
     conn.close()
     df = pd.DataFrame(data, columns=columns)
+    if use_cache:
+        query_cache.put(key, df, generation)
     return df
 
 def psql_execute(query, config, values=None):
@@ -29,7 +576,7 @@ def psql_execute(query, config, values=None):
     Executes a query with optional values. Useful for inserting/removing rows,
     creating/dropping tables, etc. Does not return anything.
     """
-    conn = pg.connect(**config)
+    conn = connect(config)
     cur = conn.cursor()
     if values is None:
         cur.execute(query)
@@ -40,6 +587,175 @@ def psql_execute(query, config, values=None):
     conn.close()
     return None
 
+def create_tables(config):
+    """
+    Creates the music tables (the same schema `create_database.py` builds) if
+    they don't exist yet. Useful for setting up empty/test databases.
+    """
+    query = """
+    create table if not exists genres(
+        genre_id integer unique not null,
+        genre_nm varchar,
+        primary key (genre_id)
+    );
+    create table if not exists artists(
+        artist_id integer unique not null,
+        artist_nm varchar not null,
+        primary key (artist_id)
+    );
+    create table if not exists albums(
+        album_id integer unique not null,
+        artist_id integer not null,
+        album_nm varchar not null,
+        primary key (album_id),
+        foreign key (artist_id) references artists (artist_id)
+    );
+    create table if not exists songs(
+        song_id int unique not null,
+        song_nm varchar not null,
+        artist_id int not null,
+        album_id int,
+        genre_id int,
+        primary key (song_id),
+        foreign key (artist_id) references artists (artist_id),
+        foreign key (album_id) references albums (album_id),
+        foreign key (genre_id) references genres (genre_id)
+    );
+    create table if not exists playlists(
+        playlist_id integer unique not null,
+        playlist_nm varchar not null,
+        primary key (playlist_id)
+    );
+    create table if not exists playlist_songs(
+        playlist_id integer not null,
+        song_id integer not null,
+        playlist_order integer,
+        foreign key (playlist_id) references playlists (playlist_id),
+        foreign key (song_id) references songs (song_id)
+    );
+    create table if not exists song_files(
+        song_id integer not null,
+        file_nm varchar not null,
+        bitrate integer,
+        beats_per_min float,
+        duration integer,
+        file_size integer,
+        foreign key (song_id) references songs (song_id)
+    );
+    """
+    psql_execute(query, config)
+    return None
+
+##############################################################################
+##                          Denormalized playlist view                      ##
+##############################################################################
+
+# Every playlist track with all of its display columns. Album, genre and file
+# are left joined so that songs missing any of them still show up.
+PLAYLIST_TRACKS_QUERY = """
+select
+    playlists.playlist_id
+    ,playlists.playlist_nm
+    ,playlist_songs.playlist_order
+    ,songs.song_id
+    ,songs.song_nm
+    ,artists.artist_id
+    ,artists.artist_nm
+    ,albums.album_id
+    ,albums.album_nm
+    ,genres.genre_id
+    ,genres.genre_nm
+    ,song_files.file_nm
+    ,song_files.duration
+    ,song_files.bitrate
+from playlist_songs
+    join playlists on playlists.playlist_id = playlist_songs.playlist_id
+    join songs on songs.song_id = playlist_songs.song_id
+    join artists on artists.artist_id = songs.artist_id
+    left join albums on albums.album_id = songs.album_id
+    left join genres on genres.genre_id = songs.genre_id
+    left join lateral (
+        select file_nm, duration, bitrate
+        from song_files
+        where song_files.song_id = songs.song_id
+        order by file_nm
+        limit 1
+    ) song_files on true
+"""
+
+def create_playlist_tracks_view(config):
+    """
+    Creates the `playlist_tracks` materialized view (if it doesn't exist yet)
+    along with the unique index needed to refresh it concurrently.
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(
+        "create materialized view if not exists playlist_tracks as "
+        + PLAYLIST_TRACKS_QUERY
+    )
+    cur.execute("""
+    create unique index if not exists playlist_tracks_pk
+        on playlist_tracks (playlist_id, playlist_order, song_id);
+    """)
+    cur.execute("""
+    create index if not exists playlist_tracks_playlist_nm
+        on playlist_tracks (playlist_nm);
+    """)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def _refresh_playlist_tracks(cur, concurrently=True):
+    """
+    Recomputes the `playlist_tracks` view in the cursor's transaction, so it
+    commits (or rolls back) with the writes before it. Does nothing if the
+    view hasn't been created.
+    """
+    cur.execute("select to_regclass('playlist_tracks') is not null")
+    if not cur.fetchone()[0]:
+        return False
+    if concurrently:
+        cur.execute("refresh materialized view concurrently playlist_tracks;")
+    else:
+        cur.execute("refresh materialized view playlist_tracks;")
+    return True
+
+def refresh_playlist_tracks(config, concurrently=True):
+    """
+    Recomputes the `playlist_tracks` view, if it exists. A concurrent refresh
+    doesn't block readers, so it is safe to run after every ingest/delete.
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    _refresh_playlist_tracks(cur, concurrently)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def get_playlist_tracks(config, playlist_nm=None, order_by='playlist_order', limit=None, cache=False, replica=False):
+    """
+    Reads playlist tracks from the `playlist_tracks` view instead of joining
+    the underlying tables. Optionally filters by playlist name and limits the
+    number of rows returned. `cache` and `replica` are passed to `psql_to_df`.
+    """
+    valid_order = ['playlist_order', 'artist_nm', 'song_nm', 'album_nm', 'genre_nm']
+    if order_by not in valid_order:
+        raise ValueError(f"order_by must be one of {valid_order}, not {order_by}")
+    query = "select * from playlist_tracks"
+    values = list()
+    if playlist_nm is not None:
+        query += " where playlist_nm = %s"
+        values.append(playlist_nm)
+    query += f" order by playlist_id, {order_by}, playlist_order"
+    if limit is not None:
+        query += " limit %s"
+        values.append(int(limit))
+    df = psql_to_df(query, config, values, cache=cache, replica=replica)
+    return df
+
 ##############################################################################
 ##                        Music database manipulation                       ##
 ##############################################################################
@@ -56,18 +772,26 @@ def find_new_songs(music_dir, db_config):
     from song_files;
     """
     db_files = set(psql_to_df(query, db_config).file_nm.values)
+    local_files = list_music_files(music_dir)
+    # Get files that are in <local_files> but not <db_files>
+    new_files = list(local_files - db_files)
+    
+    return new_files
+
+def list_music_files(music_dir):
+    """
+    Returns the set of music file names (relative to the music directory) that
+    are currently on disk.
+    """
     # Pull all the song file paths from the directory
     local_files = glob.glob(music_dir+"*.*")
     # Strip the music directory from the file names
-    local_files = [re.sub(f"^{music_dir}(.*)", r"\1", s) for s in local_files]
+    local_files = [re.sub(f"^{re.escape(music_dir)}(.*)", r"\1", s) for s in local_files]
     # Ignore all file extensions not in those specified
     local_files = [s for s in local_files if len(s)>=4]
     valid_ext = ['.mp3','.wav','.m4a']
     local_files = {s for s in local_files if s[-4:].lower() in valid_ext}
-    # Get files that are in <local_files> but not <db_files>
-    new_files = list(local_files - db_files)
-    
-    return new_files
+    return local_files
 
 def gen_new_song_config(config, music_dir, file_nm, song_nm, artist_nm, genre_nm=None, album_nm=None):
     """
@@ -92,8 +816,8 @@ def gen_new_song_config(config, music_dir, file_nm, song_nm, artist_nm, genre_nm
     song_config['song_id'] = int(song_id)
     
     # Create or retrieve artist_id
-    query = f"select artist_id from artists where lower(artist_nm) = '{artist_nm.lower()}'"
-    artist_id = psql_to_df(query, config)
+    query = "select artist_id from artists where lower(artist_nm) = %s"
+    artist_id = psql_to_df(query, config, (artist_nm.lower(),))
     if len(artist_id) == 0:    # Artist doesn't exist
         query = "select max(artist_id) artist_id from artists"
         artist_id = psql_to_df(query, config).artist_id.loc[0] + 1
@@ -108,8 +832,8 @@ def gen_new_song_config(config, music_dir, file_nm, song_nm, artist_nm, genre_nm
     if genre_nm is None:
         genre_id = None
     else:
-        query = f"select genre_id from genres where lower(genre_nm) = '{genre_nm.lower()}'"
-        genre_id = psql_to_df(query, config)
+        query = "select genre_id from genres where lower(genre_nm) = %s"
+        genre_id = psql_to_df(query, config, (genre_nm.lower(),))
         if len(genre_id) == 0:    # Genre doesn't exist yet
             query = "select max(genre_id) genre_id from genres"
             genre_id = psql_to_df(query, config).genre_id.iloc[0] + 1
@@ -118,21 +842,21 @@ def gen_new_song_config(config, music_dir, file_nm, song_nm, artist_nm, genre_nm
             genre_id = genre_id.genre_id.iloc[0]
         else:
             raise IndexError(f"genre_nm {genre_nm} has more than one entry in the database!")
-    song_config['genre_id'] = int(genre_id)
+    song_config['genre_id'] = None if genre_id is None else int(genre_id)
     
     # Create or retrieve album_id (if applicable)
     if album_nm is None:
-        album_id = None
+        song_config['album_id'] = None
     else:
-        query = f"""
+        query = """
         select albums.album_id
         from albums, artists
         where
             albums.artist_id = artists.artist_id
-            and lower(albums.album_nm) = '{album_nm.lower()}'
-            and lower(artists.artist_nm) = '{artist_nm.lower()}'
+            and lower(albums.album_nm) = %s
+            and lower(artists.artist_nm) = %s
         """
-        album_id = psql_to_df(query, config)
+        album_id = psql_to_df(query, config, (album_nm.lower(), artist_nm.lower()))
         if len(album_id) == 0:    # Album doesn't exist
             query = "select max(album_id) album_id from albums"
             album_id = psql_to_df(query, config).album_id.iloc[0] + 1
@@ -144,6 +868,7 @@ def gen_new_song_config(config, music_dir, file_nm, song_nm, artist_nm, genre_nm
                              "has more than one entry in the database!")
         song_config['album_id'] = int(album_id)
     # Get some file metadata
+    import mutagen.mp3
     try:
         metadata = get_song_metadata(file_nm, music_dir)
         for key in ['bitrate','beats_per_min','duration','file_size']:
@@ -158,7 +883,7 @@ def add_new_song_to_db(song_config, db_config):
     in an earlier step.
     """
     # Open db connections
-    conn = pg.connect(**db_config)
+    conn = connect(db_config)
     cur = conn.cursor()
     # Add genre to `genres` table (if new)
     if song_config['new_genre']:
@@ -229,26 +954,106 @@ def add_new_song_to_db(song_config, db_config):
     conn.close()
     return song_config
 
-def delete_song_from_db(song_id: int, db_config):
+def delete_song_from_db(song_id: int, db_config, refresh_view=True):
+    """
+    Deletes a song (and its files/playlist entries) from the database, and
+    refreshes the `playlist_tracks` view in the same transaction.
+    """
+    delete_songs_from_db([song_id], db_config, refresh_view=refresh_view)
+    return None
+
+def delete_songs_from_db(song_ids, db_config, collect_orphans=False, refresh_view=True):
+    """
+    Deletes many songs (and their files/playlist entries) with one set-based
+    statement per table, all in a single transaction. If `collect_orphans` is
+    set, artists/albums/genres left without any songs are removed in the same
+    transaction. Returns the number of songs deleted.
+    """
+    song_ids = [int(s) for s in song_ids]
+    if len(song_ids) == 0:
+        return 0
     # Open db connections
-    conn = pg.connect(**db_config)
+    conn = connect(db_config)
     cur = conn.cursor()
+    values = (song_ids,)
     # Delete from `song_files` table
-    query = "delete from song_files where song_id = %s;"
-    values = (song_id,)
-    cur.execute(query, values)
+    cur.execute("delete from song_files where song_id = any(%s);", values)
     # Delete from playlist_songs table
-    query = "delete from playlist_songs where song_id = %s;"
-    cur.execute(query, values)
+    cur.execute("delete from playlist_songs where song_id = any(%s);", values)
     # Delete from `song` table
-    query = "delete from songs where song_id = %s;"
-    cur.execute(query, values)
+    cur.execute("delete from songs where song_id = any(%s);", values)
+    n_deleted = cur.rowcount
+    if collect_orphans:
+        _collect_orphans(cur)
+    if refresh_view:
+        _refresh_playlist_tracks(cur)
     conn.commit()
     cur.close()
     conn.close()
-    return None
+    return n_deleted
+
+def _collect_orphans(cur):
+    """
+    Deletes albums, genres and artists that no longer have any songs. Albums
+    go first since they hold a foreign key to `artists`.
+    """
+    counts = dict()
+    query = """
+    delete from albums
+    where not exists (
+        select 1 from songs where songs.album_id = albums.album_id
+    );
+    """
+    cur.execute(query)
+    counts['albums'] = cur.rowcount
+    query = """
+    delete from genres
+    where not exists (
+        select 1 from songs where songs.genre_id = genres.genre_id
+    );
+    """
+    cur.execute(query)
+    counts['genres'] = cur.rowcount
+    query = """
+    delete from artists
+    where not exists (
+            select 1 from songs where songs.artist_id = artists.artist_id
+        )
+        and not exists (
+            select 1 from albums where albums.artist_id = artists.artist_id
+        );
+    """
+    cur.execute(query)
+    counts['artists'] = cur.rowcount
+    return counts
+
+def collect_orphans(db_config):
+    """
+    Garbage collects artists, albums and genres that aren't referenced by any
+    song. Returns the number of rows removed from each table.
+    """
+    conn = connect(db_config)
+    cur = conn.cursor()
+    counts = _collect_orphans(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return counts
+
+def find_missing_songs(music_dir, db_config):
+    """
+    Finds the song_ids whose files are no longer in the music directory (i.e.
+    none of the song's files exist on disk).
+    """
+    query = "select song_id, file_nm from song_files;"
+    db_files = psql_to_df(query, db_config)
+    local_files = list_music_files(music_dir)
+    on_disk = db_files.file_nm.isin(local_files)
+    present = set(db_files.song_id[on_disk])
+    missing = set(db_files.song_id[~on_disk]) - present
+    return sorted(int(s) for s in missing)
 
-def change_song_name(song_id, new_song_nm, config):
+def change_song_name(song_id, new_song_nm, config, refresh_view=True):
     """ Changes a song's name in the database. """
     query = """
     update songs
@@ -256,7 +1061,14 @@ def change_song_name(song_id, new_song_nm, config):
     where song_id = %s;
     """
     values = (new_song_nm, song_id)
-    psql_execute(query, config, values)
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query, values)
+    if refresh_view:
+        _refresh_playlist_tracks(cur)
+    conn.commit()
+    cur.close()
+    conn.close()
     return None
 
 ##############################################################################
@@ -267,12 +1079,14 @@ def get_song_metadata(file_nm, music_dir):
     """
     Gets as much metadata from the song file as possible.
     """
+    # Imported here so commands that never read files skip it
+    import mutagen
     file = mutagen.File(music_dir+file_nm)
     if file is None:
         return dict()
-    mdata = {str(k[:4]): v for k, v in file.items()}
+    # Artwork (APIC) is left out on purpose: it can be a whole JPEG per file.
+    # See `artwork.py` for extracting it separately.
     ID3_dict = {
-        'picture': 'APIC',
         'comment': 'COMM',
         'play_counter': 'PCNT',
         'popularimeter': 'POPM',
@@ -0,0 +1,403 @@
+import os
+import sys
+import json
+from time import sleep
+import pandas as pd
+from psycopg2.extras import execute_values
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'source'))
+from util import (
+    connect,
+    psql_to_df,
+    refresh_playlist_tracks,
+)
+from playlist_order import (
+    entries_to_move,
+    plan_orders,
+)
+from sort_playlist import (
+    login,
+    get_all_songs,
+)
+from song_matching import link_library
+
+##############################################################################
+##                               Sync tables                                ##
+##############################################################################
+
+def create_sync_tables(config):
+    """
+    Creates the tables the sync engine needs:
+        google_song_map: links local `song_id`s to Google track IDs, with
+            the matcher's confidence (1 for exact and manual links)
+        playlist_sync_state: playlist membership/order as of the last sync,
+            used as the common ancestor for the three-way diff
+    """
+    query = """
+    create table if not exists google_song_map(
+        song_id integer not null,
+        google_id varchar unique not null,
+        confidence float not null default 1,
+        primary key (song_id),
+        foreign key (song_id) references songs (song_id) on delete cascade
+    );
+    alter table google_song_map add column if not exists confidence float not null default 1;
+    create table if not exists playlist_sync_state(
+        playlist_nm varchar not null,
+        song_id integer not null,
+        position integer not null,
+        primary key (playlist_nm, song_id)
+    );
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    cur.execute(query)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def link_songs(pairs, config):
+    """
+    Stores manual (song_id, google_id) pairs in `google_song_map`, replacing
+    any existing link for the same song.
+    """
+    query = """
+    insert into google_song_map (song_id, google_id, confidence)
+    values %s
+    on conflict (song_id) do update set
+        google_id = excluded.google_id
+        ,confidence = 1;
+    """
+    conn = connect(config)
+    cur = conn.cursor()
+    execute_values(cur, query, [(int(s), g, 1.0) for s, g in pairs])
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+##############################################################################
+##                           Reading both sides                             ##
+##############################################################################
+
+def get_local_playlists(config):
+    """
+    Gets every playlist in the database with its songs in order. Songs that
+    aren't linked to a Google track have a null `google_id`.
+    """
+    query = """
+    select
+        playlists.playlist_id
+        ,playlists.playlist_nm
+        ,playlist_songs.song_id
+        ,playlist_songs.playlist_order
+        ,google_song_map.google_id
+    from playlists
+        left join playlist_songs
+            on playlist_songs.playlist_id = playlists.playlist_id
+        left join google_song_map
+            on google_song_map.song_id = playlist_songs.song_id
+    order by playlists.playlist_id, playlist_songs.playlist_order
+    """
+    return psql_to_df(query, config)
+
+def get_remote_playlists(api, config):
+    """
+    Gets every playlist in the Google account with its entries in order. The
+    raw entry dicts are kept because reordering needs them. Entries whose
+    track isn't linked to a local song have a null `song_id`.
+    """
+    rows = list()
+    for pl in api.get_all_user_playlist_contents():
+        if len(pl['tracks']) == 0:
+            rows.append([pl['name'], pl['id'], None, None, None, None])
+        for track in pl['tracks']:
+            rows.append([
+                pl['name'],
+                pl['id'],
+                track.get('trackId', None),
+                track.get('id', None),
+                int(track.get('absolutePosition', 0)),
+                track,
+            ])
+    col_names = ['playlist_nm','playlist_id','google_id','pl_entry_id','position','entry']
+    remote_df = pd.DataFrame(rows, columns=col_names)
+    song_map = psql_to_df("select song_id, google_id from google_song_map", config)
+    remote_df = pd.merge(remote_df, song_map, on='google_id', how='left')
+    remote_df = remote_df.sort_values(['playlist_nm','position'], kind='stable')
+    return remote_df
+
+def get_sync_state(config):
+    """ Gets playlist membership as of the last sync. """
+    query = """
+    select playlist_nm, song_id, position
+    from playlist_sync_state
+    order by playlist_nm, position
+    """
+    return psql_to_df(query, config)
+
+##############################################################################
+##                                 Diffing                                  ##
+##############################################################################
+
+def _song_list(df):
+    """ Unique, non-null song_ids of a (sorted) playlist frame, in order. """
+    songs = df.song_id.dropna().astype(int).tolist()
+    return list(dict.fromkeys(songs))
+
+def _merge_order(preferred, other, members):
+    """
+    Orders the merged membership: songs follow the preferred side's order,
+    and songs only on the other side are placed after their predecessor
+    there (or at the end).
+    """
+    order = [s for s in preferred if s in members]
+    placed = set(order)
+    prev = None
+    for s in other:
+        if (s in members) and (s not in placed):
+            idx = order.index(prev) + 1 if prev in placed else len(order)
+            order.insert(idx, s)
+            placed.add(s)
+        if s in placed:
+            prev = s
+    return order
+
+def diff_playlists(api, config, prefer='local'):
+    """
+    Computes a three-way, set-based diff of playlist membership and order
+    between the database, the Google account and the last synced state.
+    Additions and removals from either side are kept; when both sides
+    reordered a playlist the `prefer`red side ('local' or 'remote') wins.
+    Returns a plan dictionary consumed by `apply_plan`, whose 'report' entry
+    is a dataframe of every change that would be made.
+    """
+    if prefer not in ['local', 'remote']:
+        raise ValueError(f"prefer must be 'local' or 'remote', not {prefer}")
+    local_df = get_local_playlists(config)
+    remote_df = get_remote_playlists(api, config)
+    state_df = get_sync_state(config)
+    song_map = psql_to_df("select song_id, google_id from google_song_map", config)
+    song_map = dict(zip(song_map.song_id.astype(int), song_map.google_id))
+
+    plan = dict(playlists=list(), report=None)
+    report = list()
+    names = sorted(set(local_df.playlist_nm) | set(remote_df.playlist_nm))
+    for pl_nm in names:
+        local = local_df[local_df.playlist_nm == pl_nm]
+        remote = remote_df[remote_df.playlist_nm == pl_nm]
+        base = state_df[state_df.playlist_nm == pl_nm]
+        L, R, B = _song_list(local), _song_list(remote), _song_list(base)
+        # Only songs linked on both sides can be synced
+        L = [s for s in L if s in song_map]
+        Ls, Rs, Bs = set(L), set(R), set(B)
+        members = (Bs - (Bs - Ls) - (Bs - Rs)) | (Ls - Bs) | (Rs - Bs)
+        # Pick the order from whichever side changed it since the last sync
+        local_moved = [s for s in L if s in Bs] != [s for s in B if s in Ls]
+        remote_moved = [s for s in R if s in Bs] != [s for s in B if s in Rs]
+        if (prefer == 'local' and local_moved) or not remote_moved:
+            target = _merge_order(L, R, members)
+        else:
+            target = _merge_order(R, L, members)
+
+        entry = dict(
+            playlist_nm=pl_nm,
+            local_id=int(local.playlist_id.iloc[0]) if len(local) > 0 else None,
+            remote_id=remote.playlist_id.iloc[0] if len(remote) > 0 else None,
+            target=target,
+            local_add=[s for s in target if s not in Ls],
+            local_remove=sorted(Ls - members),
+            remote_add=[s for s in target if s not in Rs],
+            remote_remove=remote[remote.song_id.isin(list(Rs - members))].pl_entry_id.tolist(),
+        )
+        kept_local = [s for s in L if s in members]
+        kept_remote = [s for s in R if s in members]
+        entry['local_orders'] = {
+            int(s): int(o) for s, o in zip(local.song_id, local.playlist_order)
+            if pd.notna(s) and pd.notna(o) and (int(s) in members)
+        }
+        entry['local_moves'] = entries_to_move(kept_local, [s for s in target if s in Ls])
+        entry['remote_moves'] = entries_to_move(kept_remote, [s for s in target if s in Rs])
+        entry['changed'] = any(
+            len(entry[k]) > 0 for k in
+            ['local_add','local_remove','remote_add','remote_remove','local_moves','remote_moves']
+        ) or (entry['local_id'] is None) or (entry['remote_id'] is None) or (B != target)
+        plan['playlists'].append(entry)
+
+        if entry['local_id'] is None:
+            report.append([pl_nm, 'local', 'create_playlist', None])
+        if entry['remote_id'] is None:
+            report.append([pl_nm, 'remote', 'create_playlist', None])
+        for side in ['local', 'remote']:
+            for s in entry[f'{side}_add']:
+                report.append([pl_nm, side, 'add', s])
+            for s in entry[f'{side}_moves']:
+                report.append([pl_nm, side, 'move', s])
+        for s in entry['local_remove']:
+            report.append([pl_nm, 'local', 'remove', s])
+        for s in sorted(Rs - members):
+            report.append([pl_nm, 'remote', 'remove', s])
+        unmatched = (local.song_id.notna() & local.google_id.isna()).sum() \
+            + (remote.google_id.notna() & remote.song_id.isna()).sum()
+        if unmatched > 0:
+            report.append([pl_nm, 'both', 'unmatched', int(unmatched)])
+
+    cols = ['playlist_nm','side','action','song_id']
+    plan['report'] = pd.DataFrame(report, columns=cols)
+    return plan
+
+##############################################################################
+##                                Applying                                  ##
+##############################################################################
+
+def _apply_local(plan, config):
+    """ Applies the local half of the plan with batched SQL in one transaction. """
+    changed = [pl for pl in plan['playlists'] if pl['changed']]
+    if len(changed) == 0:
+        return None
+    conn = connect(config)
+    cur = conn.cursor()
+    # Create missing playlists
+    cur.execute("select coalesce(max(playlist_id), -1) from playlists")
+    next_id = cur.fetchone()[0] + 1
+    new_playlists = list()
+    for pl in changed:
+        if pl['local_id'] is None:
+            pl['local_id'] = next_id
+            new_playlists.append((next_id, pl['playlist_nm']))
+            next_id += 1
+    if len(new_playlists) > 0:
+        execute_values(cur, "insert into playlists (playlist_id, playlist_nm) values %s", new_playlists)
+    # Remove songs
+    removes = [(pl['local_id'], s) for pl in changed for s in pl['local_remove']]
+    if len(removes) > 0:
+        query = """
+        delete from playlist_songs
+        using (values %s) v (playlist_id, song_id)
+        where playlist_songs.playlist_id = v.playlist_id
+            and playlist_songs.song_id = v.song_id;
+        """
+        execute_values(cur, query, removes)
+    # Insert new songs and fix up the order of the ones that moved; songs that
+    # stay put keep their `playlist_order` so only changed rows are written
+    inserts, updates = list(), list()
+    for pl in changed:
+        adds = set(pl['local_add'])
+        for s, o in plan_orders(pl['target'], pl['local_orders']).items():
+            if s in adds:
+                inserts.append((pl['local_id'], s, o))
+            else:
+                updates.append((pl['local_id'], s, o))
+    if len(inserts) > 0:
+        query = "insert into playlist_songs (playlist_id, song_id, playlist_order) values %s"
+        execute_values(cur, query, inserts)
+    if len(updates) > 0:
+        query = """
+        update playlist_songs
+        set playlist_order = v.playlist_order
+        from (values %s) v (playlist_id, song_id, playlist_order)
+        where playlist_songs.playlist_id = v.playlist_id
+            and playlist_songs.song_id = v.song_id
+            and playlist_songs.playlist_order is distinct from v.playlist_order;
+        """
+        execute_values(cur, query, updates)
+    conn.commit()
+    cur.close()
+    conn.close()
+    refresh_playlist_tracks(config)
+    return None
+
+def _apply_remote(plan, api, config, pause=1):
+    """
+    Applies the remote half of the plan: one batched removal call for all
+    playlists, one add call per playlist, then the minimal set of reorders.
+    """
+    changed = [pl for pl in plan['playlists'] if pl['changed']]
+    song_map = psql_to_df("select song_id, google_id from google_song_map", config)
+    song_map = dict(zip(song_map.song_id.astype(int), song_map.google_id))
+    for pl in changed:
+        if pl['remote_id'] is None:
+            pl['remote_id'] = api.create_playlist(pl['playlist_nm'])
+    removes = [e for pl in changed for e in pl['remote_remove']]
+    if len(removes) > 0:
+        api.remove_entries_from_playlist(removes)
+        sleep(pause)
+    for pl in changed:
+        if len(pl['remote_add']) > 0:
+            api.add_songs_to_playlist(pl['remote_id'], [song_map[s] for s in pl['remote_add']])
+            sleep(pause)
+    # Added songs are appended, so reorders are computed against fresh entries
+    needs_order = [pl for pl in changed if len(pl['remote_add']) + len(pl['remote_moves']) > 0]
+    if len(needs_order) == 0:
+        return None
+    remote_df = get_remote_playlists(api, config)
+    for pl in needs_order:
+        remote = remote_df[(remote_df.playlist_id == pl['remote_id']) & remote_df.song_id.notna()]
+        remote = remote.drop_duplicates('song_id')
+        entries = dict(zip(remote.song_id.astype(int), remote.entry))
+        target = [s for s in pl['target'] if s in entries]
+        current = [s for s in remote.song_id.astype(int) if s in set(target)]
+        for s in entries_to_move(current, target):
+            i = target.index(s)
+            before = entries[target[i-1]] if i > 0 else None
+            after = entries[target[i+1]] if i+1 < len(target) else None
+            api.reorder_playlist_entry(entries[s], to_follow_entry=before, to_precede_entry=after)
+    return None
+
+def _save_sync_state(plan, config):
+    """ Records the merged playlists as the base for the next sync. """
+    changed = [pl for pl in plan['playlists'] if pl['changed']]
+    if len(changed) == 0:
+        return None
+    conn = connect(config)
+    cur = conn.cursor()
+    execute_values(
+        cur,
+        "delete from playlist_sync_state where playlist_nm in (select v.nm from (values %s) v (nm))",
+        [(pl['playlist_nm'],) for pl in changed]
+    )
+    rows = [(pl['playlist_nm'], s, i) for pl in changed for i, s in enumerate(pl['target'])]
+    if len(rows) > 0:
+        execute_values(cur, "insert into playlist_sync_state (playlist_nm, song_id, position) values %s", rows)
+    conn.commit()
+    cur.close()
+    conn.close()
+    return None
+
+def apply_plan(plan, api, config):
+    """ Applies a plan from `diff_playlists` to both sides. """
+    _apply_local(plan, config)
+    _apply_remote(plan, api, config)
+    _save_sync_state(plan, config)
+    return None
+
+def sync_playlists(api, config, dry_run=True, prefer='local'):
+    """
+    Syncs playlists between the database and the Google account. With
+    `dry_run` nothing is changed and only the report is returned.
+    """
+    plan = diff_playlists(api, config, prefer)
+    if not dry_run:
+        apply_plan(plan, api, config)
+    return plan['report']
+
+if __name__ == "__main__":
+    dry_run = '--apply' not in sys.argv
+    with open('config.json', 'r') as fp:
+        config = json.load(fp)
+    config = config['databases']['music']
+    api = login()
+    if '--match' in sys.argv:
+        print('Matching songs to the Google library...')
+        create_sync_tables(config)
+        matches = link_library(get_all_songs(api), config, dry_run=dry_run)
+        print(matches.groupby('method').size().to_string())
+    print('Diffing playlists...')
+    report = sync_playlists(api, config, dry_run=dry_run)
+    if len(report) == 0:
+        print('Already in sync.')
+    else:
+        print(report.groupby(['playlist_nm','side','action']).size().to_string())
+    if dry_run:
+        print('Dry run; pass --apply to make these changes.')
+    print('Done!')
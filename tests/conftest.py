@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules in source/ import each other by name; the scripts live at the top
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(REPO_DIR, 'source'))
+sys.path.insert(0, REPO_DIR)
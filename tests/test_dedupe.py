@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+from dedupe import (
+    cluster_names,
+    _resolve,
+)
+
+def _names(rows, group=False):
+    columns = ['id','nm','songs'] + (['group'] if group else [])
+    return pd.DataFrame(rows, columns=columns)
+
+def test_cluster_names():
+    df = _names([
+        (1, 'The Beatles', 10),
+        (2, 'Beatles', 30),
+        (3, 'Beatles, The', 1),
+        (4, 'Queen', 5),
+        (5, 'Bob Marley & The Wailers', 3),
+        (6, 'Bob Marley and the Wailers', 4),
+    ])
+    clusters = cluster_names(df)
+    canonical = dict(zip(clusters.id, clusters.canonical_id))
+    # The name with the most songs is canonical
+    assert canonical[1] == canonical[2] == 2
+    assert canonical[5] == canonical[6] == 6
+    assert 4 not in canonical
+    assert (clusters.score > 0.85).all()
+
+def test_cluster_names_keeps_numbers_apart():
+    df = _names([(1, 'Greatest Hits Vol. 1', 5), (2, 'Greatest Hits Vol. 2', 5)])
+    assert len(cluster_names(df)) == 0
+
+def test_cluster_names_within_groups():
+    df = _names([(1, 'Greatest Hits', 5, 1), (2, 'Greatest Hits', 5, 2), (3, 'Greatest Hits', 1, 2)], group=True)
+    clusters = cluster_names(df)
+    assert sorted(clusters.id) == [2, 3]
+    assert set(clusters.canonical_id) == {2}
+
+def test_cluster_names_with_missing_names():
+    df = _names([(1, None, 1), (2, 'Queen', 5), (3, 'Queen', 2)])
+    assert sorted(cluster_names(df).id) == [2, 3]
+
+def test_resolve_follows_chains():
+    assert _resolve({1: 2, 2: 3, 4: 4}) == {1: 3, 2: 3}
+
+def test_resolve_frame():
+    df = pd.DataFrame(dict(id=[1, 2, 3], canonical_id=[2, 2, 2]))
+    assert _resolve(df) == {1: 2, 3: 2}
+
+def test_resolve_cycle():
+    with pytest.raises(ValueError):
+        _resolve({1: 2, 2: 1})
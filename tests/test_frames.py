@@ -0,0 +1,64 @@
+import pandas as pd
+from frames import (
+    build_frame,
+    concat_frames,
+    GOOGLE_ENTRY_SCHEMA,
+    GOOGLE_SONG_SCHEMA,
+    RHYTHMDB_SCHEMA,
+)
+
+def test_build_frame_from_dicts():
+    df = build_frame(
+        [
+            {'title': 'A', 'artist': 'X', 'duration': '180', 'rating': None, 'extra': 1},
+            {'title': 'B', 'artist': 'X', 'duration': 'n/a'},
+        ],
+        RHYTHMDB_SCHEMA
+    )
+    assert list(df.columns) == list(RHYTHMDB_SCHEMA)
+    assert df.dtypes.astype(str).to_dict() == RHYTHMDB_SCHEMA
+    assert df.duration.tolist() == [180, pd.NA]
+    assert df.rating.isna().all()
+    assert df.artist.cat.categories.tolist() == ['X']
+
+def test_build_frame_from_tuples():
+    df = build_frame([('s1', 'Title', None, 'Album')], GOOGLE_SONG_SCHEMA)
+    assert df.song_id.tolist() == ['s1']
+    assert df.artist.isna().all()
+    assert str(df.album.dtype) == 'category'
+
+def test_build_frame_empty():
+    df = build_frame([], GOOGLE_ENTRY_SCHEMA)
+    assert len(df) == 0
+    assert df.dtypes.astype(str).to_dict() == GOOGLE_ENTRY_SCHEMA
+
+def test_concat_frames_keeps_categoricals():
+    a = build_frame([('s1', 'A', 'X', 'P')], GOOGLE_SONG_SCHEMA)
+    b = build_frame([('s2', 'B', 'Y', 'P')], GOOGLE_SONG_SCHEMA)
+    df = concat_frames([a, b])
+    assert df.song_id.tolist() == ['s1', 's2']
+    assert str(df.artist.dtype) == 'category'
+    assert sorted(df.artist.cat.categories) == ['X', 'Y']
+    assert df.album.cat.categories.tolist() == ['P']
+
+def test_concat_frames_with_empty_and_all_null_chunks():
+    # A page whose entries were all filtered out, and one where no track has an album
+    empty = build_frame([], GOOGLE_ENTRY_SCHEMA)
+    full = build_frame([('p1', 's1', 'e1', '01')], GOOGLE_ENTRY_SCHEMA)
+    no_playlist = build_frame([(None, 's2', 'e2', '02')], GOOGLE_ENTRY_SCHEMA)
+    df = concat_frames([empty, full, no_playlist])
+    assert df.pl_entry_id.tolist() == ['e1', 'e2']
+    assert str(df.playlist_id.dtype) == 'category'
+    assert df.playlist_id.tolist()[0] == 'p1'
+    assert df.playlist_id.isna().tolist() == [False, True]
+
+    songs = concat_frames([
+        build_frame([('s1', 'A', 'X', None)], GOOGLE_SONG_SCHEMA),
+        build_frame([('s2', 'B', 'Y', 'P')], GOOGLE_SONG_SCHEMA),
+    ])
+    assert songs.album.isna().tolist() == [True, False]
+
+def test_concat_frames_of_empty_chunks():
+    df = concat_frames([build_frame([], GOOGLE_ENTRY_SCHEMA)]*2)
+    assert len(df) == 0
+    assert list(df.columns) == list(GOOGLE_ENTRY_SCHEMA)
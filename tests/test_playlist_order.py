@@ -0,0 +1,91 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from playlist_order import (
+    entries_to_move,
+    plan_orders,
+    sort_key,
+    _plan_sort,
+    ORDER_GAP,
+)
+
+def _apply(orders, changes):
+    orders = {**orders, **changes}
+    return sorted(orders, key=orders.get)
+
+def test_entries_to_move_already_in_order():
+    assert entries_to_move([1, 2, 3], [1, 2, 3]) == []
+
+def test_entries_to_move_single_move():
+    assert entries_to_move([1, 2, 3, 4], [2, 3, 4, 1]) == [1]
+    assert entries_to_move([1, 2, 3, 4], [1, 4, 2, 3]) == [4]
+
+def test_entries_to_move_reversed():
+    # Only one item of a reversed list can stay put
+    assert len(entries_to_move([1, 2, 3, 4], [4, 3, 2, 1])) == 3
+
+def test_entries_to_move_empty():
+    assert entries_to_move([], []) == []
+
+def test_plan_orders_unchanged():
+    orders = {s: k*ORDER_GAP for k, s in enumerate([1, 2, 3])}
+    assert plan_orders([1, 2, 3], orders) == dict()
+
+def test_plan_orders_moves_only_what_it_has_to():
+    orders = {s: k*ORDER_GAP for k, s in enumerate([1, 2, 3, 4, 5])}
+    target = [1, 5, 2, 3, 4]
+    changes = plan_orders(target, orders)
+    assert list(changes) == [5]
+    assert _apply(orders, changes) == target
+
+def test_plan_orders_new_songs_at_the_ends():
+    orders = {1: 0, 2: ORDER_GAP}
+    target = [3, 1, 2, 4]
+    changes = plan_orders(target, orders)
+    assert set(changes) == {3, 4}
+    assert _apply(orders, changes) == target
+
+def test_plan_orders_rebalances_when_gaps_run_out():
+    orders = {1: 0, 2: 1, 3: 2, 4: 3}
+    target = [1, 4, 2, 3]
+    changes = plan_orders(target, orders)
+    assert {s: changes.get(s, orders[s]) for s in target} == {s: k*ORDER_GAP for k, s in enumerate(target)}
+    assert _apply(orders, changes) == target
+
+@pytest.mark.parametrize('seed', range(5))
+def test_plan_orders_random_shuffles(seed):
+    rng = random.Random(seed)
+    songs = list(range(50))
+    orders = {s: k*ORDER_GAP for k, s in enumerate(songs)}
+    target = songs[:]
+    rng.shuffle(target)
+    changes = plan_orders(target, orders)
+    assert _apply(orders, changes) == target
+    assert len(changes) == len(entries_to_move(songs, target))
+
+@pytest.mark.parametrize('name, key', [
+    ('The Beatles', 'beatles'),
+    ('Theatre', 'theatre'),
+    ('ABBA', 'abba'),
+    (None, ''),
+    (np.nan, ''),
+])
+def test_sort_key(name, key):
+    assert sort_key(name) == key
+
+def test_plan_sort_with_missing_names():
+    # Songs without an album/genre come back from the database as NaN
+    df = pd.DataFrame(dict(
+        playlist_id=[1, 1, 1, 2, 2],
+        playlist_nm=['a', 'a', 'a', 'b', 'b'],
+        song_id=[10, 11, 12, 10, 13],
+        playlist_order=[0, ORDER_GAP, 2*ORDER_GAP, 0, ORDER_GAP],
+        sort_nm=['The Wall', np.nan, 'Abbey Road', 'The Wall', 'Animals'],
+    ))
+    updates, changed = _plan_sort(df)
+    assert changed == {'a': 1, 'b': 1}
+    orders = {(p, s): o for p, s, o in df[['playlist_id','song_id','playlist_order']].itertuples(index=False)}
+    orders.update({(p, s): o for p, s, o in updates})
+    assert sorted([s for p, s in orders if p == 1], key=lambda s: orders[1, s]) == [11, 12, 10]
+    assert sorted([s for p, s in orders if p == 2], key=lambda s: orders[2, s]) == [13, 10]
@@ -0,0 +1,40 @@
+import numpy as np
+import scipy.sparse as sp
+from similar import _top_k
+
+def test_top_k_per_row():
+    scores = sp.csr_matrix(np.array([
+        [0.0, 0.5, 0.9, 0.1],
+        [0.3, 0.0, 0.0, 0.0],
+        [0.0, 0.0, 0.0, 0.0],
+        [0.2, 0.8, 0.4, 1.0],
+    ]))
+    rows, rank, cols, data = _top_k(scores, 2)
+    assert rows.tolist() == [0, 0, 1, 3, 3]
+    assert rank.tolist() == [0, 1, 0, 0, 1]
+    assert cols.tolist() == [2, 1, 0, 3, 1]
+    assert np.allclose(data, [0.9, 0.5, 0.3, 1.0, 0.8])
+
+def test_top_k_excludes_self():
+    scores = sp.csr_matrix(np.array([
+        [1.0, 0.5, 0.2],
+        [0.5, 1.0, 0.7],
+    ]))
+    rows, rank, cols, data = _top_k(scores, 5, exclude=np.array([0, 1]))
+    assert rows.tolist() == [0, 0, 1, 1]
+    assert rank.tolist() == [0, 1, 0, 1]
+    assert cols.tolist() == [1, 2, 2, 0]
+
+def test_top_k_ties_keep_column_order():
+    scores = sp.csr_matrix(np.array([[0.5, 0.5, 0.5]]))
+    _, _, cols, _ = _top_k(scores, 2)
+    assert cols.tolist() == [0, 1]
+
+def test_top_k_matches_dense_sort():
+    rng = np.random.default_rng(0)
+    dense = rng.random((30, 40)) * (rng.random((30, 40)) < 0.2)
+    rows, rank, cols, data = _top_k(sp.csr_matrix(dense), 3)
+    for r in range(dense.shape[0]):
+        expected = np.sort(dense[r][dense[r] > 0])[::-1][:3]
+        assert np.allclose(data[rows == r], expected)
+        assert (rank[rows == r] == np.arange(len(expected))).all()
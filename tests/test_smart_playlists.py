@@ -0,0 +1,57 @@
+import pytest
+from smart_playlists import compile_rule
+
+def test_text_rule():
+    assert compile_rule(['artist', '=', 'Bob Marley']) == (
+        "lower(artists.artist_nm) = lower(%s)", ['Bob Marley']
+    )
+
+@pytest.mark.parametrize('op, pattern', [
+    ('contains', '%marley%'),
+    ('not_contains', '%marley%'),
+    ('starts_with', 'marley%'),
+    ('ends_with', '%marley'),
+])
+def test_like_patterns(op, pattern):
+    _, values = compile_rule(['artist', op, 'Marley'])
+    assert values == [pattern]
+
+def test_like_wildcards_are_escaped():
+    _, values = compile_rule(['title', 'contains', '100%_sure'])
+    assert values == ['%100\\%\\_sure%']
+
+def test_number_rule():
+    assert compile_rule(['duration', '>', '300']) == ("song_files.duration > %s", [300.0])
+    assert compile_rule(['bpm', '!=', 120]) == ("song_files.beats_per_min is distinct from %s", [120.0])
+
+def test_playlist_rule():
+    sql, values = compile_rule(['playlist', '!=', 'Favorites'])
+    assert sql.startswith('not exists (')
+    assert values == ['Favorites']
+
+def test_groups():
+    sql, values = compile_rule({'all': [
+        ['duration', '>', 300],
+        {'any': [['genre', '=', 'reggae'], ['artist', 'contains', 'marley']]},
+    ]})
+    assert sql == (
+        "(song_files.duration > %s and "
+        "(lower(genres.genre_nm) = lower(%s) or lower(artists.artist_nm) like %s))"
+    )
+    assert values == [300.0, 'reggae', '%marley%']
+
+def test_empty_groups():
+    assert compile_rule({'all': []}) == ('true', [])
+    assert compile_rule({'any': []}) == ('false', [])
+
+@pytest.mark.parametrize('rule', [
+    ['rating', '=', 5],
+    ['artist', '>', 'a'],
+    ['duration', 'contains', 3],
+    ['playlist', 'contains', 'Favorites'],
+    {'none': []},
+    {'all': [], 'any': []},
+])
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        compile_rule(rule)
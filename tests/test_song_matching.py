@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+from song_matching import (
+    normalize_name,
+    match_songs,
+)
+
+@pytest.mark.parametrize('name, key', [
+    ('The Beatles', 'beatles'),
+    ('Beyoncé', 'beyonce'),
+    ('Simon & Garfunkel', 'simon and garfunkel'),
+    ('Song (feat. Someone)', 'song'),
+    ('Song feat. Someone', 'song'),
+    ('Song (Live)', 'song'),
+    ('Song - Live', 'song'),
+    ('Song - Live at Wembley 1986', 'song'),
+    ('Song - 2011 Remaster', 'song'),
+    ('Song - Remastered 2009', 'song'),
+    ('Song - Single Version', 'song'),
+    ('A - B - Radio Edit', 'a b'),
+    (None, ''),
+])
+def test_normalize_name(name, key):
+    assert normalize_name(name) == key
+
+@pytest.mark.parametrize('name, key', [
+    ('Song - Live Forever', 'song live forever'),
+    ('Live Forever', 'live forever'),
+    ('Song - Edit Me', 'song edit me'),
+])
+def test_normalize_name_keeps_titles_that_look_like_notes(name, key):
+    assert normalize_name(name) == key
+
+def test_match_songs():
+    local = pd.DataFrame(
+        [
+            (1, 'Hey Jude', 'The Beatles', 'Hey Jude'),
+            (2, 'Yesterday', 'The Beatles', 'Help!'),
+            (3, 'Bohemian Rhapsody', 'Queen', 'A Night at the Opera'),
+            (4, 'Nothing Like It', 'Nobody', None),
+        ],
+        columns=['song_id','title','artist','album']
+    )
+    remote = pd.DataFrame(
+        [
+            ('g1', 'Hey Jude - 2015 Remaster', 'Beatles', 'Hey Jude'),
+            ('g2', 'Yesterday', 'The Beatles', 'Help! (Remastered)'),
+            ('g3', 'Bohemian Rhapsodie', 'Queen', 'A Night at the Opera'),
+            ('g4', 'Something Else', 'Somebody', 'Other'),
+        ],
+        columns=['google_id','title','artist','album']
+    )
+    matches = match_songs(local, remote).set_index('song_id')
+    assert matches.google_id.to_dict() == {1: 'g1', 2: 'g2', 3: 'g3'}
+    assert matches.method.to_dict() == {1: 'exact', 2: 'exact', 3: 'fuzzy'}
+    assert (matches.confidence <= 1).all()
+    assert matches.confidence[3] < 1
@@ -0,0 +1,28 @@
+import threading
+import time
+import pytest
+from sort_playlist import prefetch
+
+def _prefetch_threads():
+    return [t for t in threading.enumerate() if t.name == 'prefetch']
+
+def test_prefetch_yields_every_page():
+    assert list(prefetch(iter([[1], [2], [3]]))) == [[1], [2], [3]]
+
+def test_prefetch_raises_fetch_errors():
+    def pages():
+        yield [1]
+        raise RuntimeError('network down')
+    with pytest.raises(RuntimeError):
+        list(prefetch(pages()))
+
+def test_prefetch_thread_exits_when_consumer_stops_early():
+    # The queue is full when the consumer stops, so the final put has to give up
+    pages = prefetch(iter([[1], [2]]), depth=1)
+    assert next(pages) == [1]
+    time.sleep(0.2)
+    pages.close()
+    deadline = time.monotonic() + 2
+    while _prefetch_threads() and (time.monotonic() < deadline):
+        time.sleep(0.05)
+    assert _prefetch_threads() == []
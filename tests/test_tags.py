@@ -0,0 +1,44 @@
+import os
+import wave
+import pandas as pd
+import pytest
+import mutagen.wave
+from mutagen.id3 import TIT2
+import tags
+
+@pytest.fixture
+def wav_file(tmp_path):
+    """ A short silent WAV file with an ID3 title. """
+    path = str(tmp_path / 'song.wav')
+    with wave.open(path, 'wb') as fp:
+        fp.setnchannels(1)
+        fp.setsampwidth(2)
+        fp.setframerate(8000)
+        fp.writeframes(b'\x00\x00'*800)
+    file = mutagen.wave.WAVE(path)
+    file.add_tags()
+    file.tags.add(TIT2(encoding=3, text='Old Title'))
+    file.save()
+    return path
+
+def test_read_tags_rejects_wav(wav_file):
+    with pytest.raises(ValueError):
+        tags.read_tags(wav_file)
+
+def test_write_tags_leaves_wav_alone(wav_file):
+    before = open(wav_file, 'rb').read()
+    with pytest.raises(ValueError):
+        tags.write_tags(wav_file, {'song_nm': 'New Title'})
+    assert open(wav_file, 'rb').read() == before
+    assert os.listdir(os.path.dirname(wav_file)) == ['song.wav']
+
+def test_write_back_tags_reports_errors_per_file(wav_file, monkeypatch):
+    music_dir = os.path.dirname(wav_file) + '/'
+    drift = pd.DataFrame([
+        dict(song_id=1, file_nm='song.wav', diff={'song_nm': ('Old Title', 'New')}, error=None),
+        dict(song_id=2, file_nm='missing.mp3', diff={'song_nm': (None, 'New')}, error=None),
+    ])
+    monkeypatch.setattr(tags, 'find_tag_drift', lambda *args: drift.copy())
+    report = tags.write_back_tags(None, music_dir)
+    assert report.status.notna().all()
+    assert not (report.status == 'written').any()
@@ -0,0 +1,232 @@
+import datetime
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+import util
+from util import (
+    to_sqlite,
+    normalize_sql,
+    QueryLog,
+    QueryBudgetExceeded,
+    read_tables,
+    written_tables,
+    QueryCache,
+)
+
+def test_to_sqlite_placeholders():
+    query, params = to_sqlite("select * from songs where song_id = %s and song_nm = %s", (1, 'a'))
+    assert query == "select * from songs where song_id = ? and song_nm = ?"
+    assert params == [1, 'a']
+
+def test_to_sqlite_without_values():
+    # psycopg2 doesn't touch '%' when there are no values, so neither does this
+    query, params = to_sqlite("select * from songs where song_nm like '%%a%'")
+    assert query == "select * from songs where song_nm like '%%a%'"
+    assert params == []
+
+def test_to_sqlite_unescapes_percent_signs():
+    query, _ = to_sqlite("select * from songs where song_nm like '%%a' and song_id = %s", [1])
+    assert query == "select * from songs where song_nm like '%a' and song_id = ?"
+
+def test_to_sqlite_tuples_and_lists():
+    query, params = to_sqlite(
+        "select * from songs where song_id in %s or artist_id = any(%s)",
+        ((1, 2), [3, 4])
+    )
+    assert ' '.join(query.split()) == (
+        "select * from songs where song_id in (?, ?) or artist_id in (select value from json_each(?))"
+    )
+    assert params == [1, 2, json.dumps([3, 4])]
+
+def test_to_sqlite_converts_values():
+    when = datetime.datetime(2020, 1, 2, 3, 4, 5)
+    _, params = to_sqlite("select %s, %s", (np.int64(7), when))
+    assert params == [7, '2020-01-02T03:04:05']
+    assert type(params[0]) is int
+
+def test_to_sqlite_ilike():
+    query, _ = to_sqlite("select * from songs where song_nm ILIKE %s", ['a%'])
+    assert query == "select * from songs where song_nm like ?"
+
+def test_to_sqlite_runs_in_sqlite():
+    conn = sqlite3.connect(':memory:')
+    conn.execute("create table songs (song_id integer, song_nm text)")
+    conn.executemany("insert into songs values (?, ?)", [(1, 'One'), (2, 'Two'), (3, 'Three')])
+    query, params = to_sqlite(
+        "select song_id from songs where song_id = any(%s) and song_nm ilike %s order by song_id",
+        ([1, 2, 3], 't%')
+    )
+    assert conn.execute(query, params).fetchall() == [(2,), (3,)]
+    conn.close()
+
+##############################################################################
+##                      Table extraction and the cache                      ##
+##############################################################################
+
+@pytest.mark.parametrize('query, tables', [
+    ("select * from songs", {'songs'}),
+    ("select * from songs s, artists a where s.artist_id = a.artist_id", {'songs', 'artists'}),
+    ("""
+    select songs.song_nm
+    from songs
+        join artists on artists.artist_id = songs.artist_id
+        left join albums on albums.album_id = songs.album_id
+    where songs.song_nm = 'from genres'
+    """, {'songs', 'artists', 'albums'}),
+    ("""
+    with recent as (
+        select song_id from plays where played_at > now() - interval '1 day'
+    )
+    select * from recent join songs using (song_id)
+    """, {'plays', 'recent', 'songs'}),
+    ("select * from songs where song_nm is distinct from lower(%s)", {'songs'}),
+    ("select * from (select song_id from playlist_songs) ps join songs using (song_id)", {'playlist_songs', 'songs'}),
+    ("""
+    select songs.song_id
+    from songs
+        left join lateral (select file_nm from song_files where song_files.song_id = songs.song_id limit 1) f on true
+    """, {'songs', 'song_files'}),
+    ("select extract(year from now()), * from public.songs", {'songs'}),
+])
+def test_read_tables(query, tables):
+    assert read_tables(query) == tables
+
+@pytest.mark.parametrize('query, tables', [
+    ("insert into songs (song_id) values (1)", {'songs'}),
+    ("insert into songs (song_id, song_nm) select song_id, song_nm from staging", {'songs'}),
+    ("update songs set album_id = m.new_id from album_merges m where songs.album_id = m.old_id", {'songs'}),
+    ("update only songs set song_nm = 'x'", {'songs'}),
+    ("delete from albums using album_merges where albums.album_id = album_merges.old_id", {'albums'}),
+    ("""
+    insert into artist_play_counts (artist_id, play_count)
+    select artist_id, count(*) from plays group by 1
+    on conflict (artist_id) do update set play_count = excluded.play_count
+    """, {'artist_play_counts'}),
+    ("""
+    insert into genres (genre_nm) values ('x')
+    on conflict (genre_nm) do
+        update set genre_nm = excluded.genre_nm
+    """, {'genres'}),
+    ("""
+    with moved as (
+        update playlist_songs set playlist_order = 0 where song_id = 1 returning playlist_id
+    )
+    delete from playlists where playlist_id in (select playlist_id from moved)
+    """, {'playlist_songs', 'playlists'}),
+    ("refresh materialized view concurrently playlist_tracks", {'playlist_tracks'}),
+    ("truncate table plays", {'plays'}),
+    ("drop table if exists song_artwork", {'song_artwork'}),
+    ("update public.songs set song_nm = 'x'", {'songs'}),
+    ("select * from songs where song_nm = 'delete from artists'", set()),
+    ("select * from songs for update", set()),
+    ("select * from songs for update of songs skip locked", set()),
+])
+def test_written_tables(query, tables):
+    assert written_tables(query) == tables
+
+def _cache(**kwargs):
+    return QueryCache(**kwargs)
+
+def _put(cache, query, df=None, scope='db'):
+    key = cache.key(query, None, scope)
+    cache.put(key, pd.DataFrame(dict(a=[1, 2])) if df is None else df, cache.generation())
+    return key
+
+def test_cache_hit_returns_a_copy():
+    cache = _cache()
+    key = _put(cache, "select * from songs")
+    df = cache.get(key)
+    df['a'] = 0
+    assert cache.get(key).a.tolist() == [1, 2]
+    assert cache.stats['hits'] == 2
+
+def test_cache_key_ignores_whitespace():
+    cache = _cache()
+    assert cache.key("select *\n  from songs", None, 'db') == cache.key("select * from songs", None, 'db')
+    assert cache.key("select * from songs", (1,), 'db') != cache.key("select * from songs", (2,), 'db')
+
+def test_cache_lru_eviction():
+    cache = _cache(max_entries=2)
+    a = _put(cache, "select * from songs")
+    b = _put(cache, "select * from artists")
+    cache.get(a)
+    c = _put(cache, "select * from albums")
+    assert cache.get(b) is None
+    assert cache.get(a) is not None
+    assert cache.get(c) is not None
+    assert cache.stats['evictions'] == 1
+
+def test_cache_byte_limit_counts_strings():
+    df = pd.DataFrame(dict(nm=['x'*1000]*100))
+    cache = _cache(max_bytes=4*50_000)
+    _put(cache, "select * from songs", df)
+    # 100 kB of strings is over a quarter of the budget, so it isn't cached
+    assert len(cache) == 0
+
+def test_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(util.time, 'monotonic', lambda: now[0])
+    cache = _cache(ttl=60)
+    key = _put(cache, "select * from songs")
+    now[0] += 59
+    assert cache.get(key) is not None
+    now[0] += 2
+    assert cache.get(key) is None
+    assert cache.stats['expirations'] == 1
+
+def test_cache_invalidation():
+    cache = _cache()
+    songs = _put(cache, "select * from songs join artists using (artist_id)")
+    genres = _put(cache, "select * from genres")
+    other_db = _put(cache, "select * from songs", scope='other')
+    assert cache.invalidate({'artists'}, 'db') == 1
+    assert cache.get(songs) is None
+    assert cache.get(genres) is not None
+    assert cache.get(other_db) is not None
+
+def test_cache_invalidation_follows_dependents():
+    cache = _cache()
+    key = _put(cache, "select * from song_play_counts")
+    cache.invalidate({'songs'})
+    assert cache.get(key) is None
+
+def test_cache_skips_results_that_raced_a_write():
+    cache = _cache()
+    key = cache.key("select * from songs", None, 'db')
+    generation = cache.generation()
+    cache.invalidate({'albums'})
+    cache.put(key, pd.DataFrame(dict(a=[1])), generation)
+    assert cache.get(key) is None
+
+##############################################################################
+##                              Query logs                                  ##
+##############################################################################
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT *\n  FROM songs WHERE song_id = 42 AND song_nm = 'it''s'") == (
+        "select * from songs where song_id = ? and song_nm = ?"
+    )
+
+def test_normalize_sql_collapses_value_lists():
+    a = normalize_sql("insert into plays (song_id, position) values (1, 2.5), (3, 4.0)")
+    b = normalize_sql("insert into plays (song_id, position) values (7, 1)")
+    assert a == b == "insert into plays (song_id, position) values (...)"
+
+def test_normalize_sql_keeps_identifiers_with_digits():
+    assert normalize_sql("select mp3_2 from t1") == "select mp3_2 from t1"
+
+def test_query_log_budget():
+    log = QueryLog('add song')
+    for i in range(6):
+        log._record(f"select * from songs where song_id = {i}", 0.001, 1, 0)
+    log._record("select 1", 0.001, 1, 1)
+    log.connections = 2
+    assert log.repeated(5) == {"select * from songs where song_id = ?": 6}
+    assert log.summary().loc["select * from songs where song_id = ?", 'count'] == 6
+    log.check_budget(max_queries=7, max_connections=2, max_repeats=6)
+    with pytest.raises(QueryBudgetExceeded):
+        log.check_budget(max_repeats=5)
+    with pytest.raises(QueryBudgetExceeded):
+        log.check_budget(max_connections=1)